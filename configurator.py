@@ -1,7 +1,24 @@
 import getpass
 from configparser import ConfigParser, ExtendedInterpolation
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Iterable, Optional
+from typing import Dict, Iterable, Optional, Tuple
+
+
+@lru_cache(maxsize=None)
+def _read(
+    config_dir: Path,
+    config_files: Tuple[Path, ...],
+    interpolate_vars: Tuple[Tuple[str, str], ...],
+) -> Tuple[ConfigParser, list]:
+    """Parse the config files once per process, every module's
+    CONFIG = Config() shares the parser (so don't modify it)."""
+    parser = ConfigParser(
+        defaults=dict(interpolate_vars),
+        interpolation=ExtendedInterpolation(),
+        converters={"path": Path},
+    )
+    return parser, parser.read(config_dir / file for file in config_files)
 
 
 class Config:
@@ -27,13 +44,10 @@ class Config:
             if interpolate_vars is None
             else interpolate_vars
         )
-        self.parser = ConfigParser(
-            defaults=interpolate_vars,
-            interpolation=ExtendedInterpolation(),
-            converters={"path": Path},
-        )
-        self.config_files = self.parser.read(
-            self.config_dir / file for file in config_files
+        self.parser, self.config_files = _read(
+            self.config_dir,
+            tuple(config_files),
+            tuple(sorted(interpolate_vars.items())),
         )
 
     def __getitem__(self, item):
@@ -0,0 +1,169 @@
+"""Quantile bins that can be kept fixed across runs.
+
+pd.qcut on the whole frame moves every bin edge whenever a collection date
+is added, so e.g. bin_gdp chord diagrams from different runs can't be
+compared. QuantileBins keeps a quantile sketch per column instead: the
+weighted values seen so far, compressed to at most SKETCH_SIZE centroids
+(exact while a column has no more distinct values than that). Sketches of
+all columns are (columns x centroids) arrays, so merging in new data,
+compressing and computing breakpoints are one pass over all columns.
+
+Each update only adds the query dates the sketch hasn't seen, and is saved
+as a new version in {processed}/_bins/{name}-{version}.json, with the dates
+it covers and its breakpoints. A new date still moves the breakpoints (a
+bit), so to compare runs load one version and apply it without updating.
+Rows of a date already seen are never sketched again, even if they change.
+Values are binned with np.searchsorted on the breakpoints, right closed
+like pd.qcut.
+"""
+import json
+import os
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+
+CONFIG = Config()
+
+SKETCH_SIZE = 1000
+LABELS = {5: ['Low', 'Low-middle', 'Middle', 'Middle-high', 'High']}
+
+
+def _bins_dir():
+    bins_dir = f"{CONFIG['directories.data']['processed']}/_bins"
+    if not os.path.exists(bins_dir):
+        os.mkdir(bins_dir)
+    return bins_dir
+
+
+def compress(values, weights, size=SKETCH_SIZE):
+    """Merge weighted values (columns x n) into at most size centroids per
+    column, keeping the weighted order. Equal values are always merged,
+    and if a column has at most size distinct values nothing else is."""
+    order = np.argsort(values, axis=1, kind='stable')
+    values = np.take_along_axis(values, order, axis=1)
+    weights = np.take_along_axis(weights, order, axis=1)
+    weights = np.where(np.isnan(values), 0, weights)
+    new = (np.diff(values, axis=1, prepend=np.nan) != 0) & ~np.isnan(values)
+    # index of each value among the distinct ones, 0 for all-NaN columns
+    distinct = np.maximum(np.cumsum(new, axis=1) - 1, 0)
+    cum = np.cumsum(weights, axis=1)
+    total = np.maximum(cum[:, -1:], 1e-300)
+    by_weight = np.minimum(
+        ((cum - weights / 2) / total * size).astype(int), size - 1)
+    exact = distinct[:, -1:] < size
+    bucket = np.where(exact, np.minimum(distinct, size - 1), by_weight)
+    bucket = bucket + size * np.arange(len(values))[:, None]
+    length = size * len(values)
+    sums = np.bincount(bucket.ravel(), (weights * np.nan_to_num(values))
+                       .ravel(), minlength=length)
+    new_weights = np.bincount(bucket.ravel(), weights.ravel(),
+                              minlength=length)
+    with np.errstate(invalid='ignore'):
+        new_values = sums / new_weights
+    # exact buckets keep their value as is, w * v / w can round off it
+    flat = bucket.ravel()
+    starts = np.r_[True, flat[1:] != flat[:-1]]
+    first = np.full(length, np.nan)
+    first[flat[starts]] = values.ravel()[starts]
+    new_values = np.where(np.repeat(exact.ravel(), size), first, new_values)
+    return (new_values.reshape(-1, size),
+            new_weights.reshape(-1, size))
+
+
+def weighted_quantiles(values, weights, probs):
+    """Quantiles of each row of a sketch, (columns x probs).
+
+    Interpolates between order statistics like np.quantile, which it
+    matches exactly when the weights are counts of exact values.
+    """
+    values = np.where(weights > 0, values, np.inf)
+    order = np.argsort(values, axis=1, kind='stable')
+    values = np.take_along_axis(values, order, axis=1)
+    cum = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1)
+    # position among the n values, 0 to n - 1
+    pos = (cum[:, -1:] - 1) * np.asarray(probs)[None, :]
+    lo = np.floor(pos)
+
+    def _order_stat(rank):
+        idx = np.minimum(
+            (cum[:, None, :] <= rank[..., None]).sum(axis=2),
+            cum.shape[1] - 1)
+        return np.take_along_axis(values, idx, axis=1)
+    lo_value, hi_value = _order_stat(lo), _order_stat(lo + 1)
+    with np.errstate(invalid='ignore'):
+        return np.where(pos > lo, lo_value + (pos - lo) *
+                        (hi_value - lo_value), lo_value)
+
+
+class QuantileBins:
+    """Quantile sketches and breakpoints of some columns, one version."""
+
+    def __init__(self, columns, q=5, values=None, weights=None, dates=(),
+                 version=0):
+        self.columns, self.q = list(columns), q
+        self.weights = np.zeros((len(columns), 0)) \
+            if weights is None else np.asarray(weights, dtype=float)
+        self.values = np.full(self.weights.shape, np.nan) \
+            if values is None else np.where(
+                self.weights > 0, np.asarray(values, dtype=float), np.nan)
+        self.dates, self.version = sorted(dates), version
+        self.labels = LABELS.get(q, [f'Q{i}' for i in range(1, q + 1)])
+
+    @property
+    def breakpoints(self):
+        """(columns x q - 1) inner bin edges."""
+        if not self.values.shape[1]:
+            return np.full((len(self.columns), self.q - 1), np.nan)
+        return weighted_quantiles(
+            self.values, self.weights, np.arange(1, self.q) / self.q)
+
+    def update(self, df, date_col='query_date'):
+        """New version with the rows of df from dates not seen before.
+        The rows of dates already seen are ignored, changed or not."""
+        new = df[~df[date_col].isin(self.dates)]
+        if new.empty:
+            return self
+        x = new[self.columns].values.T.astype(float)
+        values, weights = compress(
+            np.hstack([self.values, x]),
+            np.hstack([self.weights, np.ones_like(x)]))
+        return QuantileBins(
+            self.columns, self.q, values, weights,
+            set(self.dates) | set(new[date_col]), self.version + 1)
+
+    def apply(self, df):
+        """df with a categorical bin_{col} column for each column."""
+        df = df.copy()
+        for col, edges in zip(self.columns, self.breakpoints):
+            x = df[col].values.astype(float)
+            codes = np.searchsorted(edges, x, side='left')
+            df[f'bin_{col}'] = pd.Categorical.from_codes(
+                np.where(np.isnan(x), -1, codes), self.labels, ordered=True)
+        return df
+
+    def save(self, name):
+        with open(f"{_bins_dir()}/{name}-{self.version}.json", 'w') as f:
+            json.dump({
+                'columns': self.columns, 'q': self.q, 'dates': self.dates,
+                'breakpoints': dict(zip(
+                    self.columns, self.breakpoints.tolist())),
+                # JSON has no NaN, empty centroids have weight 0
+                'values': np.nan_to_num(self.values).tolist(),
+                'weights': self.weights.tolist()}, f)
+
+    @classmethod
+    def load(cls, name, version=None):
+        """Saved bins, the latest version unless one is given."""
+        if version is None:
+            versions = [int(x.rsplit('-', 1)[1][:-5])
+                        for x in glob(f"{_bins_dir()}/{name}-*.json")]
+            if not versions:
+                return None
+            version = max(versions)
+        with open(f"{_bins_dir()}/{name}-{version}.json") as f:
+            saved = json.load(f)
+        return cls(saved['columns'], saved['q'], saved['values'],
+                   saved['weights'], saved['dates'], version)
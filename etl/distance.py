@@ -0,0 +1,162 @@
+"""Inter-country distances from city coordinates and populations.
+
+Same method as distance.R (Maciej's), for all country pairs at once: take
+the max_cities most populous cities of each country and average the
+distances between every origin city and destination city.
+
+dist_pop_weighted: (sum_kl w_k w_l d_kl^theta / sum_kl w_k w_l)^(1/theta)
+    with city population weights, theta = 1 (CEPII distw)
+dist_pop_weighted_ces: the same with theta = -1 (CEPII distwces)
+dist_unweighted: mean distance between the cities
+dist_biggest_cities: distance between the most populous cities
+
+Distances are haversine great circle distances in km (distance.R uses
+geosphere's ellipsoid, they differ by well under 1%). Cities are packed into
+(countries x max_cities) arrays and origins are processed in chunks, so the
+(chunk x countries x cities x cities) distance array stays under
+MAX_CHUNK_BYTES. Results are cached in the processed _cache folder, keyed on
+the city file and max_cities.
+
+The city file is maps::world.cities written to csv (name, country.etc, pop,
+lat, long), an iso3 column is used instead of country.etc if there is one.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from utils.misc import name_to_iso3
+
+CONFIG = Config()
+
+CITIES_FILE = f"{CONFIG['directories.data']['raw']}/cities/world_cities.csv"
+# same as nCit in distance.R
+MAX_CITIES = 50
+MAX_CHUNK_BYTES = 2 ** 27
+EARTH_RADIUS_KM = 6371.0088
+SAME_PLACE_KM = 1e-3
+MEASURES = ['dist_pop_weighted', 'dist_pop_weighted_ces', 'dist_unweighted',
+            'dist_biggest_cities']
+
+
+def read_cities(cities_file=CITIES_FILE):
+    df = pd.read_csv(cities_file)
+    if 'iso3' not in df.columns:
+        names = df['country.etc'].unique()
+        iso3s = {x: name_to_iso3(x) for x in names}
+        df['iso3'] = df['country.etc'].map(iso3s)
+    return df.dropna(subset=['iso3', 'lat', 'long']).assign(
+        iso3=lambda x: x['iso3'].str.lower())
+
+
+def pack_cities(cities, max_cities=MAX_CITIES):
+    """Return (isos, lat, lon, pop): (countries x max_cities) arrays of
+    the largest cities of each country in radians, padded with zero
+    population (and NaN coordinates), most populous first."""
+    cities = cities.sort_values('pop', ascending=False, kind='mergesort')
+    cities = cities[cities.groupby('iso3').cumcount() < max_cities]
+    isos, country = np.unique(
+        cities['iso3'].values.astype(str), return_inverse=True)
+    rank = cities.groupby('iso3').cumcount().values
+    shape = (len(isos), min(max_cities, rank.max() + 1))
+    lat, lon = np.full(shape, np.nan), np.full(shape, np.nan)
+    pop = np.zeros(shape)
+    lat[country, rank] = np.radians(cities['lat'].values)
+    lon[country, rank] = np.radians(cities['long'].values)
+    pop[country, rank] = cities['pop'].values
+    return isos, lat, lon, pop
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in km between points given in radians."""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def _unit_vectors(lat, lon):
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+def _weighted_sum(w_orig, d, w_dest):
+    """sum_kl w_orig[a, k] d[a, k, b, l] w_dest[b, l] for every a, b."""
+    return np.einsum('ak,akbl,bl->ab', w_orig, d, w_dest, optimize=True)
+
+
+def country_distances(lat, lon, pop, max_chunk_bytes=MAX_CHUNK_BYTES):
+    """(countries x countries) array of each of MEASURES."""
+    n, k = lat.shape
+    has_city = pop > 0
+    # padding cities get weight 0, their coordinates just need to be finite
+    xyz = np.nan_to_num(_unit_vectors(lat, lon)).reshape(n * k, 3)
+    # the chunk's distances plus a boolean mask
+    chunk = max(1, max_chunk_bytes // (n * k * k * 9))
+    out = {x: np.full((n, n), np.nan) for x in MEASURES}
+    out['dist_biggest_cities'] = haversine(
+        lat[:, [0]], lon[:, [0]], lat[None, :, 0], lon[None, :, 0])
+    w_sum = np.outer(pop.sum(axis=1), pop.sum(axis=1))
+    n_pairs = np.outer(has_city.sum(axis=1), has_city.sum(axis=1))
+    for start in range(0, n, chunk):
+        o = slice(start, start + chunk)
+        # (origin cities x destination cities) from one matrix product,
+        # haversine = 2R asin(chord / 2) with chord^2 = 2 - 2 cos(angle),
+        # in place since these are the big arrays
+        d = xyz[start * k:(start + chunk) * k] @ xyz.T
+        d *= -2
+        d += 2
+        np.maximum(d, 0, out=d)
+        np.sqrt(d, out=d)
+        d /= 2
+        np.minimum(d, 1, out=d)
+        np.arcsin(d, out=d)
+        d *= 2 * EARTH_RADIUS_KM
+        # rounding leaves the same city a few cm from itself
+        d[d < SAME_PLACE_KM] = 0
+        # -> (origins x origin cities x destinations x destination cities)
+        d = d.reshape(-1, k, n, k)
+        out['dist_pop_weighted'][o] = _weighted_sum(pop[o], d, pop) / w_sum[o]
+        out['dist_unweighted'][o] = _weighted_sum(
+            has_city[o], d, has_city) / n_pairs[o]
+        # the same city on both sides (d = 0) is left out of theta = -1
+        same = _weighted_sum(pop[o], d == 0, pop)
+        with np.errstate(divide='ignore'):
+            np.divide(1, d, out=d)
+        d[np.isinf(d)] = 0
+        out['dist_pop_weighted_ces'][o] = \
+            (w_sum[o] - same) / _weighted_sum(pop[o], d, pop)
+    return out
+
+
+def _cache_path(cities_file, max_cities):
+    cache_dir = f"{CONFIG['directories.data']['processed']}/_cache"
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    version = int(os.path.getmtime(cities_file))
+    return f"{cache_dir}/city_distances_{max_cities}_{version}.npz"
+
+
+def city_distances(cities_file=CITIES_FILE, max_cities=MAX_CITIES):
+    """Long dataframe of MEASURES for every country pair, indexed by
+    (iso_o, iso_d) like prep_geo. Cached per city file and max_cities."""
+    cache = _cache_path(cities_file, max_cities)
+    if os.path.exists(cache):
+        arrays = np.load(cache, allow_pickle=False)
+        isos, out = arrays['isos'], {x: arrays[x] for x in MEASURES}
+    else:
+        isos, lat, lon, pop = pack_cities(
+            read_cities(cities_file), max_cities)
+        out = country_distances(lat, lon, pop)
+        np.savez(cache, isos=isos, **out)
+    index = pd.MultiIndex.from_product([isos, isos], names=['iso_o', 'iso_d'])
+    return pd.DataFrame({x: out[x].ravel() for x in MEASURES}, index=index)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cities_file', default=CITIES_FILE)
+    parser.add_argument('--max_cities', type=int, default=MAX_CITIES)
+    args = parser.parse_args()
+    print(city_distances(**vars(args)).describe())
@@ -0,0 +1,245 @@
+"""Watch the raw data directory and run the ETL on new scrape drops.
+
+Every poll looks for flow files ({date}_LinkedInRecruiter_..._wr6.csv) and
+baserate files (LinkedInRecruiterBaseratesSimple_withTime_*.csv) that haven't
+been ingested yet, checks their columns, and runs
+
+    prep_bilateral_flows.main(date)   newest new flow file
+    prep_total_users_dest.main()      newest baserate file
+    model/trends.py, model/forecast.py --update
+
+Files count as dropped once they haven't changed for SETTLE_SECONDS, so
+half copied files are left for the next poll. Each scrape file holds every
+collection date so far, so only the newest pending file of each kind is
+run, older ones are marked superseded: drops that pile up while a run is
+going (or while the service is down) cost one run, not one each.
+
+Progress is kept per file in {processed}/_ingest/state.json (status seen,
+running, done, failed, invalid or superseded, with the size and mtime it
+had), written after every step. A file left running by a crash is run
+again on restart, a file that changes on disk (say a failed one that was
+fixed) is picked up again. A pass that raises is printed and the next
+poll goes ahead. Only one ingester can run at a time, it holds a lock on
+_ingest/ingest.lock.
+
+    python etl/ingest.py           # poll every POLL_SECONDS
+    python etl/ingest.py --once    # one pass, e.g. from cron
+"""
+import argparse
+import fcntl
+import json
+import os
+import re
+import time
+import traceback
+from datetime import datetime
+
+import pandas as pd
+
+from configurator import Config
+from etl import prep_bilateral_flows, prep_total_users_dest
+from etl.prep_bilateral_flows import RAW_COLUMNS
+from model import forecast, trends
+
+CONFIG = Config()
+
+POLL_SECONDS = 300
+SETTLE_SECONDS = 60
+PATTERNS = {
+    'flows': re.compile(
+        r'^(\d{4}-\d{2}-\d{2})_LinkedInRecruiter_'
+        r'dffromtobase_merged_wr6\.csv$'),
+    'baserates': re.compile(
+        r'^LinkedInRecruiterBaseratesSimple_withTime_.*\.csv$')}
+SCHEMAS = {
+    'flows': RAW_COLUMNS,
+    'baserates': ['query_country', 'total', 'query_time', 'query_info']}
+PENDING = ['seen', 'running']
+
+
+def _ingest_dir():
+    ingest_dir = f"{CONFIG['directories.data']['processed']}/_ingest"
+    if not os.path.exists(ingest_dir):
+        os.mkdir(ingest_dir)
+    return ingest_dir
+
+
+def acquire_lock():
+    """Open and lock _ingest/ingest.lock, None if another ingester has it.
+    Keep the returned file open, the lock goes when it's closed."""
+    lock = open(f"{_ingest_dir()}/ingest.lock", 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    lock.write(str(os.getpid()))
+    lock.flush()
+    return lock
+
+
+def load_state():
+    path = f"{_ingest_dir()}/state.json"
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state):
+    """Write to a temporary file and rename, so a crash can't leave half a
+    state file."""
+    path = f"{_ingest_dir()}/state.json"
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def _set(state, name, status, **info):
+    state[name].update(
+        status=status, updated=datetime.now().isoformat(timespec='seconds'),
+        **info)
+    save_state(state)
+
+
+def scan(state, raw_dir=None, now=None):
+    """Add files of raw_dir that are new or changed to state as seen."""
+    raw_dir = raw_dir or CONFIG['directories.data']['raw']
+    now = now or time.time()
+    for name in sorted(os.listdir(raw_dir)):
+        kind = next((k for k, p in PATTERNS.items() if p.match(name)), None)
+        if kind is None:
+            continue
+        stat = os.stat(os.path.join(raw_dir, name))
+        if now - stat.st_mtime < SETTLE_SECONDS:
+            continue
+        known = state.get(name, {})
+        if (known.get('size'), known.get('mtime')) != \
+                (stat.st_size, stat.st_mtime):
+            state[name] = {'kind': kind, 'size': stat.st_size,
+                           'mtime': stat.st_mtime, 'status': 'seen'}
+    return state
+
+
+def validate(name, kind, raw_dir=None):
+    """Return what's wrong with the file's header, None if nothing."""
+    raw_dir = raw_dir or CONFIG['directories.data']['raw']
+    try:
+        header = pd.read_csv(os.path.join(raw_dir, name), nrows=0).columns
+    except (pd.errors.EmptyDataError, pd.errors.ParserError,
+            UnicodeDecodeError, OSError) as e:
+        return f"unreadable: {e}"
+    missing = [x for x in SCHEMAS[kind] if x not in header]
+    return f"missing {missing}" if missing else None
+
+
+def _order(name, info):
+    """Flow files sort by collection date, baserates by when they landed."""
+    match = PATTERNS['flows'].match(name)
+    return (match.group(1) if match else '', info['mtime'], name)
+
+
+def next_drops(state, raw_dir=None):
+    """Return {kind: newest valid pending file}, marking invalid files and
+    older pending files as such in state."""
+    drops = {}
+    for kind in PATTERNS:
+        files = sorted(
+            ((name, info) for name, info in state.items()
+             if info['kind'] == kind and info['status'] in PENDING + ['done']),
+            key=lambda x: _order(*x), reverse=True)
+        newest = None
+        for name, info in files:
+            error = None if info['status'] == 'done' else \
+                validate(name, kind, raw_dir)
+            if info['status'] == 'done':
+                # pending files older than the newest done one are stale
+                newest = newest or name
+            elif error:
+                _set(state, name, 'invalid', error=error)
+            elif newest is not None:
+                _set(state, name, 'superseded', by=newest)
+            else:
+                drops[kind] = newest = name
+    return drops
+
+
+def _run(state, name, func, *args):
+    _set(state, name, 'running')
+    start = time.perf_counter()
+    try:
+        func(*args)
+    except Exception:
+        _set(state, name, 'failed', error=traceback.format_exc(limit=3))
+        print(f"{name} failed, see {_ingest_dir()}/state.json")
+        return False
+    _set(state, name, 'done', seconds=round(time.perf_counter() - start, 1))
+    print(f"{name} done")
+    return True
+
+
+def ingest(state, update_chord_diagram=False, db=False):
+    """One pass: run the ETL on the newest drops, then the models. Returns
+    whether anything was run."""
+    drops = next_drops(scan(state))
+    if not drops:
+        return False
+    if 'flows' in drops:
+        name = drops['flows']
+        date = PATTERNS['flows'].match(name).group(1)
+        if not _run(state, name, prep_bilateral_flows.main, date,
+                    update_chord_diagram, db):
+            # the goers are merged onto model_input, don't mix versions
+            return True
+    goers = drops.get('baserates') or max(
+        (x for x, info in state.items()
+         if info['kind'] == 'baserates' and info['status'] == 'done'),
+        key=lambda x: _order(x, state[x]), default=None)
+    if goers is not None:
+        if 'baserates' not in drops:
+            # same baserates against the new model_input
+            state[goers]['status'] = 'seen'
+        if not _run(state, goers, prep_total_users_dest.main, db, goers):
+            return True
+    try:
+        trends.main(trends.MIN_DATES, trends.ALPHA)
+        forecast.main(forecast.HORIZON, 'best', True, 0)
+    except Exception:
+        # the inputs are in, the models can be rerun by hand
+        traceback.print_exc()
+    return True
+
+
+def main(poll, once, update_chord_diagram, db):
+    lock = acquire_lock()
+    assert lock is not None, "Another ingester is running"
+    state = load_state()
+    interrupted = [x for x, info in state.items()
+                   if info['status'] == 'running']
+    if interrupted:
+        print(f"Resuming {interrupted}")
+    while True:
+        try:
+            ingest(state, update_chord_diagram, db)
+        except Exception:
+            # e.g. raw directory unmounted, try again next poll
+            if once:
+                raise
+            traceback.print_exc()
+        if once:
+            break
+        time.sleep(poll)
+    lock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--poll', type=int, default=POLL_SECONDS,
+                        help='seconds between looks at the raw directory')
+    parser.add_argument('--once', action='store_true',
+                        help='one pass instead of polling')
+    parser.add_argument('--update_chord_diagram', action='store_true')
+    parser.add_argument('--db', action='store_true',
+                        help='also write outputs to the embedded database')
+    args = parser.parse_args()
+    main(**vars(args))
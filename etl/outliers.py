@@ -0,0 +1,138 @@
+"""Flag anomalous scrapes by comparing every value to its own history.
+
+Each series (a dyad, or a destination for goers) is laid out as one row of
+a (series x dates) array of log values, so all of them are scored at once:
+
+z: robust z-score, distance from the series median in units of its MAD
+jump_z: distance from the mean of the neighboring dates, in units of the
+    robust spread of those jumps
+
+A value is an outlier if both are large, i.e. a spike away from the rest of
+the series rather than a level shift that persists. Whole destination
+queries are checked too: the origin shares of a query are compared with the
+destination's usual shares (total variation distance), and a query whose
+profile shifts far more than on other dates is flagged as a whole. A
+shifted query can be an honest change in who looks at a destination, so
+only its spikes are marked to drop unless drop_queries is set.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# cutoffs on the robust z-scores (Iglewicz & Hoaglin suggest 3.5)
+Z_MAX = 3.5
+JUMP_MAX = 3.5
+# at least this many dates before a series is scored
+MIN_DATES = 5
+# floor on the spread of log values, so near-constant series aren't flagged
+# for tiny changes
+MIN_SCALE = 0.1
+# share of a destination's origins that has to move to flag a whole query
+MIN_SHIFT = 0.15
+
+
+def _robust_z(x, min_scale):
+    """Robust z-scores along the last axis of x (NaNs ignored): distance
+    from the median in units of 1.4826 * MAD, with the MAD floored."""
+    with warnings.catch_warnings():
+        # all-NaN rows just give NaN scores
+        warnings.simplefilter('ignore', RuntimeWarning)
+        med = np.nanmedian(x, axis=-1, keepdims=True)
+        mad = np.nanmedian(np.abs(x - med), axis=-1, keepdims=True)
+    return (x - med) / np.maximum(1.4826 * mad, min_scale)
+
+
+def _to_array(df, id_cols, values, date_col):
+    """(series x dates) array of values and the row -> cell positions."""
+    series, _ = pd.factorize(pd.MultiIndex.from_frame(df[id_cols]))
+    dates, date_idx = pd.factorize(df[date_col], sort=True)
+    x = np.full((series.max() + 1, len(date_idx)), np.nan)
+    x[series, dates] = values
+    return x, (series, dates)
+
+
+def series_scores(df, id_cols, value_col, date_col='query_date'):
+    """z and jump_z of log(value_col) for every row of df, as a DataFrame
+    aligned with df."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_values = np.log(df[value_col].values.astype(float))
+    x, cells = _to_array(
+        df, id_cols, np.where(np.isfinite(log_values), log_values, np.nan),
+        date_col)
+    z = _robust_z(x, MIN_SCALE)
+    padded = np.pad(x, ((0, 0), (1, 1)), constant_values=np.nan)
+    with warnings.catch_warnings():
+        # dates without either neighbor
+        warnings.simplefilter('ignore', RuntimeWarning)
+        neighbors = np.nanmean(
+            np.stack([padded[:, :-2], padded[:, 2:]]), axis=0)
+    jump_z = _robust_z(x - neighbors, MIN_SCALE)
+    too_short = np.isfinite(x).sum(axis=1) < MIN_DATES
+    z[too_short] = np.nan
+    jump_z[too_short] = np.nan
+    return pd.DataFrame({'z': z[cells], 'jump_z': jump_z[cells]},
+                        index=df.index)
+
+
+def query_scores(df, value_col='flow', orig_col='iso3_orig',
+                 dest_col='iso3_dest', date_col='query_date'):
+    """Profile shift of each (destination, date) query and its robust z
+    across the destination's dates, aligned with df."""
+    share = df[value_col] / df.groupby(
+        [dest_col, date_col])[value_col].transform('sum')
+    usual = share.groupby([df[orig_col], df[dest_col]]).transform('median')
+    shift = (share - usual).abs().groupby(
+        [df[dest_col], df[date_col]]).transform('sum') / 2
+    x, cells = _to_array(df, [dest_col], shift.values, date_col)
+    shift_z = _robust_z(x, MIN_SHIFT / Z_MAX)
+    shift_z[np.isfinite(x).sum(axis=1) < MIN_DATES] = np.nan
+    return pd.DataFrame({'shift': shift.values, 'shift_z': shift_z[cells]},
+                        index=df.index)
+
+
+def flag_outliers(df, id_cols, value_col='flow', queries=True,
+                  date_col='query_date', drop_queries=False):
+    """Audit table of the rows of df that look like bad scrapes.
+
+    Has the id columns, date, value, scores, the reason for the flag and
+    whether to drop the row (spikes, and with drop_queries every row of a
+    shifted query); its index is the index of the flagged rows in df.
+    """
+    scores = series_scores(df, id_cols, value_col, date_col)
+    spike = (scores['z'].abs() > Z_MAX) & (scores['jump_z'].abs() > JUMP_MAX)
+    reason = pd.Series(np.where(spike, 'spike', ''), index=df.index)
+    if queries:
+        scores = scores.join(query_scores(df, value_col, date_col=date_col))
+        shifted = (scores['shift_z'] > Z_MAX) & (scores['shift'] > MIN_SHIFT)
+        reason = reason.where(
+            ~shifted, reason.str.cat(['query_shift'] * len(df), sep=' ')
+        ).str.strip()
+    flagged = reason != ''
+    drop = spike | (reason.str.contains('query_shift') & drop_queries)
+    return df.loc[flagged, id_cols + [date_col, value_col]].join(
+        scores[flagged]).assign(reason=reason[flagged], drop=drop[flagged])
+
+
+def test_flag_outliers():
+    # the CAF 2020-10-08 scrape dropped by hand before: 8 origins way up
+    caf_bad = ['usa', 'ind', 'gbr', 'deu', 'esp', 'can', 'pol', 'nld']
+    origins = caf_bad + ['fra', 'ita', 'bra', 'nga', 'cmr', 'tcd', 'cog',
+                         'cod', 'sdn', 'ssd', 'gab', 'gnq']
+    dates = ['2020-07-20', '2020-08-10', '2020-09-01', '2020-09-20',
+             '2020-10-08', '2020-10-27', '2020-11-16', '2020-12-05']
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        [(o, 'caf', d) for o in origins for d in dates],
+        columns=['iso3_orig', 'iso3_dest', 'query_date'])
+    base = df['iso3_orig'].map(dict(zip(origins, range(20, 400, 19))))
+    df['flow'] = np.round(base * rng.uniform(0.9, 1.1, len(df)))
+    too_big = (df['query_date'] == '2020-10-08') & \
+        df['iso3_orig'].isin(caf_bad)
+    df.loc[too_big, 'flow'] *= 50
+    audit = flag_outliers(df, ['iso3_orig', 'iso3_dest'])
+    assert set(df.index[too_big]) <= set(audit.index)
+    # the rest of that query shifted with them but isn't dropped
+    assert set(audit.index[audit['drop']]) == set(df.index[too_big])
+    audit = flag_outliers(df, ['iso3_orig', 'iso3_dest'], drop_queries=True)
+    assert audit['drop'].sum() == len(origins)
@@ -1,30 +1,41 @@
 """Prep dyadic LinkedIn Recruiter data for all countries."""
 
-from collections import defaultdict, namedtuple
+from collections import namedtuple
+from functools import partial
 from os import listdir, path, pipe
 import argparse
 
 import numpy as np
 import pandas as pd
-from scipy.stats import variation as cv
-from pycountry import countries
 
+from etl.binning import QuantileBins
+from etl.distance import CITIES_FILE, city_distances
+from etl.outliers import flag_outliers
 from utils.io import save_output
+from utils.loader import load_sources
+from utils.network import network_metrics
 from utils.misc import (no_duplicates, test_no_duplicates,
-                        iso2_to_iso3, name_to_iso3, get_location_hierarchy)
+                        iso2_to_iso3, name_to_iso3, get_location_hierarchy,
+                        prep_eu_states, cyp_hack, fix_query_date)
+from utils.lazy import lazy_import
 from configurator import Config
 
 CONFIG = Config()
+stats = lazy_import('scipy.stats')
+pycountry = lazy_import('pycountry')
+
+
+RAW_COLUMNS = [
+    'country_from', 'country_to', 'number_people_who_indicated',
+    'query_time_round', 'query_info', 'linkedinusers_from',
+    'linkedinusers_to']
 
 
 def read_data(date):
     filename = f'{date}_LinkedInRecruiter_dffromtobase_merged_wr6.csv'
     df = pd.read_csv(
         path.join(f"{CONFIG['directories.data']['raw']}", filename),
-        usecols=[
-            'country_from', 'country_to', 'number_people_who_indicated',
-            'query_time_round', 'query_info', 'linkedinusers_from',
-            'linkedinusers_to']
+        usecols=RAW_COLUMNS
     )
     replace_dict = {
         '_from': '_orig', '_to': '_dest', 'linkedin': '',
@@ -57,7 +68,7 @@ def fix_iso3(df, verbose=True):
     # e.g. FYRO Macedonia and North Macedonia
     for x in suffixes:
         df[f'country_{x}'] = df[f'iso3_{x}'].apply(
-            lambda x: countries.get(alpha_3=x.upper()).name
+            lambda x: pycountry.countries.get(alpha_3=x.upper()).name
         )
     return df.drop_duplicates(
         subset=['iso3_dest', 'iso3_orig', 'query_date'])
@@ -65,29 +76,49 @@ def fix_iso3(df, verbose=True):
 
 def reshape_long_wide(df, wide_col='query_info',
                       value_cols=['users_orig', 'users_dest', 'flow'],
-                      hack=True):
+                      dual_query=False, queries=('r4', 'r6_remote')):
     """Reshape wide_col from long to wide.
 
     query_info column takes two values: 'r4' and 'r6_remote'
     r4 is those open to relocating,
     r6 is open to relocating AND open to remote work
+    With dual_query, the r6 flow is joined onto the r4 rows by dyad and
+    date as flow_r6, with remote_share = flow_r6 / flow (missing where flow
+    is 0). flow stays the r4 count. Dyads with differing values for the
+    same query are an error.
     """
-    if hack:
+    r4, r6 = queries
+    if not dual_query:
         # CHANGE THIS LATER - Tom is investigating
         # basically for now, we only trust r4
-        return df[df['query_info'] == 'r4'].drop('query_info', axis=1)
-        # return df[~(df['query_date'].str.startswith('2021-03-2'))].drop(
-        #     [wide_col], axis=1)
-    else:
-        idx_cols = list(
-            set([x for x in df.columns]) - set(value_cols + [wide_col])
-        )
-        df = df.pivot_table(index=idx_cols, columns=wide_col,
-                            values=value_cols).reset_index()
-        df.columns = ['_'.join(x) if '' not in x else ''.join(x)
-                      for x in df.columns]
-        df.columns = df.columns.to_series().replace({'_r[46]': ''}, regex=True)
-        return df
+        return df[df[wide_col] == r4].drop(wide_col, axis=1)
+    id_cols = [x for x in df.columns if x not in value_cols + [wide_col]]
+    # one integer key per dyad and date, so the checks and the join hash
+    # ints instead of strings; null ids are a group too, not NaN keys
+    key = df.groupby(id_cols, sort=False, dropna=False).ngroup().values
+    split = {}
+    for query in queries:
+        is_query = (df[wide_col] == query).values
+        query_key = pd.Series(key[is_query])
+        dups = df[is_query][query_key.duplicated(keep=False).values]
+        conflicts = dups[~dups.duplicated(keep=False)]
+        if len(conflicts):
+            conflicts.to_csv(path.join(
+                CONFIG['directories.data']['processed'],
+                f'query_conflicts_{query}.csv'), index=False)
+        assert conflicts.empty, \
+            f"{len(conflicts)} {query} rows disagree on {value_cols}, " \
+            f"see query_conflicts_{query}.csv"
+        first = ~query_key.duplicated().values
+        split[query] = (df[is_query][first], query_key[first].values)
+    (r4_df, r4_key), (r6_df, r6_key) = split[r4], split[r6]
+    flow_r6 = pd.Series(r6_df['flow'].values, index=r6_key).reindex(r4_key)
+    missing = len(r6_key) - flow_r6.notna().sum()
+    if missing:
+        print(f"Dropping {missing} {r6} rows without an {r4} row")
+    return r4_df.drop(wide_col, axis=1).assign(
+        flow_r6=pd.array(flow_r6.values, dtype='Int64'),
+        remote_share=lambda x: x['flow_r6'] / x['flow'].where(x['flow'] > 0))
 
 
 def prep_population():
@@ -97,7 +128,8 @@ def prep_population():
     """
     def _helper_func(x):
         try:
-            return countries.get(numeric=str(x).zfill(3)).alpha_3.lower()
+            return pycountry.countries.get(
+                numeric=str(x).zfill(3)).alpha_3.lower()
         except AttributeError:
             return ''
     return pd.read_excel(
@@ -160,33 +192,16 @@ def check_geo(cepii, maciej):
     assert len(diffs) < len(diffs2)
 
 
-def prep_geo():
-    """Prep data on relevant geographic variables.
-
-    CEPII
-    dist: Geodesic distances from lat/long of most populous cities
-    distcap: geodesic distance between capital cities
-    distw: population weighted distance, theta = 1
-    distwces: population weighted distance, theta = -1
-    contig: share a land border
-    comcol: share common colonizer post 1945
-    colony: have ever had a colonial link
-    col45: share common colonizer pre 1945
-    curcol: currently in a colonial relationship
-
-    Maciej
-    dist_pop_weighted: population-weighted average distance between
-    biggest cities
-    dist_biggest_cities: average distance between biggest cities
-    ^ most similar to distwces
-    dist_unweighted: average distance between (?) (not population weighted)
-    """
-    cepii = pd.read_excel(
+def read_cepii_distance():
+    return pd.read_excel(
         path.join(
             f"{CONFIG['directories.data']['raw']}",
             'CEPII_distance/dist_cepii.xls'),
         converters=dict(zip(['iso_o', 'iso_d'], [lambda x: str.lower(x)]*2))
     ).replace({'rom': 'rou'})
+
+
+def read_maciej_distance():
     maciej = pd.read_csv(
         path.join(
             f"{CONFIG['directories.data']['raw']}",
@@ -206,18 +221,56 @@ def prep_geo():
     # map iso2 to iso3
     maciej[['origin2', 'dest2']] = maciej[['origin2', 'dest2']].apply(
         lambda x: x.map(iso2_3))
+    return maciej
+
+
+def read_city_distance():
+    """Distances from city coordinates (etl.distance), empty w/o city file."""
+    cols = ['dist_pop_weighted', 'dist_biggest_cities', 'dist_unweighted']
+    if not path.exists(CITIES_FILE):
+        return pd.DataFrame(columns=cols)
+    return city_distances()[cols]
+
+
+def prep_geo(cepii=None, maciej=None, cities=None):
+    """Prep data on relevant geographic variables.
+
+    CEPII
+    dist: Geodesic distances from lat/long of most populous cities
+    distcap: geodesic distance between capital cities
+    distw: population weighted distance, theta = 1
+    distwces: population weighted distance, theta = -1
+    contig: share a land border
+    comcol: share common colonizer post 1945
+    colony: have ever had a colonial link
+    col45: share common colonizer pre 1945
+    curcol: currently in a colonial relationship
+
+    Maciej
+    dist_pop_weighted: population-weighted average distance between
+    biggest cities
+    dist_biggest_cities: average distance between biggest cities
+    ^ most similar to distwces
+    dist_unweighted: average distance between (?) (not population weighted)
+    """
+    cepii = read_cepii_distance() if cepii is None else cepii
+    maciej = read_maciej_distance() if maciej is None else maciej
+    cities = read_city_distance() if cities is None else cities
     # some checks
     check_geo(cepii,  maciej)
     # merge two 'databases' together
     geo_df = maciej.set_index(['origin2', 'dest2']).merge(
         cepii, how='outer', left_index=True, right_on=['iso_o', 'iso_d'])
-    # fill null distances TODO calculate from latlong w/ Maciej's method
+    geo_df = geo_df.set_index(['iso_o', 'iso_d'])
+    # fill null distances w/ Maciej's method from city coordinates, this
+    # also adds pairs in neither database, CEPII for whatever is left
+    if not cities.empty:
+        geo_df = geo_df.combine_first(cities)
     return geo_df.fillna(
         {'dist_pop_weighted': geo_df['distwces'],
          'dist_biggest_cities': geo_df['distwces'],
          'dist_unweighted': geo_df['dist']}
-    ).drop(['comlang_off', 'dist', 'distcap', 'distw', 'distwces'], axis=1
-           ).set_index(['iso_o', 'iso_d'])
+    ).drop(['comlang_off', 'dist', 'distcap', 'distw', 'distwces'], axis=1)
 
 
 def prep_language():
@@ -281,17 +334,6 @@ def prep_internet_usage():
     return {k: v / 100 for k, v in internet_dict.items()}
 
 
-def prep_eu_states():
-    """Flag eu, eurozone, schengen member countries.
-
-    Data pulled from europa.eu
-    """
-    return pd.read_csv(
-        path.join(f"{CONFIG['directories.data']['raw']}", 'eu_countries.csv'),
-        converters={'country': lambda x: countries.get(name=x).alpha_3.lower()}
-    ).set_index('country')
-
-
 def merge_region_subregion(df):
     """Add columns for country groups using UNSD or Abel/Cohen methods."""
     loc_df = get_location_hierarchy()
@@ -306,26 +348,32 @@ def merge_region_subregion(df):
     return df
 
 
-def bin_continuous_vars(df, cont_vars: list, q: int = 5):
+def bin_continuous_vars(df, cont_vars: list, q: int = 5, version=None):
     """Returns dataframe w/ added columns for quantiles of continuous vars.
     q <- number of quantiles
-    User passes in a list of continuous variables, eg. ['gdp', 'hdi'],
-    and then all columns in data containing that string are identified & binned
+    version <- saved breakpoints to use as is, eg. to compare with a past run
+    User passes in a list of continuous variables, eg. ['gdp', 'hdi'], and
+    their origin and destination columns are binned, eg. bin_gdp_orig.
+    Breakpoints are kept by etl.binning.QuantileBins. Without a version they
+    are updated with any query dates not seen before, so they still move
+    when a date is added; rows of a date already seen are never sketched
+    again, even if a re-scrape or a change to the outlier drops alters them.
     """
-    assert q == 5, NotImplementedError
-    if type(cont_vars) is not list:
-        cont_vars = list(cont_vars)
-    mapper = defaultdict(list)
-    for var in cont_vars:
-        mapper.update({var: [x for x in df.columns if var in x]})
-        cols = mapper[var]
-        assert ((len(cols) > 0) & (np.mod(len(cols), 2) == 0)), \
-            f"Need origin and destination, one is missing from {cols}"
-    labels = ['Low', 'Low-middle', 'Middle', 'Middle-high', 'High']
-    for var, col_list in mapper.items():
-        for col in col_list:
-            df[f'bin_{col}'] = pd.qcut(df[f'{col}'], q=q, labels=labels)
-    return df
+    cols = [f'{var}_{x}' for var in cont_vars for x in ['orig', 'dest']]
+    missing = set(cols) - set(df.columns)
+    assert not missing, f"Need origin and destination, missing {missing}"
+    name = f"{'_'.join(cont_vars)}_q{q}"
+    if version is not None:
+        bins = QuantileBins.load(name, version)
+        assert bins.columns == cols, f"Version {version} bins {bins.columns}"
+        return bins.apply(df)
+    bins = QuantileBins.load(name)
+    if bins is None or bins.columns != cols:
+        bins = QuantileBins(cols, q)
+    updated = bins.update(df)
+    if updated is not bins:
+        updated.save(name)
+    return updated.apply(df)
 
 
 def sensitivity_reciprocal_pairs(df, across=True):
@@ -449,7 +497,7 @@ def get_variation(
     id_cols = ['iso3_orig', 'iso3_dest']
     assert not df[id_cols + [across_col]].duplicated().values.any()
     v_df = df.groupby(id_cols)[value_cols].agg(
-        ['std', 'mean', 'median', 'count', cv]
+        ['std', 'mean', 'median', 'count', stats.variation]
     ).reset_index()
     v_df.columns = ['_'.join(x) if '' not in x
                     else ''.join(x) for x in v_df.columns]
@@ -485,44 +533,59 @@ def prep_chord_diagram(df, grp_var):
         columns={'median': 'flow_median', 'users_dest': 'users_dest_median'})
 
 
-def drop_bad_rows(df):
-    # found these manually using standard deviation
-    too_big = (
-        (df['query_date'] == '2020-10-08') &
-        (df['iso3_dest'] == 'caf') &
-        (df['iso3_orig'].isin(['usa', 'ind', 'gbr', 'deu', 'esp',
-                               'can', 'pol', 'nld']))
-    )
-    # few of these, drop b/c should not be possible
-    same = (df['iso3_dest'] == df['iso3_orig'])
-    return df[~(too_big | same)]
-
+def drop_bad_rows(df, audit_name='outlier_audit', drop_queries=False):
+    """Drop self pairs and scrapes flagged by etl.outliers.
 
-def add_metadata(df):
+    Spikes are dropped; the other rows of a shifted destination query only
+    with drop_queries. All flagged rows are saved to an audit table
+    (audit_name) for review.
+    """
+    # few of these, drop b/c should not be possible
+    df = df[df['iso3_dest'] != df['iso3_orig']]
+    audit = flag_outliers(df, ['iso3_orig', 'iso3_dest'], 'flow',
+                          drop_queries=drop_queries)
+    print(f"Dropping {audit['drop'].sum()} of {len(audit)} rows flagged as "
+          f"outliers:\n{audit.groupby('reason')['drop'].agg(['size', 'sum'])}")
+    save_output(audit, audit_name)
+    return df.drop(audit.index[audit['drop']])
+
+
+# source name -> (function, sources it needs), read by add_metadata
+METADATA_SOURCES = {
+    'area': (prep_country_area, []),
+    'internet': (prep_internet_usage, []),
+    'gdp': (prep_gdp, []),
+    'pop': (prep_population, []),
+    'eu': (prep_eu_states, []),
+    'language': (prep_language, []),
+    'cepii_distance': (read_cepii_distance, []),
+    'maciej_distance': (read_maciej_distance, []),
+    'city_distance': (read_city_distance, []),
+    'geo': (prep_geo,
+            ['cepii_distance', 'maciej_distance', 'city_distance'])}
+
+
+def add_metadata(df, n_jobs=None):
     """So meta.
 
     Wrapper for many smaller functions that prep metadata to be merged on.
     Split into parts (1) where two columns are created separately for origin
     and destination and (2) where one new column is created from the
-    origin, destination pair
+    origin, destination pair. The sources are read concurrently, see
+    METADATA_SOURCES.
     """
     orig_cols = df.columns
+    meta = load_sources(METADATA_SOURCES, n_jobs)
     # (1) two new columns, separate for origin + destination
-    dict_of_dicts = {
-        'area': prep_country_area(),
-        'internet': prep_internet_usage(),
-        'gdp': prep_gdp(),
-        'pop': prep_population(),
-        'prop': ''}
-    for k, v in dict_of_dicts.items():
+    for k in ['area', 'internet', 'gdp', 'pop', 'prop']:
         for x in ['orig', 'dest']:
             if k == 'prop':
                 df[f'{k}_{x}'] = df[f'users_{x}'] / df[f'pop_{x}']
             else:
-                df[f'{k}_{x}'] = df[f'iso3_{x}'].map(v)
+                df[f'{k}_{x}'] = df[f'iso3_{x}'].map(meta[k])
     # (2) one new column, based on origin/destination pair
     # columns flagging EU, Schengen, EEA membership
-    eu = prep_eu_states()
+    eu = meta['eu']
     for col in eu.columns:
         iso3_codes = eu[eu[col] == 1].index.values
         df[col] = df.apply(
@@ -534,7 +597,7 @@ def add_metadata(df):
         'how': 'left', 'left_on': ['iso3_orig', 'iso3_dest'],
         'right_index': True
     }
-    df = df.merge(prep_geo(), **kwargs).merge(prep_language(), **kwargs)
+    df = df.merge(meta['geo'], **kwargs).merge(meta['language'], **kwargs)
     return df, list(set(df.columns) - set(orig_cols)) + \
         [f'{x}_{y}' for x in ['region', 'subregion', 'midregion']
          for y in ['orig', 'dest']]
@@ -569,30 +632,6 @@ def fill_missing_borders(df):
     return df.drop('neighbor', axis=1)
 
 
-def cyp_hack(df):
-    """Change subregion for Cyprus to Southern Europe."""
-    df.loc[df['iso3_orig'] == 'cyp', 'subregion_orig'] = 'Southern Europe'
-    df.loc[df['iso3_dest'] == 'cyp', 'subregion_dest'] = 'Southern Europe'
-    assert set(df['subregion_orig']) == set(
-        ['Southern Europe', 'Eastern Europe', 'Western Europe', 'Northern Europe'])
-    return df
-
-
-def fix_query_date(df, cutoff=np.timedelta64(10, 'D')):
-    """Adjust date of data collection for timeout errors."""
-    dates = sorted([np.datetime64(x) for x in df['query_date'].unique()])
-    combine_dates = {
-        str(dates[n + 1]): str(dates[n])
-        for n in range(0, len(dates) - 1) if dates[n+1] - dates[n] < cutoff}
-    df = df.replace(combine_dates)
-    # while we're here... let's add another column
-    new_dates = sorted([np.datetime64(x) for x in df['query_date'].unique()])
-    midpoint = np.datetime64(new_dates[round(len(new_dates) / 2)])
-    df['date_centered'] = df['query_date'].apply(
-        lambda x: (np.datetime64(x) - midpoint).astype(int))
-    return df.drop(['date_centered'], axis=1)
-
-
 def data_validation(
     df, id_cols=['country_orig', 'country_dest', 'query_date'],
     value_col='flow'
@@ -609,35 +648,40 @@ def data_validation(
     return df
 
 
-def main(date, update_chord_diagram):
-    df = read_data(date).pipe(reshape_long_wide).pipe(fix_iso3)
+def main(date, update_chord_diagram, db=False, dual_query=False,
+         bins_version=None):
+    # optionally write every output to the embedded database too
+    save = partial(save_output, db=db)
+    df = (read_data(date).pipe(reshape_long_wide, dual_query=dual_query)
+                         .pipe(fix_iso3))
     # see changes across data collection dates
-    df.pipe(get_pct_change).pipe(save_output, 'pct_change')
+    df.pipe(get_pct_change).pipe(save, 'pct_change')
 
     df, meta_cols = (df.pipe(merge_region_subregion).pipe(add_metadata))
-    df = (df.pipe(bin_continuous_vars, ['gdp'])
+    df = (df.pipe(bin_continuous_vars, ['gdp'], version=bins_version)
             .pipe(data_validation)
             .pipe(drop_bad_rows)
             .pipe(get_rank)
             .pipe(flag_reciprocals, False, True)
             .pipe(get_net_migration))
 
-    save_output(df, 'model_input')
+    save(df, 'model_input')
+    df.pipe(network_metrics).pipe(save, 'network_metrics')
     df.query('recip == 1').pipe(get_variation, meta_cols).pipe(
-        save_output, 'variance_recip_pairs')
+        save, 'variance_recip_pairs')
     df.drop('recip', axis=1).pipe(get_variation, meta_cols).pipe(
-        save_output, 'variance')
+        save, 'variance')
     if update_chord_diagram:
         for grp_var in ['bin_gdp', 'midregion', 'subregion']:
             (df.pipe(prep_chord_diagram, grp_var)
-               .pipe(save_output, f'chord_diagram_{grp_var}'))
+               .pipe(save, f'chord_diagram_{grp_var}'))
             (df.query('recip == 1')
                .pipe(prep_chord_diagram, grp_var)
-               .pipe(save_output, f'chord_diagram_{grp_var}_recip'))
+               .pipe(save, f'chord_diagram_{grp_var}_recip'))
             (df.query('eu_plus == 1')
                .pipe(cyp_hack)
                .pipe(prep_chord_diagram, grp_var)
-               .pipe(save_output, f'chord_diagram_{grp_var}_euplus'))
+               .pipe(save, f'chord_diagram_{grp_var}_euplus'))
 
 
 if __name__ == "__main__":
@@ -652,5 +696,17 @@ if __name__ == "__main__":
         help='whether to update input data for the chord diagram',
         action='store_true'
     )
+    parser.add_argument(
+        '-db', help='also write outputs to the embedded database',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-dual_query', help='add the r6_remote flow next to the r4 flow',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-bins_version', type=int,
+        help='bin with these saved breakpoints instead of updating them'
+    )
     args = parser.parse_args()
     main(**vars(args))
@@ -1,12 +1,13 @@
 import numpy as np
+import argparse
 import pandas as pd
-import xlsxwriter
-from os import pipe
+from etl.outliers import flag_outliers
 from utils.io import save_output
-from etl.prep_bilateral_flows import prep_eu_states
+from utils.misc import prep_eu_states
 from configurator import Config
 
 CONFIG = Config()
+GOERS_FILE = 'LinkedInRecruiterBaseratesSimple_withTime_2021 - 03 - 30.csv'
 
 
 def prep_total_users():
@@ -32,20 +33,24 @@ def fix_dups(df, id_cols=['query_date', 'country_dest'], value_col='goers'):
     return df.drop_duplicates(id_cols)
 
 
-def drop_bad_rows(df):
+def drop_bad_rows(df, audit_name='goers_outlier_audit'):
+    """Drop invalid rows and scrapes flagged by etl.outliers.
+
+    Flagged rows are saved to an audit table (audit_name) for review.
+    """
     # there are some -1 values, drop these
-    return df[(df['goers'] > 0) &
-        ~((
-            (df['query_date'] == '2020-10-08') &
-            (df['country_dest'] == 'Central African Republic')
-        ) | (df['country_dest'] == 'Cyprus UN Neutral Zone'))
-    ]
+    df = df[(df['goers'] > 0) &
+            (df['country_dest'] != 'Cyprus UN Neutral Zone')]
+    # one series per destination, so no origin profile to check
+    audit = flag_outliers(df, ['country_dest'], 'goers', queries=False)
+    save_output(audit, audit_name)
+    return df.drop(audit.index[audit['drop']])
 
 
-def prep_goers():
+def prep_goers(filename=GOERS_FILE):
     """Prep those who want to go ("potential immmigrants") to a country."""
     df = pd.read_csv(
-        f"{CONFIG['directories.data']['raw']}/LinkedInRecruiterBaseratesSimple_withTime_2021 - 03 - 30.csv"
+        f"{CONFIG['directories.data']['raw']}/{filename}"
     ).assign(query_date=lambda x: x['query_time'].str[:-9]).rename(
         columns={'query_country': 'country_dest', 'total': 'goers'})
     assert (df['query_info'] == 'r4').values.all()
@@ -94,11 +99,11 @@ def get_rank_over_time(df, value, metric_name):
         )
 
 
-def main():
-    goers_df = prep_goers()
+def main(db=False, goers_file=GOERS_FILE):
+    goers_df = prep_goers(goers_file)
     users_df = prep_total_users()
     df = merge_goers_total(goers_df, users_df)
-    save_output(df, 'goers')
+    save_output(df, 'goers', db=db)
     writer = pd.ExcelWriter(
         f"{CONFIG['directories.data']['processed']}/destination_ranks.xlsx",
         engine='xlsxwriter'
@@ -116,4 +121,14 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-db', help='also write goers to the embedded database',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-goers_file', default=GOERS_FILE,
+        help='baserates file in the raw data directory'
+    )
+    args = parser.parse_args()
+    main(**vars(args))
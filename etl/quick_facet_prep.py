@@ -1,5 +1,5 @@
 import pandas as pd
-from etl.prep_bilateral_flows import fix_query_date
+from utils.misc import fix_query_date
 
 df = pd.read_csv(
     "/Users/scharlottej13/Nextcloud/linkedin_recruiter/raw-data/recruiter_all_categories/2021-06-03_all_facets.csv"
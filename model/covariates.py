@@ -0,0 +1,47 @@
+"""Candidate covariates for the gravity model, grouped by theme."""
+import pandas as pd
+from configurator import Config
+
+
+class Covariates:
+    config = Config()
+    cov_list = list(pd.read_csv(
+        f"{config['directories.data']['processed']}/variance.csv"
+    ).columns)
+
+    def __init__(self):
+        self.number_of_covs = len(self.cov_list)
+        self.dep_var = 'flow_median'
+        self.distance_covs = [
+            'dist_pop_weighted',
+            'dist_unweighted',
+            'dist_biggest_cities']
+        self.geo_covs = ['contig', 'schengen', 'eurozone', 'eea', 'eu'] + \
+            [x for x in self.cov_list if 'area' in x  # area_orig, area_dest eg
+             or 'region' in x or 'country' in x]
+        self.colonizer_covs = ['col45', 'curcol', 'smctry', 'colony', 'comcol']
+        self.language_covs = ['cnl', 'csl', 'col', 'prox1', 'prox2', 'lp1',
+                              'lp2', 'comlang_ethno']
+        self.money_covs = ['gdp_dest', 'gdp_orig', 'internet_dest',
+                           'internet_orig']
+        self.people_covs = [
+            x for x in self.cov_list if 'users' in x
+            or 'pop' in x or 'prop' in x]
+        self.rank_covs = [x for x in self.cov_list if 'rank' in x]
+
+    def dependent_variables(self):
+        return [x for x in self.cov_list if 'flow' in x or 'rate' in x]
+
+    def numeric_covariates(self):
+        return \
+            self.rank_covs + self.people_covs + self.money_covs + \
+            self.distance_covs + ['area_orig', 'area_dest', 'cnl', 'csl',
+                                  'lp2', 'prox2']
+
+    def log_tformed_covariates(self):
+        return \
+            [x for x in self.numeric_covariates() if 'area' in x
+             or 'users' in x or 'pop' in x or 'gdp' in x] + self.distance_covs
+
+    def dummy_covariates(self):
+        return list(set(self.geo_covs) - set(self.numeric_covariates()))
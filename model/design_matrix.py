@@ -0,0 +1,237 @@
+"""Design matrix cache shared across model specifications.
+
+Every candidate column (raw, log and log10 versions of the numeric
+covariates, one indicator column per factor level) is computed once per
+version of the source csv and saved as a memory-mapped .npy with a json
+column index. A model specification is then just a column selection plus a
+row mask, and parallel workers that open the same file share it with zero
+copies.
+
+The cache is keyed on the source file's size and mtime, so rerunning the
+ETL gets a new matrix even on the same day. The json also keeps the
+data_version label and the key columns of each row, and rows are matched
+back to the source csv on those keys rather than by position.
+"""
+import hashlib
+import json
+import os
+import re
+from datetime import datetime
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from model.covariates import Covariates
+
+CONFIG = Config()
+
+LOG_FUNCS = {'log10': np.log10, 'log': np.log}
+KEY_COLUMNS = ['iso3_orig', 'iso3_dest', 'query_date']
+
+
+def get_data_version():
+    """Date that model_input.csv was created."""
+    return datetime.fromtimestamp(os.path.getctime(
+        f"{CONFIG['directories.data']['processed']}/model_input.csv"
+    )).date()
+
+
+def parse_formula(formula):
+    """Split an R style formula into (func, variable) terms.
+
+    e.g. 'log10(flow_median)~log10(area_dest)+factor(eu)+csl' returns
+    ('log10', 'flow_median'), [('log10', 'area_dest'), ('factor', 'eu'),
+    (None, 'csl')]
+    """
+    def _term(x):
+        match = re.fullmatch(r'(\w+)\((\w+)\)', x.strip())
+        if match:
+            return match.group(1), match.group(2)
+        return None, x.strip()
+    lhs, rhs = formula.split('~')
+    return _term(lhs), [_term(x) for x in rhs.split('+')]
+
+
+def source_file(recip_only):
+    suffix = '_recip_pairs' if recip_only else ''
+    return f"{CONFIG['directories.data']['processed']}/variance{suffix}.csv"
+
+
+def _fingerprint(filename):
+    stat = os.stat(filename)
+    return hashlib.sha1(
+        f"{filename}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()[:12]
+
+
+def _cache_prefix(recip_only):
+    cache_dir = f"{CONFIG['directories.data']['model']}/_cache"
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    recip_str = '_recip_pairs' * bool(recip_only)
+    return f"{cache_dir}/design_matrix{recip_str}"
+
+
+def candidate_columns(df, covs=None):
+    """Return {column name: values} for every transformed candidate column.
+
+    Names follow ModelOptions.get_tform_func so a formula term maps directly
+    to a column, and a {factor variable: [level columns]} dictionary.
+    """
+    covs = Covariates() if covs is None else covs
+    log_vars = set(covs.log_tformed_covariates() + [covs.dep_var])
+    factor_vars = set(covs.dummy_covariates())
+    columns, factors = {}, {}
+    for var in df.columns:
+        if var in factor_vars:
+            levels = pd.get_dummies(df[var].astype('category'))
+            # keep missing values missing, so those rows get dropped
+            levels = levels.astype(float).where(df[var].notnull())
+            names = [f'factor({var}){x}' for x in levels.columns]
+            columns.update(zip(names, levels.values.T))
+            factors[var] = names
+        elif pd.api.types.is_numeric_dtype(df[var]):
+            values = df[var].values.astype(float)
+            columns[var] = values
+            if var in log_vars:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    for func, tform in LOG_FUNCS.items():
+                        logged = tform(values)
+                        logged[~np.isfinite(logged)] = np.nan
+                        columns[f'{func}({var})'] = logged
+    return columns, factors
+
+
+class DesignMatrix:
+    """Memory-mapped matrix of candidate columns for one source file."""
+
+    def __init__(self, stem):
+        self.stem = stem
+        with open(f'{stem}.json') as f:
+            index = json.load(f)
+        self.columns = index['columns']
+        self.factors = index['factors']
+        self.data_version = index['data_version']
+        self.source = index['source']
+        self.key_values = pd.DataFrame(index['keys'])
+        self.col_idx = {x: i for i, x in enumerate(self.columns)}
+        self.matrix = np.load(f'{stem}.npy', mmap_mode='r')
+
+    @classmethod
+    def build(cls, df, stem, data_version, source, covs=None):
+        """Write the matrix under a temporary name and rename it into
+        place, json last, so a concurrent build never leaves a valid
+        looking json next to half an .npy."""
+        columns, factors = candidate_columns(df, covs)
+        tmp = f'{stem}-tmp{os.getpid()}'
+        matrix = np.lib.format.open_memmap(
+            f'{tmp}.npy', mode='w+', dtype=np.float64,
+            shape=(len(df), len(columns)))
+        for i, values in enumerate(columns.values()):
+            matrix[:, i] = values
+        matrix.flush()
+        del matrix
+        keys = [x for x in KEY_COLUMNS if x in df.columns]
+        with open(f'{tmp}.json', 'w') as f:
+            json.dump({
+                'columns': list(columns), 'factors': factors,
+                'data_version': str(data_version), 'source': source,
+                'keys': df[keys].astype(str).to_dict('list')}, f)
+        os.replace(f'{tmp}.npy', f'{stem}.npy')
+        os.replace(f'{tmp}.json', f'{stem}.json')
+        return cls(stem)
+
+    @classmethod
+    def cached(cls, data_version=None, recip_only=0):
+        """Open the cache of the current source file, building it if it's
+        missing. An older data_version has to be in the cache already,
+        its source csv has been overwritten since."""
+        source = source_file(recip_only)
+        current = str(get_data_version())
+        prefix = _cache_prefix(recip_only)
+        if data_version is None or str(data_version) == current:
+            stem = f"{prefix}_{current}_{_fingerprint(source)}"
+            if os.path.exists(f'{stem}.json'):
+                return cls(stem)
+            return cls.build(pd.read_csv(source), stem, current, source)
+        saved = sorted(glob(f"{prefix}_{data_version}_*.json"),
+                       key=os.path.getmtime)
+        if not saved:
+            raise ValueError(
+                f"No cached design matrix for data version {data_version}, "
+                f"{source} is now version {current}")
+        return cls(saved[-1][:-len('.json')])
+
+    def keys(self, rows):
+        """Key columns (iso3_orig, iso3_dest, ...) of rows."""
+        return self.key_values.iloc[rows].reset_index(drop=True)
+
+    def data(self, rows, usecols=None):
+        """Rows of the source csv, matched on the key columns."""
+        keys = self.keys(rows)
+        df = pd.read_csv(self.source, usecols=usecols and list(
+            dict.fromkeys(list(keys.columns) + list(usecols))))
+        df = keys.merge(df.astype({x: str for x in keys.columns}),
+                        how='left', on=list(keys.columns), indicator=True,
+                        validate='one_to_one')
+        missing = df['_merge'] != 'both'
+        assert not missing.any(), \
+            f"{missing.sum()} rows of the design matrix aren't in " \
+            f"{self.source} anymore, rerun with the current data version"
+        return df.drop('_merge', axis=1)
+
+    def column(self, name):
+        return self.matrix[:, self.col_idx[name]]
+
+    def row_mask(self, location, min_n=1, min_prop=0,
+                 dep_var='flow_median'):
+        """Subsetting rules of prep_data in model/gravity_model.R: any
+        location but global is eu_plus, global keeps users_orig_median >
+        min_prop. The one difference is min_n: R compares the name of the
+        dependent variable with it, which keeps every row, here the
+        dependent variable itself has to be at least min_n."""
+        mask = self.column(dep_var) >= min_n
+        if location != 'global':
+            mask &= self.column('eu_plus') == 1
+        else:
+            mask &= self.column('users_orig_median') > min_prop
+        return mask
+
+    def select(self, terms, rows):
+        """Column names for formula terms, given the rows in the model.
+
+        Like R's treatment contrasts the first level that is present in
+        the rows is the reference, levels absent from the rows are dropped.
+        """
+        names = []
+        for func, var in terms:
+            if func == 'factor':
+                present = [
+                    x for x in self.factors[var]
+                    if np.nansum(self.matrix[rows, self.col_idx[x]]) > 0]
+                names.extend(present[1:])
+            else:
+                names.append(f'{func}({var})' if func else var)
+        return names
+
+    def design(self, formula, location, min_n=1, min_prop=0):
+        """Return (y, X, column names, row indices) for a specification."""
+        (dep_func, dep_var), terms = parse_formula(formula)
+        dep_name = f'{dep_func}({dep_var})' if dep_func else dep_var
+        mask = self.row_mask(location, min_n, min_prop, dep_var)
+        term_cols = [self.col_idx[x] for x in self.select(terms, mask)]
+        factor_cols = [
+            self.col_idx[x] for f, v in terms if f == 'factor'
+            for x in self.factors[v]]
+        used = [self.col_idx[dep_name]] + term_cols + factor_cols
+        mask &= ~np.isnan(self.matrix[:, used]).any(axis=1)
+        rows = np.flatnonzero(mask)
+        # re-select in case the reference level changed after dropping NaNs
+        names = self.select(terms, rows)
+        X = np.column_stack([
+            np.ones(len(rows)),
+            self.matrix[np.ix_(rows, [self.col_idx[x] for x in names])]])
+        y = np.asarray(self.matrix[rows, self.col_idx[dep_name]])
+        return y, X, ['(Intercept)'] + names, rows
@@ -0,0 +1,285 @@
+"""Short horizon forecasts of every flow and goers series.
+
+Series are laid out as a (series x dates) array of log(1 + value) (see
+model.trends.to_cube) and two simple models are run over all of them at
+once, one date at a time:
+
+ets: damped trend exponential smoothing. alpha, beta and phi are picked per
+    series from a small grid by one step ahead squared error, all grid
+    points scored together (beta = 0 is simple exponential smoothing).
+ar: AR(1) with a mean, fit from running sums over consecutive dates.
+best: whichever of the two has the lower one step error for the series.
+
+Everything needed to forecast is kept in a state table, one row per series
+(smoothing parameters, level and trend, the AR sums), so when a new scrape
+comes in update() only runs the new dates through it instead of refitting.
+backtest() refits at past rounds and scores the forecasts of the following
+rounds, against a naive last-value forecast.
+
+    python model/forecast.py              # fit, forecast HORIZON rounds
+    python model/forecast.py --update     # add new dates to the saved state
+    python model/forecast.py --backtest 6
+"""
+import argparse
+from itertools import product
+from os import path
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from utils.lazy import lazy_import
+from model.trends import to_cube
+
+CONFIG = Config()
+stats = lazy_import('scipy.stats')
+
+HORIZON = 3
+# coverage of the forecast intervals
+INTERVAL = 0.8
+METHODS = ['ets', 'ar', 'best']
+# alpha, beta (as a fraction of alpha) and phi tried for every series
+GRID = np.array(list(product(
+    [0.1, 0.3, 0.5, 0.7, 0.9, 1.0], [0, 0.05, 0.1, 0.2], [0.8, 0.9, 0.98])))
+# parameters for series that first show up in update()
+DEFAULT_PARAMS = {'alpha': 0.5, 'beta': 0.1, 'phi': 0.9}
+AR_SUMS = ['ar_n', 'ar_x', 'ar_y', 'ar_xx', 'ar_xy', 'ar_yy']
+SERIES = {
+    'flow': ('model_input', ['iso3_orig', 'iso3_dest']),
+    'goers': ('goers', ['country_dest'])}
+
+
+def _ets(x, alpha, beta, phi, level, trend, sse, n):
+    """Run the columns of x through damped trend smoothing.
+
+    Parameters and state broadcast against a column of x, so a grid of
+    parameters (grid x 1) gives (grid x series) results. Missing dates
+    carry the forecast forward.
+    """
+    for col in x.T:
+        fcast = level + phi * trend
+        err = col - fcast
+        seen = np.isfinite(err)
+        first = np.isnan(level) & np.isfinite(col)
+        sse = sse + np.where(seen, err ** 2, 0)
+        n = n + seen
+        level = np.where(seen, fcast + alpha * err,
+                         np.where(first, col, fcast))
+        trend = np.where(seen, phi * trend + alpha * beta * err, phi * trend)
+    return level, trend, sse, n
+
+
+def _grid_search(x):
+    """alpha, beta and phi with the smallest one step error per series."""
+    alpha, beta, phi = (GRID[:, [i]] for i in range(3))
+    shape = (len(GRID), len(x))
+    _, _, sse, n = _ets(x, alpha, beta, phi, np.full(shape, np.nan),
+                        np.zeros(shape), np.zeros(shape), np.zeros(shape))
+    best = np.argmin(np.where(n > 0, sse, np.inf), axis=0)
+    return pd.DataFrame(GRID[best], columns=['alpha', 'beta', 'phi'])
+
+
+def _advance(state, x, dates):
+    """State after running the new dates (columns of x) through it."""
+    state = state.copy()
+    state['level'], state['trend'], state['ets_sse'], state['ets_n'] = _ets(
+        x, *(state[col].values for col in
+             ['alpha', 'beta', 'phi', 'level', 'trend', 'ets_sse', 'ets_n']))
+    # AR pairs are consecutive dates, including last scrape -> first new one
+    prev = np.where(state['age'] == 0, state['last'], np.nan)
+    lagged = np.column_stack([prev, x])
+    lag, lead = lagged[:, :-1], lagged[:, 1:]
+    ok = np.isfinite(lag) & np.isfinite(lead)
+    lag, lead = np.where(ok, lag, 0), np.where(ok, lead, 0)
+    for col, value in zip(AR_SUMS,
+                          [ok, lag, lead, lag ** 2, lag * lead, lead ** 2]):
+        state[col] += value.sum(axis=1)
+    seen = np.isfinite(x)
+    last_pos = np.where(seen, np.arange(x.shape[1]), -1).max(axis=1)
+    has_new = last_pos >= 0
+    state['last'] = np.where(
+        has_new, x[np.arange(len(x)), last_pos], state['last'])
+    state['age'] = np.where(
+        has_new, x.shape[1] - 1 - last_pos, state['age'] + x.shape[1])
+    state['last_date'] = dates[-1]
+    return state
+
+
+def _init_state(ids, params, round_days):
+    return pd.concat([ids, params], axis=1).assign(
+        level=np.nan, trend=0., ets_sse=0., ets_n=0.,
+        **{col: 0. for col in AR_SUMS}, last=np.nan, age=0,
+        round_days=round_days)
+
+
+def _fit_cube(ids, dates, x):
+    days = np.diff(pd.to_datetime(dates)).astype('timedelta64[D]')
+    round_days = np.median(days.astype(int)) if len(days) else 14
+    return _advance(_init_state(ids, _grid_search(x), round_days), x, dates)
+
+
+def fit(df, id_cols, value_col, date_col='query_date'):
+    """State table for every series of df: smoothing parameters from the
+    grid search, and level, trend and AR sums after the last date."""
+    return _fit_cube(*to_cube(df, id_cols, value_col, date_col))
+
+
+def update(state, df, id_cols, value_col, date_col='query_date'):
+    """Add the dates of df after the state's last date, keeping the fitted
+    parameters. Series not in the state start with DEFAULT_PARAMS."""
+    new = df[df[date_col] > state['last_date'].iloc[0]]
+    if new.empty:
+        return state
+    ids, dates, x = to_cube(new, id_cols, value_col, date_col)
+    index = pd.MultiIndex.from_frame(state[id_cols])
+    new_ids = pd.MultiIndex.from_frame(ids)
+    added = new_ids.difference(index)
+    if len(added):
+        state = pd.concat([state, _init_state(
+            added.to_frame(index=False),
+            pd.DataFrame(DEFAULT_PARAMS, index=range(len(added))),
+            state['round_days'].iloc[0])], ignore_index=True)
+        index = pd.MultiIndex.from_frame(state[id_cols])
+    aligned = np.full((len(state), x.shape[1]), np.nan)
+    aligned[index.get_indexer(new_ids)] = x
+    return _advance(state, aligned, dates)
+
+
+def _ar(state):
+    """AR(1) intercept, slope and residual variance from the running sums."""
+    n, sx, sy, sxx, sxy, syy = (state[col].values for col in AR_SUMS)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cxx = sxx - sx ** 2 / n
+        cxy = sxy - sx * sy / n
+        rho = np.clip(np.where(cxx > 0, cxy / cxx, 0), -0.99, 1)
+        const = (sy - rho * sx) / n
+        var = (syy - sy ** 2 / n - rho * cxy) / (n - 2)
+    return const, rho, np.where(n > 2, np.maximum(var, 0), np.nan)
+
+
+def _geometric(r, k):
+    """1 + r + ... + r^(k - 1), elementwise."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(np.isclose(r, 1), k, (1 - r ** k) / (1 - r))
+
+
+def forecast_arrays(state, horizon=HORIZON, method='best'):
+    """(mean, sd, method) of log(1 + value), (series x horizon) arrays."""
+    h = np.arange(1, horizon + 1)
+    alpha, beta, phi = (state[col].values[:, None]
+                        for col in ['alpha', 'beta', 'phi'])
+    # damped trend: phi + ... + phi^h multiplies the trend
+    phi_h = phi * _geometric(phi, h)
+    ets_mean = state['level'].values[:, None] + \
+        phi_h * state['trend'].values[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ets_var = (state['ets_sse'] / state['ets_n']).values
+    steps = (alpha * (1 + beta * phi_h[:, :-1])) ** 2
+    ets_sd = np.sqrt(ets_var[:, None] * np.column_stack(
+        [np.ones(len(state)), 1 + np.cumsum(steps, axis=1)])[:, :horizon])
+    const, rho, ar_var = _ar(state)
+    # steps ahead of the last observation, not of the last scrape
+    k = state['age'].values[:, None] + h
+    rho = rho[:, None]
+    ar_mean = const[:, None] * _geometric(rho, k) + \
+        rho ** k * state['last'].values[:, None]
+    ar_sd = np.sqrt(ar_var[:, None] * _geometric(rho ** 2, k))
+    if method == 'ets':
+        use_ar = np.zeros(len(state), dtype=bool)
+    elif method == 'ar':
+        use_ar = np.ones(len(state), dtype=bool)
+    else:
+        use_ar = np.nan_to_num(ar_var, nan=np.inf) < ets_var
+    return (np.where(use_ar[:, None], ar_mean, ets_mean),
+            np.where(use_ar[:, None], ar_sd, ets_sd),
+            np.where(use_ar, 'ar', 'ets'))
+
+
+def forecast(state, id_cols, horizon=HORIZON, method='best',
+             interval=INTERVAL):
+    """Forecasts of the next horizon rounds, one row per series and round,
+    back in the original units."""
+    mean, sd, used = forecast_arrays(state, horizon, method)
+    z = stats.norm.ppf(0.5 + interval / 2)
+    last_date = pd.to_datetime(state['last_date'].iloc[0])
+    dates = [last_date + pd.Timedelta(days=state['round_days'].iloc[0] * h)
+             for h in range(1, horizon + 1)]
+    ids = state[id_cols].loc[state.index.repeat(horizon)].reset_index(
+        drop=True)
+    return ids.assign(
+        step=np.tile(np.arange(1, horizon + 1), len(state)),
+        query_date=np.tile([x.strftime('%Y-%m-%d') for x in dates],
+                           len(state)),
+        method=np.repeat(used, horizon),
+        forecast=np.expm1(mean).ravel(),
+        lower=np.expm1(mean - z * sd).clip(0).ravel(),
+        upper=np.expm1(mean + z * sd).ravel()
+    ).dropna(subset=['forecast'])
+
+
+def backtest(df, id_cols, value_col, n_origins=4, horizon=HORIZON,
+             date_col='query_date', interval=INTERVAL):
+    """Refit at each of the last n_origins rounds and score forecasts of the
+    following rounds. Errors are in log(1 + value); coverage is the share
+    of actual values inside the forecast interval."""
+    ids, dates, x = to_cube(df, id_cols, value_col, date_col)
+    z = stats.norm.ppf(0.5 + interval / 2)
+    scores = []
+    for origin in range(len(dates) - n_origins, len(dates)):
+        state = _fit_cube(ids, dates[:origin], x[:, :origin])
+        actual = x[:, origin:origin + horizon]
+        steps = actual.shape[1]
+        naive = np.repeat(state['last'].values[:, None], steps, axis=1)
+        results = {'naive': (naive, np.full(naive.shape, np.nan))}
+        for method in METHODS:
+            mean, sd, _ = forecast_arrays(state, steps, method)
+            results[method] = (mean, sd)
+        for method, (mean, sd) in results.items():
+            err = actual - mean
+            ok = np.isfinite(err)
+            with np.errstate(invalid='ignore'):
+                covered = np.abs(err) <= z * sd
+            scores.append(pd.DataFrame({
+                'origin': dates[origin - 1], 'step': np.arange(1, steps + 1),
+                'method': method, 'n': ok.sum(axis=0),
+                'mae': np.nanmean(np.where(ok, np.abs(err), np.nan), axis=0),
+                'rmse': np.sqrt(
+                    np.nanmean(np.where(ok, err ** 2, np.nan), axis=0)),
+                'coverage': (ok & covered).sum(axis=0) / ok.sum(axis=0)}))
+    return pd.concat(scores, ignore_index=True)
+
+
+def main(horizon, method, update_state, n_backtest):
+    processed = CONFIG['directories.data']['processed']
+    model_dir = CONFIG['directories.data']['model']
+    for value_col, (source, id_cols) in SERIES.items():
+        df = pd.read_csv(f"{processed}/{source}.csv",
+                         usecols=id_cols + ['query_date', value_col])
+        out = f"{model_dir}/{value_col}_forecast"
+        if n_backtest:
+            scores = backtest(df, id_cols, value_col, n_backtest, horizon)
+            scores.to_csv(f"{out}_backtest.csv", index=False)
+            print(scores.groupby(['method', 'step'])[
+                ['mae', 'rmse', 'coverage']].mean())
+            continue
+        if update_state and path.exists(f"{out}_state.csv"):
+            state = update(pd.read_csv(f"{out}_state.csv"), df, id_cols,
+                           value_col)
+        else:
+            state = fit(df, id_cols, value_col)
+        state.to_csv(f"{out}_state.csv", index=False)
+        forecast(state, id_cols, horizon, method).to_csv(
+            f"{out}.csv", index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--horizon', type=int, default=HORIZON,
+                        help='number of collection rounds to forecast')
+    parser.add_argument('--method', choices=METHODS, default='best')
+    parser.add_argument('--update', dest='update_state', action='store_true',
+                        help='add new dates to the saved state, no refit')
+    parser.add_argument('--backtest', dest='n_backtest', type=int, default=0,
+                        help='score forecasts from this many past rounds')
+    args = parser.parse_args()
+    main(**vars(args))
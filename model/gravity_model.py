@@ -0,0 +1,270 @@
+"""Fit gravity models in-process instead of shelling out to R.
+
+Drop-in for model/gravity_model.R: takes a model version id, looks up the
+formula and subsetting options written by launch_model.ModelOptions, and
+writes the same files, {description}-{version_id}.csv (the model data with
+broom::augment columns .fitted, .resid, ...), _betas.csv (broom::tidy plus
+confint) and _summary.csv (broom::glance plus rmse), with dated copies in
+_archive. Confidence intervals of the GLMs are Wald intervals, R's confint
+profiles the likelihood, and min_n filters on the dependent variable (R's
+filter on it never drops a row), see DesignMatrix.row_mask.
+
+cohen: OLS on log10 flow
+poisson: Poisson GLM with log link, fit by IRLS
+nb: negative binomial (NB2) GLM with log link, IRLS + ML estimate of theta
+"""
+import argparse
+import os
+import shutil
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from utils.lazy import lazy_import
+from model.design_matrix import DesignMatrix
+from model.registry import ModelRegistry
+
+CONFIG = Config()
+stats = lazy_import('scipy.stats')
+special = lazy_import('scipy.special')
+
+TFORMS = {'log10': np.log10, 'log': np.log, None: lambda x: x}
+
+Fit = namedtuple('Fit', [
+    'coef', 'std_err', 'fitted', 'resid', 'hat', 'dispersion',
+    'loglik', 'df_resid', 'theta'])
+
+# design matrix opened once per worker process by fit_many
+_WORKER = {}
+
+
+def _hat_values(X, w=None):
+    """Diagonal of the (weighted) hat matrix via a thin QR."""
+    if w is not None:
+        X = X * np.sqrt(w)[:, None]
+    q, _ = np.linalg.qr(X)
+    return np.einsum('ij,ij->i', q, q)
+
+
+def _wls(X, z, w):
+    sw = np.sqrt(w)
+    coef, *_ = np.linalg.lstsq(X * sw[:, None], z * sw, rcond=None)
+    return coef
+
+
+def fit_ols(X, y):
+    coef, *_ = np.linalg.lstsq(X, y, rcond=None)
+    fitted = X @ coef
+    resid = y - fitted
+    n, p = X.shape
+    sigma2 = resid @ resid / (n - p)
+    cov = sigma2 * np.linalg.pinv(X.T @ X)
+    loglik = -n / 2 * (np.log(2 * np.pi * resid @ resid / n) + 1)
+    return Fit(coef, np.sqrt(np.diag(cov)), fitted, resid, _hat_values(X),
+               sigma2, loglik, n - p, None)
+
+
+def _poisson_deviance(y, mu, theta=None):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ylogy = np.where(y > 0, y * np.log(y / mu), 0)
+    if theta is None:
+        return 2 * (ylogy - (y - mu))
+    return 2 * (ylogy - (y + theta) * np.log((y + theta) / (mu + theta)))
+
+
+def _loglik(y, mu, theta=None):
+    if theta is None:
+        return np.sum(y * np.log(mu) - mu - special.gammaln(y + 1))
+    gammaln = special.gammaln
+    return np.sum(
+        gammaln(theta + y) - gammaln(theta) - gammaln(y + 1) +
+        theta * np.log(theta / (theta + mu)) + y * np.log(mu / (theta + mu)))
+
+
+def theta_ml(y, mu, theta=None, max_iter=25, tol=1e-8, limit=1e8):
+    """Newton-Raphson ML estimate of NB theta, like MASS::theta.ml.
+
+    Without overdispersion theta runs off to infinity, so it's capped at
+    limit (i.e. the model collapses to Poisson).
+    """
+    n = len(y)
+    if theta is None:
+        theta = n / np.sum((y / mu - 1) ** 2)
+    digamma, polygamma = special.digamma, special.polygamma
+    for _ in range(max_iter):
+        theta = min(abs(theta), limit)
+        score = np.sum(
+            digamma(theta + y) - digamma(theta) + np.log(theta) + 1 -
+            np.log(theta + mu) - (y + theta) / (mu + theta))
+        info = np.sum(
+            -polygamma(1, theta + y) + polygamma(1, theta) - 1 / theta +
+            2 / (mu + theta) - (y + theta) / (mu + theta) ** 2)
+        delta = score / info
+        if not np.isfinite(delta):
+            break
+        theta += delta
+        if abs(delta) < tol:
+            break
+    return min(abs(theta), limit)
+
+
+def fit_glm(X, y, theta=None, estimate_theta=False, max_iter=50, tol=1e-8):
+    """Poisson (theta is None) or NB2 GLM with log link by IRLS."""
+    mu = y + 0.1
+    eta = np.log(mu)
+    dev_old = np.inf
+    for _ in range(max_iter):
+        # var(mu) = mu + mu^2 / theta, so working weights are mu / (1+mu/th)
+        w = mu if theta is None else mu / (1 + mu / theta)
+        z = eta + (y - mu) / mu
+        coef = _wls(X, z, w)
+        eta = X @ coef
+        mu = np.exp(eta)
+        if estimate_theta:
+            theta = theta_ml(y, mu, theta)
+        dev = _poisson_deviance(y, mu, theta).sum()
+        if abs(dev - dev_old) / (abs(dev) + 0.1) < tol:
+            break
+        dev_old = dev
+    w = mu if theta is None else mu / (1 + mu / theta)
+    n, p = X.shape
+    cov = np.linalg.pinv((X * w[:, None]).T @ X)
+    unit_dev = _poisson_deviance(y, mu, theta)
+    resid = np.sign(y - mu) * np.sqrt(np.maximum(unit_dev, 0))
+    return Fit(coef, np.sqrt(np.diag(cov)), eta, resid, _hat_values(X, w),
+               1.0, _loglik(y, mu, theta), n - p, theta)
+
+
+def fit_specification(X, y, model_type):
+    """Fit one specification, y is already transformed per the formula."""
+    if model_type == 'cohen':
+        return fit_ols(X, y)
+    elif model_type == 'poisson':
+        return fit_glm(X, y)
+    elif model_type == 'nb':
+        return fit_glm(X, y, theta=1.0, estimate_theta=True)
+    raise ValueError(f"Unknown model type: {model_type}")
+
+
+def information_criteria(fit, n_obs, model_type):
+    """Return (AIC, BIC) as R would, counting sigma / theta as a parameter."""
+    k = len(fit.coef) + (model_type != 'poisson')
+    return (-2 * fit.loglik + 2 * k, -2 * fit.loglik + np.log(n_obs) * k)
+
+
+def tidy(fit, names, model_type, level=0.95):
+    """Coefficient table like broom::tidy with confint added after the
+    estimate, as gravity_model.R writes it."""
+    statistic = fit.coef / fit.std_err
+    dist = stats.t(fit.df_resid) if model_type == 'cohen' else stats.norm
+    p_value = 2 * dist.sf(np.abs(statistic))
+    half = dist.ppf(0.5 + level / 2) * fit.std_err
+    lo, hi = [f'{100 * x:g} %' for x in [(1 - level) / 2, (1 + level) / 2]]
+    return pd.DataFrame({
+        'term': names, 'estimate': fit.coef, lo: fit.coef - half,
+        hi: fit.coef + half, 'std.error': fit.std_err,
+        'statistic': statistic, 'p.value': p_value})
+
+
+def glance(fit, y, model_type):
+    """One row model summary like broom::glance, plus rmse."""
+    n, p = len(y), len(fit.coef)
+    aic, bic = information_criteria(fit, n, model_type)
+    deviance = np.sum(fit.resid ** 2)
+    if model_type == 'cohen':
+        r2 = 1 - deviance / np.sum((y - y.mean()) ** 2)
+        f_stat = (r2 / (p - 1)) / ((1 - r2) / fit.df_resid)
+        out = {'r.squared': r2,
+               'adj.r.squared': 1 - (1 - r2) * (n - 1) / fit.df_resid,
+               'sigma': np.sqrt(fit.dispersion), 'statistic': f_stat,
+               'p.value': stats.f.sf(f_stat, p - 1, fit.df_resid),
+               'df': p - 1}
+    else:
+        out = {'null.deviance': _poisson_deviance(
+                   y, np.full(n, y.mean()), fit.theta).sum(),
+               'df.null': n - 1}
+    out.update({'logLik': fit.loglik, 'AIC': aic, 'BIC': bic,
+                'deviance': deviance, 'df.residual': fit.df_resid,
+                'nobs': n, 'rmse': np.sqrt(np.mean(fit.resid ** 2))})
+    return pd.DataFrame([out])
+
+
+def augment(df, fit):
+    """Add broom::augment style columns to the model data."""
+    std_resid = fit.resid / np.sqrt(fit.dispersion * (1 - fit.hat))
+    return df.assign(**{
+        '.fitted': fit.fitted, '.resid': fit.resid, '.hat': fit.hat,
+        '.std.resid': std_resid,
+        '.cooksd': std_resid ** 2 * fit.hat / (len(fit.coef) * (1 - fit.hat))
+    })
+
+
+def _init_worker(stem):
+    _WORKER['design'] = DesignMatrix(stem)
+
+
+def _fit_one(spec):
+    y, X, names, _ = _WORKER['design'].design(
+        spec['formula'], spec['location'], spec.get('min_n', 1),
+        spec.get('min_prop', 0))
+    fit = fit_specification(X, y, spec['type'])
+    aic, bic = information_criteria(fit, len(y), spec['type'])
+    return {**spec, 'n_obs': len(y), 'aic': aic, 'bic': bic,
+            'coefs': dict(zip(names, fit.coef))}
+
+
+def fit_many(specs, data_version=None, recip_only=0, n_jobs=None):
+    """Fit a list of specifications in parallel over one shared matrix.
+
+    specs: list of dicts with keys formula, type, location and optionally
+    min_n, min_prop. Returns a dataframe with one row per specification.
+    """
+    design = DesignMatrix.cached(data_version, recip_only)
+    with ProcessPoolExecutor(
+        n_jobs, initializer=_init_worker, initargs=(design.stem,)
+    ) as pool:
+        return pd.DataFrame(pool.map(
+            _fit_one, specs, chunksize=max(1, len(specs) // 100)))
+
+
+def save_results(df, betas, summary, description, version_id):
+    """Same files as save_model in gravity_model.R, archived the same way."""
+    model_dir = CONFIG['directories.data']['model']
+    archive_dir = f"{model_dir}/_archive"
+    if not os.path.exists(archive_dir):
+        os.mkdir(archive_dir)
+    name = f"{description}-{version_id}"
+    for suffix, out in [('', df), ('_betas', betas), ('_summary', summary)]:
+        out.to_csv(f"{model_dir}/{name}{suffix}.csv", index=False)
+        shutil.copy(f"{model_dir}/{name}{suffix}.csv",
+                    f"{archive_dir}/{name}{suffix}_{date.today()}.csv")
+
+
+def main(version_id):
+    version = ModelRegistry().get(version_id)
+    design = DesignMatrix.cached(
+        version['data_version'], version['recip_only'])
+    y, X, names, rows = design.design(
+        version['formula'], version['location'], version['min_n'],
+        version['min_prop'])
+    df = design.data(rows)
+    fit = fit_specification(X, y, version['type'])
+    betas = tidy(fit, names, version['type'])
+    summary = glance(fit, y, version['type'])
+    save_results(augment(df, fit), betas, summary,
+                 version['description'], version_id)
+    theta_str = f"theta: {fit.theta:.4f}\n" if fit.theta else ""
+    print(f"{version['formula']}\nmodel type: {version['type']}\n"
+          f"{theta_str}{summary.T.to_string(header=False)}\n\n"
+          f"{betas.to_string(index=False)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('version_id', type=int)
+    args = parser.parse_args()
+    main(args.version_id)
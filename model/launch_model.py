@@ -1,59 +1,16 @@
-import pandas as pd
-import os
 from datetime import datetime
 import argparse
 from configurator import Config
-import csv
 import subprocess
-
-
-class Covariates:
-    config = Config()
-    cov_list = list(pd.read_csv(
-        f"{config['directories.data']['processed']}/variance.csv"
-    ).columns)
-
-    def __init__(self):
-        self.number_of_covs = len(self.cov_list)
-        self.dep_var = 'flow_median'
-        self.distance_covs = [
-            'dist_pop_weighted',
-            'dist_unweighted',
-            'dist_biggest_cities']
-        self.geo_covs = ['contig', 'schengen', 'eurozone', 'eea', 'eu'] + \
-            [x for x in self.cov_list if 'area' in x  # area_orig, area_dest eg
-             or 'region' in x or 'country' in x]
-        self.colonizer_covs = ['col45', 'curcol', 'smctry', 'colony', 'comcol']
-        self.language_covs = ['cnl', 'csl', 'col', 'prox1', 'prox2', 'lp1',
-                              'lp2', 'comlang_ethno']
-        self.money_covs = ['gdp_dest', 'gdp_orig', 'internet_dest',
-                           'internet_orig']
-        self.people_covs = [
-            x for x in self.cov_list if 'users' in x
-            or 'pop' in x or 'prop' in x]
-        self.rank_covs = [x for x in self.cov_list if 'rank' in x]
-
-    def dependent_variables(self):
-        return [x for x in self.cov_list if 'flow' in x or 'rate' in x]
-
-    def numeric_covariates(self):
-        return \
-            self.rank_covs + self.people_covs + self.money_covs + \
-            self.distance_covs + ['area_orig', 'area_dest', 'cnl', 'csl',
-                                  'lp2', 'prox2']
-
-    def log_tformed_covariates(self):
-        return \
-            [x for x in self.numeric_covariates() if 'area' in x
-             or 'users' in x or 'pop' in x or 'gdp' in x] + self.distance_covs
-
-    def dummy_covariates(self):
-        return list(set(self.geo_covs) - set(self.numeric_covariates()))
+from model import gravity_model
+from model.covariates import Covariates
+from model.design_matrix import get_data_version
+from model.registry import ModelRegistry
+from model.select_covariates import search_covariates
 
 
 class ModelOptions(Covariates):
     config = Config()
-    model_versions = f"{config['directories.data']['model']}/model_versions.csv"
     r_script = f"{config['directories']['code']}/model/gravity_model.R"
 
     def __init__(self, model_type, location, description,
@@ -66,25 +23,14 @@ class ModelOptions(Covariates):
         self.min_n = min_n
         self.min_prop = min_prop
         self.recip_only = recip_only * 1
-        self.model_version_id = \
-            pd.read_csv(self.model_versions).sort_values(
-                by='version_id')['version_id'].max()
-
-    @property
-    def model_version_id(self):
-        return self._model_version_id
-
-    @model_version_id.setter
-    def model_version_id(self, value):
-        self._model_version_id = value + 1
+        # allocated by the registry in update_model_versions
+        self.model_version_id = None
 
     def timestamp(self):
         return datetime.now().date()
 
     def data_version(self):
-        return datetime.fromtimestamp(os.path.getctime(
-            f"{self.config['directories.data']['processed']}/model_input.csv"
-        )).date()
+        return get_data_version()
 
     def description(self):
         return f"{self.location}-{self.type}-{self.short_description}"
@@ -131,7 +77,6 @@ class ModelOptions(Covariates):
 
     def update_model_versions(self):
         new_row = {
-            'version_id': self.model_version_id,
             'timestamp': self.timestamp(),
             'formula': self.formula(),
             'type': self.type,
@@ -142,21 +87,19 @@ class ModelOptions(Covariates):
             'min_prop': self.min_prop,
             'recip_only': self.recip_only
         }
-        # read header automatically
-        with open(self.model_versions, "r") as f:
-            reader = csv.reader(f)
-            for header in reader:
-                break
-        # add row to CSV file
-        with open(self.model_versions, "a") as f:
-            writer = csv.DictWriter(f, fieldnames=header)
-            writer.writerow(new_row)
+        registry = ModelRegistry()
+        self.model_version_id = registry.register(new_row)
+        # the R script still reads model_versions.csv
+        registry.export_csv()
 
     def launch_r_model(self):
         subprocess.run(
             ["Rscript", f"{self.r_script}", f"{self.model_version_id}"]
         )
 
+    def launch_python_model(self):
+        gravity_model.main(self.model_version_id)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -187,8 +130,37 @@ if __name__ == "__main__":
     parser.add_argument(
         '--recip_only', action='store_true',
         help="Run model on subset of data with only reciprocal pairs.")
+    parser.add_argument(
+        '--engine', choices=['python', 'r'], default='python',
+        help="Fit in-process with model/gravity_model.py or with Rscript")
+    parser.add_argument(
+        '--select', choices=['exhaustive', 'stepwise'],
+        help="Search subsets of --covariates (cohen only) and fit the best")
+    parser.add_argument(
+        '--criterion', choices=['aic', 'bic', 'cv'], default='bic',
+        help="How to rank subsets when using --select")
+    parser.add_argument(
+        '--max_terms', type=int, help="Largest subset to try with --select")
     args = parser.parse_args()
     print(args)
+    engine = vars(args).pop('engine')
+    select = vars(args).pop('select')
+    criterion = vars(args).pop('criterion')
+    max_terms = vars(args).pop('max_terms')
+    if select:
+        assert args.model_type == ['cohen'], \
+            "Subset search is only implemented for the cohen model"
+        ranked = search_covariates(
+            args.covariates, args.location[0], args.min_n, args.min_prop,
+            args.recip_only * 1, select, criterion, max_terms=max_terms)
+        ranked.to_csv(
+            f"{ModelOptions.config['directories.data']['model']}/"
+            f"covariate_search_{get_data_version()}.csv", index=False)
+        print(ranked.head(10))
+        args.covariates = ranked['covariates'].iloc[0]
     my_model = ModelOptions(**vars(args))
     my_model.update_model_versions()
-    my_model.launch_r_model()
+    if engine == 'r':
+        my_model.launch_r_model()
+    else:
+        my_model.launch_python_model()
@@ -0,0 +1,147 @@
+"""Model version registry backed by SQLite.
+
+Replaces appending rows to model_versions.csv: version ids come from an
+autoincrement key inside a write transaction, so concurrent launches never
+get the same id, and lookups by type, location, data_version and the best
+flag use indexes instead of reading the whole file. model_versions.csv is
+still written by export_csv for anything that reads it directly.
+"""
+import argparse
+import os
+import sqlite3
+from contextlib import contextmanager
+
+import pandas as pd
+
+from configurator import Config
+
+CONFIG = Config()
+
+COLUMNS = ['version_id', 'timestamp', 'formula', 'type', 'location',
+           'description', 'data_version', 'min_n', 'min_prop', 'recip_only',
+           'best']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS model_versions (
+    version_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT,
+    formula TEXT NOT NULL,
+    type TEXT NOT NULL,
+    location TEXT NOT NULL,
+    description TEXT,
+    data_version TEXT,
+    min_n INTEGER,
+    min_prop REAL,
+    recip_only INTEGER,
+    best INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_type_location_data
+    ON model_versions (type, location, data_version);
+CREATE INDEX IF NOT EXISTS idx_data_version ON model_versions (data_version);
+CREATE INDEX IF NOT EXISTS idx_best ON model_versions (best) WHERE best = 1;
+"""
+
+
+class ModelRegistry:
+    model_dir = CONFIG['directories.data']['model']
+
+    def __init__(self, db_path=None):
+        self.db_path = f"{self.model_dir}/model_versions.db" \
+            if db_path is None else db_path
+        self.csv_path = f"{self.model_dir}/model_versions.csv"
+        # autocommit, transactions are opened explicitly where needed
+        self.conn = sqlite3.connect(
+            self.db_path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        with self.transaction():
+            empty = self.conn.execute(
+                "SELECT COUNT(*) FROM model_versions").fetchone()[0] == 0
+            if empty and os.path.exists(self.csv_path):
+                self._import_csv(self.csv_path)
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction, holds the database lock until it ends."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _import_csv(self, csv_path):
+        """One-off migration of the rows in an existing model_versions.csv."""
+        df = pd.read_csv(csv_path).reindex(columns=COLUMNS)
+        df['best'] = df['best'].fillna(0).astype(int)
+        rows = df.astype(object).where(df.notnull(), None).values.tolist()
+        self.conn.executemany(
+            f"INSERT OR IGNORE INTO model_versions ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+
+    def register(self, row):
+        """Insert a model version and return its newly allocated id."""
+        row = {k: str(v) if k in ['timestamp', 'data_version'] else v
+               for k, v in row.items() if k not in ['version_id', 'best']}
+        with self.transaction():
+            cur = self.conn.execute(
+                f"INSERT INTO model_versions ({', '.join(row)}) "
+                f"VALUES ({', '.join('?' * len(row))})", list(row.values()))
+        return cur.lastrowid
+
+    def find(self, **filters):
+        """Model versions matching column == value for each filter."""
+        where = ' AND '.join(f'{k} = ?' for k in filters) or '1'
+        return pd.read_sql_query(
+            f"SELECT * FROM model_versions WHERE {where} "
+            "ORDER BY version_id", self.conn, params=list(filters.values()))
+
+    def get(self, version_id):
+        df = self.find(version_id=version_id)
+        assert len(df) == 1, f"Found {len(df)} rows for version {version_id}"
+        return df.iloc[0]
+
+    def best(self):
+        df = self.find(best=1)
+        assert len(df) == 1, f"Expected one best model, found {len(df)}"
+        return df.iloc[0]
+
+    def set_best(self, version_id):
+        """Flag a version as the best model, unflag the previous one.
+
+        Raises KeyError (and changes nothing) if the version doesn't exist.
+        """
+        with self.transaction():
+            self.conn.execute(
+                "UPDATE model_versions SET best = 0 WHERE best = 1")
+            cur = self.conn.execute(
+                "UPDATE model_versions SET best = 1 WHERE version_id = ?",
+                (version_id,))
+            # raising rolls back, so the previous best stays flagged
+            if cur.rowcount != 1:
+                raise KeyError(f"No model version {version_id}")
+
+    def export_csv(self, csv_path=None):
+        """Write the registry to csv, atomically and in version order."""
+        csv_path = self.csv_path if csv_path is None else csv_path
+        # hold the lock so a slower export can't overwrite a newer one
+        with self.transaction():
+            df = self.find()
+            df.to_csv(f"{csv_path}.tmp", index=False)
+            os.replace(f"{csv_path}.tmp", csv_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--set_best', type=int, help='version_id of the new best model')
+    parser.add_argument(
+        '--export', action='store_true',
+        help='write the registry out to model_versions.csv')
+    args = parser.parse_args()
+    registry = ModelRegistry()
+    if args.set_best is not None:
+        registry.set_best(args.set_best)
+    if args.export or args.set_best is not None:
+        registry.export_csv()
@@ -0,0 +1,214 @@
+"""Bootstrap and cross-validation of the cohen gravity model.
+
+dyad: resample country pairs with replacement. Each replicate is a
+    weighted least squares fit, done for a whole batch of replicates at once
+    with stacked Gram matrices.
+date: moving block bootstrap over collection dates. Each replicate
+    recomputes the median flow of every pair from the resampled dates and
+    refits, covariates stay fixed at their medians.
+cv: k-fold cross-validation over country pairs.
+
+Replicates run in a process pool, every worker opens the same memory-mapped
+design matrix. Besides confidence intervals for the coefficients, each pair
+gets the distribution of its residual quintile (the categories shown by
+heatmap_gravity_model.heatmap), so pairs that flip categories from noise
+alone can be spotted.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from model.design_matrix import DesignMatrix, parse_formula
+from model.gravity_model import TFORMS, fit_ols
+from model.registry import ModelRegistry
+
+CONFIG = Config()
+
+# design matrix and flows by date, opened once per worker process
+_WORKER = {}
+
+
+def _init_worker(stem, flows=None):
+    _WORKER['design'] = DesignMatrix(stem)
+    _WORKER['flows'] = flows
+
+
+def quintiles(resid):
+    """Residual quintile (1-5) of each pair, by row; 0 where resid is NaN.
+
+    Same bins as pd.qcut(resid, 5, labels=range(1, 6)) up to ties.
+    """
+    resid = np.atleast_2d(resid)
+    finite = np.isfinite(resid)
+    n = finite.sum(axis=1, keepdims=True)
+    # NaNs sort last, so ranks of the finite values are 0..n-1
+    ranks = np.argsort(np.argsort(resid, axis=1), axis=1)
+    quint = np.minimum(ranks * 5 // np.maximum(n, 1) + 1, 5)
+    return np.where(finite, quint, 0).astype(np.int8)
+
+
+def _design(spec):
+    return _WORKER['design'].design(
+        spec['formula'], spec['location'], spec['min_n'], spec['min_prop'])
+
+
+def _dyad_replicates(spec, seed, n_reps):
+    y, X, _, _ = _design(spec)
+    n = len(y)
+    rng = np.random.default_rng(seed)
+    # how many times each pair is drawn, one row per replicate
+    weights = rng.multinomial(n, np.full(n, 1 / n), size=n_reps)
+    XtWX = np.einsum('bn,ni,nj->bij', weights, X, X)
+    XtWy = np.einsum('bn,ni,n->bi', weights, X, y)
+    # a replicate that draws no pair of some factor level can't be fit,
+    # it gets NaN coefficients instead of failing the whole chunk
+    full = np.linalg.matrix_rank(XtWX) == X.shape[1]
+    coefs = np.full((n_reps, X.shape[1]), np.nan)
+    coefs[full] = np.linalg.solve(XtWX[full], XtWy[full][..., None])[..., 0]
+    return coefs, quintiles(y[None, :] - coefs @ X.T)
+
+
+def _date_replicates(spec, seed, n_reps, block):
+    y, X, _, rows = _design(spec)
+    flows = _WORKER['flows'][rows]
+    dep_func = parse_formula(spec['formula'])[0][0]
+    n_dates = flows.shape[1]
+    # a block longer than the series is just the whole series
+    block = min(block, n_dates)
+    rng = np.random.default_rng(seed)
+    n_blocks = int(np.ceil(n_dates / block))
+    starts = rng.integers(0, n_dates - block + 1, size=(n_reps, n_blocks))
+    dates = (starts[..., None] + np.arange(block)).reshape(
+        n_reps, -1)[:, :n_dates]
+    coefs = np.full((n_reps, X.shape[1]), np.nan)
+    resid = np.full((n_reps, len(y)), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for b in range(n_reps):
+            y_b = TFORMS[dep_func](np.nanmedian(flows[:, dates[b]], axis=1))
+            ok = np.isfinite(y_b)
+            coefs[b], *_ = np.linalg.lstsq(X[ok], y_b[ok], rcond=None)
+            resid[b, ok] = y_b[ok] - X[ok] @ coefs[b]
+    return coefs, quintiles(resid)
+
+
+def flows_by_date(design):
+    """Flow by pair (rows of the design matrix) and collection date."""
+    pairs = design.key_values[['iso3_orig', 'iso3_dest']]
+    return pd.read_csv(
+        f"{CONFIG['directories.data']['processed']}/model_input.csv",
+        usecols=['iso3_orig', 'iso3_dest', 'query_date', 'flow']
+    ).pivot_table(
+        'flow', ['iso3_orig', 'iso3_dest'], 'query_date'
+    ).reindex(pd.MultiIndex.from_frame(pairs)).values
+
+
+def bootstrap(spec, method='dyad', n_reps=1000, n_jobs=None, block=2,
+              seed=0, recip_only=0, data_version=None):
+    """Return (coefficients, quintiles), one row per replicate. Replicates
+    that can't be fit have NaN coefficients and quintile 0."""
+    design = DesignMatrix.cached(data_version, recip_only)
+    flows = flows_by_date(design) if method == 'date' else None
+    n_chunks = min(n_reps, 4 * (n_jobs or 8))
+    chunks = np.diff(np.linspace(0, n_reps, n_chunks + 1).astype(int))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    with ProcessPoolExecutor(
+        n_jobs, initializer=_init_worker, initargs=(design.stem, flows)
+    ) as pool:
+        if method == 'dyad':
+            futures = [pool.submit(_dyad_replicates, spec, s, n)
+                       for s, n in zip(seeds, chunks)]
+        else:
+            futures = [pool.submit(_date_replicates, spec, s, n, block)
+                       for s, n in zip(seeds, chunks)]
+        results = [f.result() for f in futures]
+    return (np.concatenate([x[0] for x in results]),
+            np.concatenate([x[1] for x in results]))
+
+
+def cross_validate(spec, k=10, seed=0, recip_only=0, data_version=None):
+    """k-fold CV over pairs, returns per fold RMSE (in log10 space)."""
+    y, X, _, _ = DesignMatrix.cached(data_version, recip_only).design(
+        spec['formula'], spec['location'], spec['min_n'], spec['min_prop'])
+    fold = np.random.default_rng(seed).permutation(len(y)) % k
+    rmse = []
+    for f in range(k):
+        fit = fit_ols(X[fold != f], y[fold != f])
+        test_resid = y[fold == f] - X[fold == f] @ fit.coef
+        rmse.append(np.sqrt(np.mean(test_resid ** 2)))
+    return pd.DataFrame({'fold': range(k), 'n_test': np.bincount(fold),
+                         'rmse': rmse})
+
+
+def summarise_coefs(fit, names, coefs, alpha=0.05):
+    return pd.DataFrame({
+        'term': names, 'estimate': fit.coef,
+        'boot.std.error': np.nanstd(coefs, axis=0),
+        'conf.low': np.nanquantile(coefs, alpha / 2, axis=0),
+        'conf.high': np.nanquantile(coefs, 1 - alpha / 2, axis=0)})
+
+
+def summarise_quintiles(pairs, point, quints, alpha=0.05):
+    """Per pair: point quintile, how often replicates agree, and an interval.
+
+    Replicates where a pair is missing (quintile 0) are ignored.
+    """
+    quints = np.where(quints == 0, np.nan, quints.astype(float))
+    counts = np.stack(
+        [(quints == q).sum(axis=0) for q in range(1, 6)], axis=1)
+    n = np.maximum(counts.sum(axis=1), 1)
+    return pairs.assign(
+        resids_quant=point,
+        modal_quant=counts.argmax(axis=1) + 1,
+        p_same_quant=counts[np.arange(len(point)), point - 1] / n,
+        quant_low=np.nanquantile(quints, alpha / 2, axis=0),
+        quant_high=np.nanquantile(quints, 1 - alpha / 2, axis=0),
+        **{f'p_quant_{q}': counts[:, q - 1] / n for q in range(1, 6)})
+
+
+def main(version_id, method, n_reps, n_jobs, block, folds):
+    version = ModelRegistry().get(version_id)
+    assert version['type'] == 'cohen', \
+        "Resampling is only implemented for the cohen model"
+    spec = {x: version[x] for x in
+            ['formula', 'location', 'min_n', 'min_prop']}
+    out = f"{CONFIG['directories.data']['model']}/" \
+        f"{version['description']}-{version_id}"
+    kwargs = {'recip_only': version['recip_only'],
+              'data_version': version['data_version']}
+    if method == 'cv':
+        cv = cross_validate(spec, folds, **kwargs)
+        cv.to_csv(f"{out}_cv.csv", index=False)
+        print(cv, f"\nmean RMSE: {cv['rmse'].mean():.4f}")
+        return
+    design = DesignMatrix.cached(**kwargs)
+    y, X, names, rows = design.design(**spec)
+    fit = fit_ols(X, y)
+    coefs, quints = bootstrap(
+        spec, method, n_reps, n_jobs, block, **kwargs)
+    failed = np.isnan(coefs).all(axis=1).sum()
+    if failed:
+        print(f"{failed} of {n_reps} replicates couldn't be fit, ignored")
+    pairs = design.keys(rows)[['iso3_orig', 'iso3_dest']]
+    coef_df = summarise_coefs(fit, names, coefs)
+    coef_df.to_csv(f"{out}_bootstrap_{method}_coefs.csv", index=False)
+    summarise_quintiles(pairs, quintiles(fit.resid)[0], quints).to_csv(
+        f"{out}_bootstrap_{method}_pairs.csv", index=False)
+    print(coef_df)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('version_id', type=int)
+    parser.add_argument('--method', choices=['dyad', 'date', 'cv'],
+                        default='dyad')
+    parser.add_argument('--n_reps', type=int, default=1000)
+    parser.add_argument('--n_jobs', type=int, help='number of processes')
+    parser.add_argument(
+        '--block', type=int, default=2,
+        help='number of consecutive collection dates per block (date only)')
+    parser.add_argument('--folds', type=int, default=10, help='cv only')
+    args = parser.parse_args()
+    main(**vars(args))
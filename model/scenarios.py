@@ -0,0 +1,137 @@
+"""Counterfactual scenarios for a fitted gravity model.
+
+A scenario is a list of perturbations to the raw covariates, e.g.
+
+    {"name": "deu internet +10%",
+     "changes": [{"variable": "internet_dest", "change": 0.1,
+                  "how": "relative", "iso3_dest": ["deu"]}]}
+
+how is 'relative' (x * (1 + change)) or 'absolute' (x + change), and
+iso3_orig / iso3_dest optionally restrict the change to some countries.
+Each perturbation only moves the linear predictor by coef * (new term - old
+term), so all scenarios are scored together: one (scenarios x pairs x terms)
+array of term changes times the coefficient vector.
+"""
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from model.design_matrix import DesignMatrix, parse_formula
+from model.gravity_model import TFORMS
+from model.registry import ModelRegistry
+from utils.hierarchy import LocationHierarchy
+
+CONFIG = Config()
+
+
+def load_fitted_model(version_id):
+    """Return the registry row and coefficients saved by gravity_model."""
+    version = ModelRegistry().get(version_id)
+    coefs = pd.read_csv(
+        f"{CONFIG['directories.data']['model']}/"
+        f"{version['description']}-{version_id}_betas.csv"
+    ).set_index('term')['estimate']
+    return version, coefs
+
+
+def _change_mask(pairs, change):
+    mask = np.ones(len(pairs), dtype=bool)
+    for x in ['orig', 'dest']:
+        isos = change.get(f'iso3_{x}')
+        if isos is not None:
+            isos = [isos] if isinstance(isos, str) else isos
+            mask &= pairs[f'iso3_{x}'].isin(isos).values
+    return mask
+
+
+def term_changes(design, rows, pairs, terms, scenarios):
+    """Array (scenarios x pairs x terms) of changes to each model term."""
+    delta = np.zeros((len(scenarios), len(rows), len(terms)))
+    term_idx = {var: i for i, (_, var) in enumerate(terms)}
+    funcs = dict((var, func) for func, var in terms)
+    for s, scenario in enumerate(scenarios):
+        for change in scenario['changes']:
+            var = change['variable']
+            assert var in term_idx, f"{var} is not in the model"
+            assert funcs[var] != 'factor', "Can't perturb factor variables"
+            raw = np.asarray(design.column(var)[rows])
+            if change.get('how', 'relative') == 'relative':
+                new = raw * (1 + change['change'])
+            else:
+                new = raw + change['change']
+            new = np.where(_change_mask(pairs, change), new, raw)
+            tform = TFORMS[funcs[var]]
+            # changes to the same variable stack on top of each other
+            delta[s, :, term_idx[var]] += tform(new) - tform(raw)
+    return delta
+
+
+def score_scenarios(version_id, scenarios, loc_level='region'):
+    """Expected flow of every pair under each scenario.
+
+    Returns (pairs, regions): expected flows by pair and scenario, and the
+    same summed over origin and destination loc_level (or 'country').
+    """
+    version, coefs = load_fitted_model(version_id)
+    design = DesignMatrix.cached(
+        version['data_version'], version['recip_only'])
+    _, X, names, rows = design.design(
+        version['formula'], version['location'], version['min_n'],
+        version['min_prop'])
+    pairs = design.keys(rows)[['iso3_orig', 'iso3_dest']]
+    terms = [x for x in parse_formula(version['formula'])[1]
+             if x[0] != 'factor']
+    coef_vec = np.array([
+        coefs[f'{func}({var})' if func else var] for func, var in terms])
+    eta = X @ coefs.reindex(names).values
+    delta = term_changes(design, rows, pairs, terms, scenarios)
+    scenario_eta = eta[None, :] + delta @ coef_vec
+    # back to flows, cohen is fit on log10 and the GLMs have a log link
+    base = 10.0 if version['type'] == 'cohen' else np.e
+    expected = np.power(base, np.vstack([eta, scenario_eta]))
+    scenario_names = ['baseline'] + [x['name'] for x in scenarios]
+    pair_df = pd.concat([
+        pairs.assign(scenario=name, expected_flow=values)
+        for name, values in zip(scenario_names, expected)
+    ], ignore_index=True)
+    pair_df['pct_change'] = (
+        pair_df['expected_flow'] /
+        np.tile(expected[0], len(scenario_names)) - 1) * 100
+    return pair_df, aggregate_scenarios(pair_df, loc_level)
+
+
+def aggregate_scenarios(pair_df, loc_level='region'):
+    hierarchy = LocationHierarchy()
+    df = pd.concat([
+        hierarchy.rollup(group, ['expected_flow'], loc_level).assign(
+            scenario=name)
+        for name, group in pair_df.groupby('scenario', sort=False)
+    ], ignore_index=True)
+    baseline = df[df['scenario'] == 'baseline'].drop(columns='scenario')
+    df = df.merge(baseline, on=[f'{loc_level}_orig', f'{loc_level}_dest'],
+                  suffixes=('', '_baseline'))
+    return df.assign(pct_change=(
+        df['expected_flow'] / df['expected_flow_baseline'] - 1) * 100)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('version_id', type=int)
+    parser.add_argument(
+        'scenarios', help='json file with a list of scenarios')
+    parser.add_argument(
+        '--loc_level',
+        choices=['country', 'region', 'subregion', 'midregion'],
+        default='region')
+    args = parser.parse_args()
+    with open(args.scenarios) as f:
+        scenarios = json.load(f)
+    pair_df, region_df = score_scenarios(
+        args.version_id, scenarios, args.loc_level)
+    out = f"{CONFIG['directories.data']['model']}/scenarios-{args.version_id}"
+    pair_df.to_csv(f"{out}.csv", index=False)
+    region_df.to_csv(f"{out}_{args.loc_level}.csv", index=False)
+    print(region_df[region_df['scenario'] != 'baseline'])
@@ -0,0 +1,208 @@
+"""Search covariate subsets for the cohen (log10 OLS) model.
+
+Everything needed to score an OLS fit lives in the Gram matrix of
+[X, y], so it is computed once and each subset is scored from its Cholesky
+factor. Adding a covariate to a subset borders the parent's factor with the
+new block of columns instead of refitting from scratch, so exhaustive
+search walks the subsets depth-first and reuses every parent's work.
+
+k-fold CV error comes from the same trick: the training Gram matrix of a
+fold is the full Gram matrix minus that fold's.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from model.covariates import Covariates
+from model.design_matrix import DesignMatrix
+from utils.lazy import lazy_import
+
+linalg = lazy_import('scipy.linalg')
+
+# at most this many covariates from a group, groups are Covariates attributes
+DEFAULT_MAX_PER_GROUP = {'distance_covs': 1, 'language_covs': 1}
+
+# Cholesky factor and projected y of a subset, for the full data and folds
+Node = namedtuple('Node', ['L', 'u', 'rss'])
+
+
+def _extend(node, G, g, cols, new):
+    """Border a subset's Cholesky factor with the columns in new."""
+    G_sb = G[np.ix_(cols, new)]
+    L21 = linalg.solve_triangular(node.L, G_sb, lower=True).T
+    L22 = linalg.cholesky(G[np.ix_(new, new)] - L21 @ L21.T, lower=True)
+    u2 = linalg.solve_triangular(L22, g[new] - L21 @ node.u, lower=True)
+    L = np.block([[node.L, np.zeros((len(cols), len(new)))], [L21, L22]])
+    return Node(L, np.concatenate([node.u, u2]), node.rss - u2 @ u2)
+
+
+class SubsetSearch:
+    """Score covariate subsets from Gram matrices.
+
+    X: design matrix for every candidate, intercept in the first column
+    y: dependent variable (already log10 transformed)
+    blocks: {covariate: [column indices in X]}, a factor is several columns
+    """
+
+    def __init__(self, X, y, blocks, folds=5, seed=0):
+        self.blocks = blocks
+        self.n = len(y)
+        Z = np.column_stack([X, y])
+        self.grams = [Z.T @ Z]
+        fold_id = np.random.default_rng(seed).integers(0, folds, self.n)
+        self.fold_grams = [Z[fold_id == k].T @ Z[fold_id == k]
+                           for k in range(folds)] if folds else []
+        # training gram of each fold is the total minus the held out part
+        self.grams += [self.grams[0] - x for x in self.fold_grams]
+
+    def root(self):
+        nodes = []
+        for G in self.grams:
+            L = np.sqrt(G[:1, :1])
+            u = G[:1, -1] / L[0]
+            nodes.append(Node(L, u, G[-1, -1] - u @ u))
+        return [0], nodes
+
+    def extend(self, cols, nodes, covariate):
+        new = self.blocks[covariate]
+        return cols + new, [
+            _extend(node, G[:-1, :-1], G[:-1, -1], cols, new)
+            for node, G in zip(nodes, self.grams)]
+
+    def score(self, cols, nodes):
+        rss = max(nodes[0].rss, 1e-300)
+        k = len(cols) + 1  # + sigma
+        loglik = -self.n / 2 * (np.log(2 * np.pi * rss / self.n) + 1)
+        scores = {'n_obs': self.n, 'rss': rss,
+                  'aic': -2 * loglik + 2 * k,
+                  'bic': -2 * loglik + np.log(self.n) * k}
+        if self.fold_grams:
+            sse = 0
+            for node, G in zip(nodes[1:], self.fold_grams):
+                b = linalg.solve_triangular(node.L.T, node.u)
+                G_ss = G[np.ix_(cols, cols)]
+                sse += G[-1, -1] - 2 * b @ G[cols, -1] + b @ G_ss @ b
+            scores['cv_rmse'] = np.sqrt(max(sse, 0) / self.n)
+        return scores
+
+
+def _groups(candidates, max_per_group, covs):
+    """Return {covariate: [constrained groups it belongs to]}."""
+    return {x: [grp for grp in max_per_group if x in getattr(covs, grp)]
+            for x in candidates}
+
+
+def _allowed(counts, groups, covariate, max_per_group):
+    return all(counts.get(grp, 0) < max_per_group[grp]
+               for grp in groups[covariate])
+
+
+def _add_count(counts, groups, covariate):
+    counts = dict(counts)
+    for grp in groups[covariate]:
+        counts[grp] = counts.get(grp, 0) + 1
+    return counts
+
+
+def exhaustive(search, candidates, groups, max_per_group, max_terms=None):
+    """Score every allowed subset, walking them depth first."""
+    max_terms = len(candidates) if max_terms is None else max_terms
+    results = []
+
+    def _walk(start, subset, cols, nodes, counts):
+        for i in range(start, len(candidates)):
+            covariate = candidates[i]
+            if not _allowed(counts, groups, covariate, max_per_group):
+                continue
+            try:
+                new_cols, new_nodes = search.extend(cols, nodes, covariate)
+            except np.linalg.LinAlgError:
+                # collinear with the subset already, no point going deeper
+                continue
+            new_subset = subset + [covariate]
+            results.append(
+                {'covariates': new_subset,
+                 **search.score(new_cols, new_nodes)})
+            if len(new_subset) < max_terms:
+                _walk(i + 1, new_subset, new_cols, new_nodes,
+                      _add_count(counts, groups, covariate))
+
+    _walk(0, [], *search.root(), {})
+    return results
+
+
+def stepwise(search, candidates, groups, max_per_group, criterion='aic',
+             max_terms=None):
+    """Forward stepwise, add the best covariate until nothing improves."""
+    max_terms = len(candidates) if max_terms is None else max_terms
+    cols, nodes = search.root()
+    subset, counts, results = [], {}, []
+    best = search.score(cols, nodes)[criterion]
+    while len(subset) < max_terms:
+        step = []
+        for covariate in [x for x in candidates if x not in subset]:
+            if not _allowed(counts, groups, covariate, max_per_group):
+                continue
+            try:
+                new_cols, new_nodes = search.extend(cols, nodes, covariate)
+            except np.linalg.LinAlgError:
+                continue
+            step.append((search.score(new_cols, new_nodes), covariate,
+                         new_cols, new_nodes))
+        if not step:
+            break
+        scores, covariate, new_cols, new_nodes = min(
+            step, key=lambda x: x[0][criterion])
+        if scores[criterion] >= best:
+            break
+        best = scores[criterion]
+        subset = subset + [covariate]
+        cols, nodes = new_cols, new_nodes
+        counts = _add_count(counts, groups, covariate)
+        results.append({'covariates': subset, **scores})
+    return results
+
+
+def search_covariates(candidates, location, min_n=1, min_prop=0,
+                      recip_only=0, method='exhaustive', criterion='aic',
+                      max_per_group=None, max_terms=None, folds=5,
+                      data_version=None):
+    """Rank subsets of candidate covariates for the cohen model.
+
+    All subsets are fit on the same rows (complete for every candidate) so
+    their AIC/BIC are comparable. Returns a dataframe sorted by criterion.
+    """
+    if criterion == 'cv' and folds < 2:
+        raise ValueError(
+            f"criterion='cv' needs at least 2 folds, got folds={folds}")
+    max_per_group = DEFAULT_MAX_PER_GROUP if max_per_group is None \
+        else max_per_group
+    covs = Covariates()
+    log_vars = covs.log_tformed_covariates()
+    factor_vars = covs.dummy_covariates()
+    terms = [f'log10({x})' if x in log_vars else
+             f'factor({x})' if x in factor_vars else x for x in candidates]
+    design = DesignMatrix.cached(data_version, recip_only)
+    y, X, names, _ = design.design(
+        f"log10({covs.dep_var})~{'+'.join(terms)}", location, min_n,
+        min_prop)
+    blocks = {
+        x: [i for i, name in enumerate(names)
+            if name == term or
+            (term.startswith('factor(') and name.startswith(term))]
+        for x, term in zip(candidates, terms)}
+    # e.g. a factor with only one level left in these rows
+    candidates = [x for x in candidates if blocks[x]]
+    search = SubsetSearch(X, y, blocks, folds=folds)
+    groups = _groups(candidates, max_per_group, covs)
+    criterion_col = 'cv_rmse' if criterion == 'cv' else criterion
+    if method == 'exhaustive':
+        results = exhaustive(search, candidates, groups, max_per_group,
+                             max_terms)
+    else:
+        results = stepwise(search, candidates, groups, max_per_group,
+                           criterion_col, max_terms)
+    return pd.DataFrame(results).assign(
+        num_covariates=lambda x: x['covariates'].str.len()
+    ).sort_values(by=criterion_col, ignore_index=True)
@@ -0,0 +1,197 @@
+"""Trends and change points of every flow and goers series at once.
+
+Series are laid out as a (series x dates) array of log(1 + value), so every
+statistic is a handful of array operations instead of a loop over dyads:
+
+slope: least squares trend in log units per year, with its standard error,
+    p-value and a Benjamini-Hochberg q-value across all series
+level: rolling median of the last dates, back in the original units
+break: the date splitting the series into two separate lines with the
+    smallest total squared error, found for every candidate date at once from
+    cumulative sums. Its p-value is the Chow test F for that split,
+    Bonferroni corrected for the number of candidate dates.
+
+Writes flow_trends.csv (one row per dyad) and goers_trends.csv (one row per
+destination), sorted so the corridors rising most clearly come first.
+"""
+import argparse
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from utils.lazy import lazy_import
+from utils.io import save_output
+
+CONFIG = Config()
+stats = lazy_import('scipy.stats')
+
+# series with fewer dates get no trend
+MIN_DATES = 6
+# fewest dates on either side of a break
+MIN_SEGMENT = 3
+# dates in the rolling median
+WINDOW = 3
+# significance level for 'rising' and 'has_break'
+ALPHA = 0.05
+
+
+def to_cube(df, id_cols, value_col, date_col='query_date'):
+    """Return (ids, dates, x): ids DataFrame, sorted dates and the
+    (series x dates) array of log(1 + value), NaN where a date is missing."""
+    series, ids = pd.factorize(pd.MultiIndex.from_frame(df[id_cols]))
+    dates, date_idx = pd.factorize(df[date_col], sort=True)
+    x = np.full((len(ids), len(date_idx)), np.nan)
+    x[series, dates] = np.log1p(df[value_col].clip(lower=0).values)
+    ids = pd.MultiIndex.from_tuples(ids, names=id_cols)
+    return ids.to_frame(index=False), date_idx, x
+
+
+def years(dates):
+    dates = pd.to_datetime(dates)
+    return ((dates - dates[0]).days / 365.25).values
+
+
+def rolling_median(x, window=WINDOW):
+    """Centered rolling median along the dates, ignoring NaNs."""
+    pad = window // 2
+    padded = np.pad(x, ((0, 0), (pad, window - 1 - pad)),
+                    constant_values=np.nan)
+    shifted = np.stack(
+        [padded[:, i:i + x.shape[1]] for i in range(window)])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.where(np.isfinite(x), np.nanmedian(shifted, axis=0), np.nan)
+
+
+def _sums(t, x):
+    """Cumulative n, sum t, sum t^2, sum y, sum ty, sum y^2 along dates."""
+    ok = np.isfinite(x)
+    y = np.where(ok, x, 0)
+    tt = np.where(ok, t, 0)
+    return np.stack([ok, tt, tt * t, y, tt * y, y * y]).cumsum(axis=-1)
+
+
+def _line(sums):
+    """Slope, intercept and squared error of least squares lines, from the
+    sums of _sums (along its first axis)."""
+    n, st, stt, sy, sty, syy = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = stt - st ** 2 / n
+        sxy = sty - st * sy / n
+        slope = sxy / sxx
+        sse = np.maximum(syy - sy ** 2 / n - slope * sxy, 0)
+        return slope, (sy - slope * st) / n, sse
+
+
+def qvalues(p):
+    """Benjamini-Hochberg adjusted p-values, NaNs left as they are."""
+    q = np.full(len(p), np.nan)
+    ok = np.isfinite(p)
+    order = np.argsort(p[ok])
+    ranked = p[ok][order] * ok.sum() / np.arange(1, ok.sum() + 1)
+    q_ok = np.empty(ok.sum())
+    q_ok[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    q[ok] = q_ok
+    return q
+
+
+def trends(t, x, min_dates=MIN_DATES, min_segment=MIN_SEGMENT):
+    """DataFrame of trend and change point statistics, one row per row of x.
+
+    t: years since the first date, x: (series x dates) log values.
+    """
+    smooth = rolling_median(x)
+    # centered, so constant series have exactly zero slope
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        x = x - np.nanmean(x, axis=1, keepdims=True)
+    t = t - t.mean()
+    sums = _sums(t, x)
+    total = sums[..., -1]
+    n = total[0]
+    slope, intercept, sse = _line(total)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se = np.sqrt(sse / (n - 2) / (total[2] - total[1] ** 2 / n))
+        p = np.where(se > 0, 2 * stats.t.sf(np.abs(slope / se), n - 2), 1)
+        # two lines split after each date, left has dates up to it
+        left, right = sums[..., :-1], total[..., None] - sums[..., :-1]
+        slope_l, int_l, sse_l = _line(left)
+        slope_r, int_r, sse_r = _line(right)
+        split_sse = np.where(
+            (left[0] >= min_segment) & (right[0] >= min_segment),
+            sse_l + sse_r, np.inf)
+        k = np.argmin(split_sse, axis=1)
+        rows = np.arange(len(x))
+        sse_1 = split_sse[rows, k]
+        f = (sse - sse_1) / 2 / (sse_1 / (n - 4))
+        n_splits = np.isfinite(split_sse).sum(axis=1)
+        break_p = np.minimum(stats.f.sf(f, 2, n - 4) * n_splits, 1)
+    has_break = np.isfinite(sse_1)
+    # the break date is the first date of the right line
+    first_right = np.argmax(
+        np.isfinite(x) & (np.arange(len(t)) > k[:, None]), axis=1)
+    t_break = t[first_right]
+    last = np.where(np.isfinite(x), np.arange(len(t)), -1).max(axis=1)
+    short = n < min_dates
+    out = pd.DataFrame({
+        'n_dates': n.astype(int),
+        'level': np.expm1(smooth[rows, last]),
+        'slope': slope, 'pct_per_year': np.expm1(slope) * 100,
+        'slope_se': se, 'slope_p': p,
+        'break_pos': np.where(has_break, first_right, -1),
+        'slope_before': slope_l[rows, k], 'slope_after': slope_r[rows, k],
+        'jump': (int_r[rows, k] + slope_r[rows, k] * t_break) -
+                (int_l[rows, k] + slope_l[rows, k] * t_break),
+        'break_f': f, 'break_p': break_p})
+    stat_cols = out.columns.drop(['n_dates', 'level'])
+    out.loc[short, stat_cols] = np.nan
+    no_break = short | ~has_break
+    out.loc[no_break, out.columns[out.columns.get_loc('break_pos'):]] = np.nan
+    out['slope_q'] = qvalues(out['slope_p'].values)
+    return out
+
+
+def trend_table(df, id_cols, value_col, date_col='query_date',
+                min_dates=MIN_DATES, alpha=ALPHA):
+    """Trend table for every series of df, rising corridors first."""
+    ids, dates, x = to_cube(df, id_cols, value_col, date_col)
+    out = trends(years(dates), x, min_dates)
+    break_date = pd.Series(dates).reindex(out['break_pos'].values).values
+    out = pd.concat([ids, out.drop(columns='break_pos')], axis=1).assign(
+        first_date=dates[np.isfinite(x).argmax(axis=1)],
+        break_date=break_date,
+        rising=lambda y: (y['slope_q'] < alpha) & (y['slope'] > 0),
+        has_break=lambda y: y['break_p'] < alpha)
+    return out.assign(t=out['slope'] / out['slope_se']).sort_values(
+        ['rising', 't'], ascending=False).drop(columns='t')
+
+
+def main(min_dates, alpha):
+    processed = CONFIG['directories.data']['processed']
+    flows = pd.read_csv(
+        f"{processed}/model_input.csv",
+        usecols=['iso3_orig', 'iso3_dest', 'query_date', 'flow'])
+    flow_trends = trend_table(
+        flows, ['iso3_orig', 'iso3_dest'], 'flow', min_dates=min_dates,
+        alpha=alpha)
+    save_output(flow_trends, 'flow_trends')
+    goers = pd.read_csv(
+        f"{processed}/goers.csv",
+        usecols=['country_dest', 'query_date', 'goers'])
+    save_output(trend_table(goers, ['country_dest'], 'goers',
+                            min_dates=min_dates, alpha=alpha), 'goers_trends')
+    print(f"{flow_trends['rising'].sum()} rising corridors, "
+          f"{flow_trends['has_break'].sum()} with a break\n",
+          flow_trends.head(20).to_string())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--min_dates', type=int, default=MIN_DATES,
+                        help='fewest dates to estimate a trend')
+    parser.add_argument('--alpha', type=float, default=ALPHA,
+                        help='significance level for rising and has_break')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,231 @@
+"""Processed ETL outputs in an embedded SQLite database.
+
+prep_bilateral_flows.py -db writes its outputs to processed.db next to the
+csvs, with typed columns and indexes on the id columns, so consumers can
+push filters and aggregations into the engine instead of reading whole
+csvs into pandas:
+
+    db = FlowDB()
+    db.select('model_input', ['query_date', 'flow'],
+              where={'iso3_orig': 'deu', 'iso3_dest': ['fra', 'ita']})
+    db.aggregate('model_input', ['subregion_orig', 'query_date'], 'flow',
+                 where={'eu_plus': 1, 'query_date': ('>=', '2021-01-01')})
+
+From the command line: python utils/database.py "SELECT ..."
+"""
+import argparse
+import sqlite3
+from statistics import median
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+
+CONFIG = Config()
+
+INDEX_COLUMNS = ['iso3_orig', 'iso3_dest', 'query_date', 'recip', 'eu_plus'] \
+    + [f'{x}_{y}' for x in ['region', 'subregion', 'midregion']
+       for y in ['orig', 'dest']]
+AGGS = {'sum': 'SUM', 'mean': 'AVG', 'median': 'MEDIAN', 'min': 'MIN',
+        'max': 'MAX', 'count': 'COUNT'}
+OPERATORS = ['=', '!=', '<', '<=', '>', '>=', 'LIKE']
+# rollups by location level pair and date, coarsest first
+ROLLUP_LEVELS = ['region', 'midregion', 'subregion']
+ROLLUP_FLAGS = ['query_date', 'eu_plus', 'recip']
+ROLLUP_VALUES = ['flow', 'net_flow']
+
+
+class Median:
+    """SQLite aggregate, MEDIAN isn't built in."""
+
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        return median(self.values) if self.values else None
+
+
+def _quote(cols):
+    return ', '.join(f'"{x}"' for x in cols)
+
+
+def db_path():
+    return f"{CONFIG['directories.data']['processed']}/processed.db"
+
+
+def sql_type(dtype):
+    if pd.api.types.is_bool_dtype(dtype) or \
+            pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+
+class FlowDB:
+    def __init__(self, path=None):
+        self.path = db_path() if path is None else path
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.create_aggregate('MEDIAN', 1, Median)
+
+    def tables(self, rollups=False):
+        tables = [x for x, in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name NOT LIKE 'sqlite_%'")]
+        return tables if rollups else [x for x in tables if '__' not in x]
+
+    def columns(self, table):
+        return [x[1] for x in self.conn.execute(
+            f'PRAGMA table_info("{table}")')]
+
+    def _rollups(self, df):
+        """Sums and counts of ROLLUP_VALUES by location level pair, date and
+        flags, which answer most regional and temporal queries."""
+        values = [x for x in ROLLUP_VALUES if x in df.columns]
+        flags = [x for x in ROLLUP_FLAGS if x in df.columns]
+        if not values or 'query_date' not in flags:
+            return {}
+        rollups = {}
+        for level in ROLLUP_LEVELS:
+            keys = [f'{level}_orig', f'{level}_dest']
+            if not set(keys) <= set(df.columns):
+                continue
+            grouped = df.groupby(keys + flags, dropna=False)[values]
+            rollups[level] = pd.concat(
+                [grouped.sum(min_count=1).add_suffix('_sum'),
+                 grouped.count().add_suffix('_count')], axis=1).reset_index()
+        return rollups
+
+    def _insert(self, df, name):
+        """Create table name from df with executemany, unlike to_sql this
+        doesn't commit, so it stays inside the caller's transaction."""
+        self.conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+        cols = ', '.join(f'"{col}" {sql_type(df[col].dtype)}'
+                         for col in df.columns)
+        self.conn.execute(f'CREATE TABLE "{name}" ({cols})')
+        rows = df.astype(object).where(df.notna(), None)
+        self.conn.executemany(
+            f'INSERT INTO "{name}" VALUES '
+            f'({", ".join("?" * len(df.columns))})',
+            rows.itertuples(index=False, name=None))
+
+    def write(self, df, name):
+        """Replace table name with df, then index its id columns."""
+        df = df.copy()
+        for col in df.columns:
+            # categoricals (e.g. gdp bins) are stored as their labels
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object)
+            elif pd.api.types.is_datetime64_any_dtype(df[col].dtype):
+                df[col] = df[col].astype(str)
+        index_cols = [x for x in INDEX_COLUMNS if x in df.columns]
+        rollups = self._rollups(df)
+        with self.conn:
+            # one transaction, so readers see the old tables or all the new
+            self.conn.execute('BEGIN')
+            self._insert(df, f'{name}__new')
+            for table in self.tables(rollups=True):
+                if table.startswith(f'{name}__by_'):
+                    self.conn.execute(f'DROP TABLE "{table}"')
+            for level, rollup in rollups.items():
+                self._insert(rollup, f'{name}__by_{level}')
+            self.conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+            self.conn.execute(
+                f'ALTER TABLE "{name}__new" RENAME TO "{name}"')
+            for col in index_cols:
+                self.conn.execute(
+                    f'CREATE INDEX "{name}_{col}" ON "{name}" ("{col}")')
+            pair_cols = [x for x in ['iso3_orig', 'iso3_dest', 'query_date']
+                         if x in df.columns]
+            if len(pair_cols) > 1:
+                self.conn.execute(f'CREATE INDEX "{name}_pair" ON "{name}" '
+                                  f'({_quote(pair_cols)})')
+        self.conn.execute(f'ANALYZE "{name}"')
+
+    def query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.conn, params=list(params))
+
+    def _where(self, where):
+        """SQL and parameters for {column: value, [values] or (op, value)}."""
+        clauses, params = [], []
+        for col, value in (where or {}).items():
+            if isinstance(value, tuple):
+                op, value = value
+                assert op.upper() in OPERATORS, f"Unknown operator {op}"
+                clauses.append(f'"{col}" {op} ?')
+                params.append(value)
+            elif isinstance(value, (list, np.ndarray, pd.Index)):
+                clauses.append(
+                    f'"{col}" IN ({", ".join("?" * len(value))})')
+                params += list(value)
+            else:
+                clauses.append(f'"{col}" = ?')
+                params.append(value)
+        return (f" WHERE {' AND '.join(clauses)}" if clauses else '',
+                [x.item() if isinstance(x, np.generic) else x
+                 for x in params])
+
+    def select(self, table, columns=None, where=None, order_by=None,
+               limit=None):
+        cols = _quote(columns) if columns else '*'
+        where_sql, params = self._where(where)
+        sql = f'SELECT {cols} FROM "{table}"{where_sql}'
+        if order_by:
+            sql += f' ORDER BY {_quote(order_by)}'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return self.query(sql, params)
+
+    def _rollup_for(self, table, columns, values, agg):
+        """Smallest rollup of table with all columns, if it can do agg."""
+        if agg not in ['sum', 'count', 'mean'] or \
+                not set(values) <= set(ROLLUP_VALUES):
+            return None
+        for level in ROLLUP_LEVELS:
+            rollup = f'{table}__by_{level}'
+            if rollup in self.tables(rollups=True) and \
+                    set(columns) <= set(self.columns(rollup)):
+                return rollup
+        return None
+
+    def aggregate(self, table, by, values, agg='sum', where=None):
+        """Group by columns and aggregate values (a column or a list).
+
+        Sums, counts and means of flows by region and date are read from
+        the rollups written with the table, everything else scans the table.
+        """
+        assert agg in AGGS, f"agg must be one of {list(AGGS)}"
+        values = [values] if isinstance(values, str) else values
+        rollup = self._rollup_for(
+            table, list(by) + list(where or {}), values, agg)
+        if rollup is not None:
+            table, aggs = rollup, ', '.join(
+                {'sum': f'SUM("{x}_sum")', 'count': f'SUM("{x}_count")',
+                 'mean': f'SUM("{x}_sum") * 1.0 / SUM("{x}_count")'}[agg]
+                + f' AS "{x}"' for x in values)
+        else:
+            aggs = ', '.join(f'{AGGS[agg]}("{x}") AS "{x}"' for x in values)
+        group = _quote(by)
+        where_sql, params = self._where(where)
+        sql = f'SELECT {group + ", " if by else ""}{aggs} FROM "{table}"' \
+            f'{where_sql}'
+        if by:
+            sql += f' GROUP BY {group} ORDER BY {group}'
+        return self.query(sql, params)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sql', nargs='?', help='query to run')
+    args = parser.parse_args()
+    db = FlowDB()
+    if args.sql:
+        print(db.query(args.sql).to_string())
+    else:
+        print(db.tables())
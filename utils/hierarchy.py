@@ -0,0 +1,96 @@
+"""Roll dyadic values up the location hierarchy with sparse matrices.
+
+Each location level (country, region, subregion, midregion) gets an
+indicator matrix mapping countries to groups. A dyadic quantity F
+(origin country x destination country) is aggregated to any pair of levels,
+including mixed ones like country origin x region destination, as
+A @ F @ B.T where A and B are the indicator matrices of the two levels.
+"""
+import numpy as np
+import pandas as pd
+
+from utils.lazy import lazy_import
+from utils.misc import get_location_hierarchy
+
+sparse = lazy_import('scipy.sparse')
+
+LEVELS = ['country', 'region', 'subregion', 'midregion']
+
+# UNSD puts Cyprus in Western Asia, for European plots it goes with the
+# south (cyp_hack), pass these to LocationHierarchy where that's wanted
+EU_OVERRIDES = {'subregion': {'cyp': 'Southern Europe'}}
+
+
+class LocationHierarchy:
+    def __init__(self, overrides=None):
+        """overrides: {level: {iso3: group}} to move countries between
+        groups, e.g. EU_OVERRIDES, none by default."""
+        loc_df = get_location_hierarchy()
+        for level, mapping in (overrides or {}).items():
+            mapping = {k: v for k, v in mapping.items() if k in loc_df.index}
+            loc_df.loc[list(mapping), level] = list(mapping.values())
+        self.iso_idx = pd.Index(loc_df.index)
+        n = len(self.iso_idx)
+        self.indicators = {
+            'country': (self.iso_idx.values, sparse.identity(n, format='csr'))
+        }
+        for level in LEVELS[1:]:
+            codes, labels = pd.factorize(loc_df[level])
+            # countries without a group (code -1) are left out of the rollup
+            has_group = codes >= 0
+            self.indicators[level] = (labels.values, sparse.csr_matrix(
+                (np.ones(has_group.sum()),
+                 (codes[has_group], np.flatnonzero(has_group))),
+                shape=(len(labels), n)))
+
+    def dyad_matrix(self, df, value=None):
+        """Sparse origin x destination matrix of df[value], summing duplicates.
+
+        With value=None, counts the rows for each pair instead.
+        """
+        orig = self.iso_idx.get_indexer(df['iso3_orig'])
+        dest = self.iso_idx.get_indexer(df['iso3_dest'])
+        values = np.ones(len(df)) if value is None \
+            else df[value].values.astype(float)
+        keep = (orig >= 0) & (dest >= 0) & ~np.isnan(values)
+        n = len(self.iso_idx)
+        return sparse.csr_matrix(
+            (values[keep], (orig[keep], dest[keep])), shape=(n, n))
+
+    def rollup(self, df, values, orig_level, dest_level=None):
+        """Sum dyadic values to (orig_level, dest_level) pairs.
+
+        Returns a long dataframe with {orig_level}_orig, {dest_level}_dest
+        and one column per value, for group pairs with at least one dyad.
+        """
+        dest_level = orig_level if dest_level is None else dest_level
+        orig_labels, A = self.indicators[orig_level]
+        dest_labels, B = self.indicators[dest_level]
+        counts = A @ self.dyad_matrix(df) @ B.T
+        rows, cols = counts.nonzero()
+        out = pd.DataFrame({
+            f'{orig_level}_orig': orig_labels[rows],
+            f'{dest_level}_dest': dest_labels[cols]})
+        for value in values:
+            summed = A @ self.dyad_matrix(df, value) @ B.T
+            out[value] = np.asarray(summed[rows, cols]).ravel()
+        return out
+
+    def rollup_all(self, df, values, levels=LEVELS):
+        """Rollups for every (origin level, destination level) combination."""
+        F = {value: self.dyad_matrix(df, value) for value in values}
+        counts = self.dyad_matrix(df)
+        out = {}
+        for orig_level in levels:
+            orig_labels, A = self.indicators[orig_level]
+            for dest_level in levels:
+                dest_labels, B = self.indicators[dest_level]
+                rows, cols = (A @ counts @ B.T).nonzero()
+                level_df = pd.DataFrame({
+                    f'{orig_level}_orig': orig_labels[rows],
+                    f'{dest_level}_dest': dest_labels[cols]})
+                for value, matrix in F.items():
+                    level_df[value] = np.asarray(
+                        (A @ matrix @ B.T)[rows, cols]).ravel()
+                out[(orig_level, dest_level)] = level_df
+        return out
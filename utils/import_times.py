@@ -0,0 +1,68 @@
+"""Import time of each command line entry point.
+
+Each module is imported in a fresh interpreter with python -X importtime,
+and the time spent in every module it pulls in is summed per top level
+package, e.g. to see whether a cron job starts by loading matplotlib it
+never uses.
+
+    python utils/import_times.py                 # all of ENTRY_POINTS
+    python utils/import_times.py etl.ingest -n 5
+"""
+import argparse
+import subprocess
+import sys
+from os import path
+
+import pandas as pd
+
+ENTRY_POINTS = [
+    'etl.prep_bilateral_flows', 'etl.prep_total_users_dest', 'etl.ingest',
+    'etl.distance', 'model.trends', 'model.forecast', 'model.gravity_model',
+    'model.launch_model', 'model.scenarios', 'utils.network',
+    'utils.query_api',
+    'viz.static_plots', 'viz.heatmap_gravity_model', 'viz.flows_time_series']
+HEAVY = ['matplotlib', 'seaborn', 'statsmodels', 'scipy', 'pycountry']
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def import_times(module):
+    """Seconds spent importing each top level package when importing
+    module, None if the import fails (e.g. a missing dependency)."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True)
+    if result.returncode:
+        print(f"{module}: {result.stderr.strip().splitlines()[-1]}")
+        return None
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        # own time of each module, nested imports are counted separately
+        package = name.strip().split('.')[0]
+        times[package] = times.get(package, 0) + int(own) / 1e6
+    return pd.Series(times)
+
+
+def main(modules, n_top):
+    rows = []
+    for module in modules:
+        times = import_times(module)
+        if times is None:
+            continue
+        rows.append({
+            'module': module, 'seconds': times.sum(),
+            'heavy': ', '.join(x for x in HEAVY if x in times),
+            'slowest': ', '.join(
+                f"{k} {v:.2f}" for k, v in times.nlargest(n_top).items())})
+    print(pd.DataFrame(rows).set_index('module').round(2).to_string())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS)
+    parser.add_argument('-n', dest='n_top', type=int, default=3,
+                        help='number of slowest packages to show')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -2,10 +2,14 @@
 from os import mkdir, path
 from datetime import datetime
 from configurator import Config
+from utils.database import FlowDB
 
 
-def save_output(df, filename, subdir='processed', archive=True):
-    """Auto archive output saving."""
+def save_output(df, filename, subdir='processed', archive=True, db=False):
+    """Auto archive output saving.
+
+    With db=True, processed outputs also go to the embedded database.
+    """
     config = Config()
     active_dir = config['directories.data'][subdir]
     df.to_csv(path.join(active_dir, f'{filename}.csv'), index=False)
@@ -16,3 +20,6 @@ def save_output(df, filename, subdir='processed', archive=True):
             mkdir(archive_dir)
         df.to_csv(
             path.join(archive_dir, f'{filename}_{today}.csv'), index=False)
+    if db:
+        assert subdir == 'processed', "Only processed outputs go in the db"
+        FlowDB().write(df, filename)
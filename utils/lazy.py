@@ -0,0 +1,34 @@
+"""Import heavy packages on first use instead of at import time.
+
+    stats = lazy_import('scipy.stats')
+    ...
+    stats.t.sf(x, df)   # scipy.stats is imported here
+
+so e.g. a cron job that only needs pandas doesn't pay for scipy, seaborn or
+statsmodels because a module it imports uses them somewhere. Only whole
+modules can be lazy: use stats.variation rather than
+from scipy.stats import variation.
+
+    python utils/import_times.py   # import time of each entry point
+"""
+import importlib
+import sys
+
+
+class LazyModule:
+    """Stands in for a module until one of its attributes is used."""
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        # after the first call import_module is a sys.modules lookup
+        return getattr(importlib.import_module(self.__name), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self.__name}>"
+
+
+def lazy_import(name):
+    """The module if it's already imported, otherwise a LazyModule."""
+    return sys.modules.get(name) or LazyModule(name)
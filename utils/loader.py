@@ -0,0 +1,57 @@
+"""Run independent data loading functions concurrently.
+
+Sources are {name: (function, [names of sources it needs])}. Every source
+starts as soon as the ones it needs are done, and gets their results as
+positional arguments in that order, e.g.
+
+    load_sources({
+        'cepii': (read_cepii_distance, []),
+        'maciej': (read_maciej_distance, []),
+        'geo': (prep_geo, ['cepii', 'maciej']),
+        'gdp': (prep_gdp, [])})
+
+Parsing is mostly pure Python or holds the GIL (openpyxl, converters), so
+sources run in a process pool by default.
+"""
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                 ThreadPoolExecutor, wait)
+from time import perf_counter
+
+import pandas as pd
+
+
+def _timed(func, *args):
+    start = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - start
+
+
+def load_sources(sources, n_jobs=None, processes=True, verbose=True):
+    """Return {name: result} of every source, printing timings if verbose."""
+    unknown = {d for _, deps in sources.values() for d in deps} - set(sources)
+    assert not unknown, f"Unknown sources {unknown}"
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    results, timings, running = {}, {}, {}
+    start = perf_counter()
+    # one worker per source by default, so every source can start at once
+    with executor(n_jobs or len(sources)) as pool:
+        while len(results) < len(sources):
+            for name, (func, deps) in sources.items():
+                if name not in results and name not in running.values() \
+                        and all(d in results for d in deps):
+                    future = pool.submit(
+                        _timed, func, *[results[d] for d in deps])
+                    running[future] = name
+            assert running, \
+                f"Circular dependencies in {set(sources) - set(results)}"
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], seconds = future.result()
+                timings[name] = (seconds, perf_counter() - start)
+    if verbose:
+        print(pd.DataFrame(
+            timings, index=['seconds', 'done_at']).T.sort_values('done_at')
+            .round(2).to_string(),
+            f"\nwall time {perf_counter() - start:.2f}s")
+    return results
@@ -1,8 +1,11 @@
 """Miscellaneous"""
 from os import path
+import numpy as np
 import pandas as pd
-from pycountry import countries, historic_countries
 from configurator import Config
+from utils.lazy import lazy_import
+
+pycountry = lazy_import('pycountry')
 
 
 def custom_round(n):
@@ -37,16 +40,53 @@ def get_location_hierarchy():
         how='left').set_index('iso3')
 
 
+def prep_eu_states():
+    """Flag eu, eurozone, schengen member countries.
+
+    Data pulled from europa.eu
+    """
+    config = Config()
+    return pd.read_csv(
+        path.join(config['directories.data']['raw'], 'eu_countries.csv'),
+        converters={'country': lambda x: pycountry.countries.get(
+            name=x).alpha_3.lower()}
+    ).set_index('country')
+
+
+def cyp_hack(df):
+    """Change subregion for Cyprus to Southern Europe."""
+    df.loc[df['iso3_orig'] == 'cyp', 'subregion_orig'] = 'Southern Europe'
+    df.loc[df['iso3_dest'] == 'cyp', 'subregion_dest'] = 'Southern Europe'
+    assert set(df['subregion_orig']) == set(
+        ['Southern Europe', 'Eastern Europe', 'Western Europe', 'Northern Europe'])
+    return df
+
+
+def fix_query_date(df, cutoff=np.timedelta64(10, 'D')):
+    """Adjust date of data collection for timeout errors."""
+    dates = sorted([np.datetime64(x) for x in df['query_date'].unique()])
+    combine_dates = {
+        str(dates[n + 1]): str(dates[n])
+        for n in range(0, len(dates) - 1) if dates[n+1] - dates[n] < cutoff}
+    df = df.replace(combine_dates)
+    # while we're here... let's add another column
+    new_dates = sorted([np.datetime64(x) for x in df['query_date'].unique()])
+    midpoint = np.datetime64(new_dates[round(len(new_dates) / 2)])
+    df['date_centered'] = df['query_date'].apply(
+        lambda x: (np.datetime64(x) - midpoint).astype(int))
+    return df.drop(['date_centered'], axis=1)
+
+
 def iso2_to_iso3(x):
     """Helper function to get iso3 from iso2."""
     # sometimes x is Null to begin with, this f'n doesn't need to care
     if x:
         iso3 = None
         try:
-            iso3 = countries.get(alpha_2=x).alpha_3
+            iso3 = pycountry.countries.get(alpha_2=x).alpha_3
         except AttributeError:
             try:
-                iso3 = historic_countries.get(alpha_2=x).alpha_3
+                iso3 = pycountry.historic_countries.get(alpha_2=x).alpha_3
             except AttributeError:
                 try:
                     # kosovo
@@ -79,13 +119,13 @@ def name_to_iso3(x, verbose=False):
     }
     iso3 = None
     try:
-        iso3 = countries.get(name=x).alpha_3
+        iso3 = pycountry.countries.get(name=x).alpha_3
     except AttributeError:
         try:
-            iso3 = countries.get(common_name=x).alpha_3
+            iso3 = pycountry.countries.get(common_name=x).alpha_3
         except AttributeError:
             try:
-                iso3 = historic_countries.get(name=x).alpha_3
+                iso3 = pycountry.historic_countries.get(name=x).alpha_3
             except AttributeError:
                 try:
                     iso3 = manual_dict[x]
@@ -93,7 +133,7 @@ def name_to_iso3(x, verbose=False):
                     try:
                         if verbose:
                             print(f'searching for {x}')
-                            print(countries.search_fuzzy(x))
+                            print(pycountry.countries.search_fuzzy(x))
                     except LookupError:
                         if verbose:
                             print(f'iso3 for {x} not found')
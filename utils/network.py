@@ -0,0 +1,142 @@
+"""Network metrics of the origin -> destination graph of each query date.
+
+The graphs of all dates go into one block diagonal sparse matrix, one block
+per date (rows and columns are (date, country) nodes, W[i, j] the flow from
+i to j), so every metric is computed for all dates at once:
+
+strength: total flow out of / into a country, and the number of partners
+pagerank: stationary share of a random walk following the flows, with
+    teleport within the date, i.e. attractiveness weighted by how
+    attractive the origins sending people are
+reciprocity: share of a country's outflow matched by flow back,
+    sum_j min(W_ij, W_ji) / sum_j W_ij
+community: label propagation over the symmetrized shares of each country's
+    outflow, labelled by the community's largest member
+
+    python utils/network.py   # network_metrics.csv from model_input.csv
+"""
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from utils.lazy import lazy_import
+from utils.io import save_output
+
+CONFIG = Config()
+sparse = lazy_import('scipy.sparse')
+
+DAMPING = 0.85
+TOL = 1e-10
+MAX_ITER = 100
+
+
+def date_graphs(df, value_col='flow', date_col='query_date'):
+    """Return (nodes, W): DataFrame of the (date, iso3) of each node and the
+    block diagonal sparse flow matrix over them."""
+    isos = pd.Index(np.union1d(df['iso3_orig'], df['iso3_dest']))
+    dates, date_idx = pd.factorize(df[date_col], sort=True)
+    n = len(isos)
+    orig = dates * n + isos.get_indexer(df['iso3_orig'])
+    dest = dates * n + isos.get_indexer(df['iso3_dest'])
+    W = sparse.csr_matrix(
+        (df[value_col].values.astype(float), (orig, dest)),
+        shape=(n * len(date_idx), n * len(date_idx)))
+    nodes = pd.DataFrame({date_col: np.repeat(date_idx.values, n),
+                          'iso3': np.tile(isos.values, len(date_idx))})
+    return nodes, W
+
+
+def _row_normalize(W):
+    out = np.asarray(W.sum(axis=1)).ravel()
+    with np.errstate(divide='ignore'):
+        return sparse.diags(np.where(out > 0, 1 / out, 0)) @ W
+
+
+def pagerank(W, block, active, damping=DAMPING, tol=TOL, max_iter=MAX_ITER):
+    """PageRank of every node, summing to one within each block (date).
+
+    block: block of each node, active: nodes with any flow. Walkers at
+    nodes without outflow, and teleports, jump to an active node of the
+    same block.
+    """
+    P_T = _row_normalize(W).T.tocsr()
+    dangling = active & (np.asarray(W.sum(axis=1)).ravel() == 0)
+    n_active = np.bincount(block, active)
+    teleport = np.where(active, 1 / n_active[block], 0)
+    rank = teleport.copy()
+    for _ in range(max_iter):
+        lost = np.bincount(block, rank * dangling, minlength=len(n_active))
+        new = damping * (P_T @ rank) + teleport * (
+            1 - damping + damping * lost[block])
+        done = np.abs(new - rank).max() < tol
+        rank = new
+        if done:
+            break
+    return rank
+
+
+def reciprocity(W):
+    """Share of each node's outflow matched by flow back."""
+    out = np.asarray(W.sum(axis=1)).ravel()
+    matched = np.asarray(W.minimum(W.T).sum(axis=1)).ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(out > 0, matched / out, np.nan)
+
+
+def label_propagation(A, max_iter=MAX_ITER, seed=0):
+    """Community label of each node of the symmetric weight matrix A.
+
+    Each round a random half of the nodes take the label with the most
+    weight among their neighbors (synchronous updates of all nodes can
+    oscillate). Stops when no label changes.
+    """
+    n = A.shape[0]
+    labels = np.arange(n)
+    has_edges = np.diff(A.indptr) > 0
+    rng = np.random.default_rng(seed)
+    unchanged = 0
+    for _ in range(max_iter):
+        onehot = sparse.csr_matrix(
+            (np.ones(n), (np.arange(n), labels)), shape=(n, n))
+        best = np.asarray((A @ onehot).argmax(axis=1)).ravel()
+        move = has_edges & (rng.random(n) < 0.5)
+        new = np.where(move, best, labels)
+        unchanged = unchanged + 1 if (new == labels).all() else 0
+        labels = new
+        # two quiet rounds in a row, so nodes skipped by the coin flip agree
+        if unchanged == 2:
+            break
+    return labels
+
+
+def network_metrics(df, value_col='flow', date_col='query_date'):
+    """Per country and date network metrics of the flows in df."""
+    nodes, W = date_graphs(df, value_col, date_col)
+    block = pd.factorize(nodes[date_col])[0]
+    out_strength = np.asarray(W.sum(axis=1)).ravel()
+    in_strength = np.asarray(W.sum(axis=0)).ravel()
+    active = (out_strength > 0) | (in_strength > 0)
+    shares = _row_normalize(W)
+    communities = label_propagation((shares + shares.T).tocsr())
+    metrics = nodes.assign(
+        out_strength=out_strength, in_strength=in_strength,
+        net_strength=in_strength - out_strength,
+        out_degree=np.diff(W.indptr), in_degree=np.diff(W.tocsc().indptr),
+        pagerank=pagerank(W, block, active),
+        reciprocity=reciprocity(W), community=communities)[active]
+    # name each community after its member with the most flow
+    biggest = metrics.assign(
+        total=metrics['out_strength'] + metrics['in_strength']
+    ).sort_values('total').groupby('community')['iso3'].last()
+    return metrics.assign(
+        community=metrics['community'].map(biggest),
+        community_size=metrics.groupby('community')['iso3'].transform(
+            'size')
+    ).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    network_metrics(pd.read_csv(
+        f"{CONFIG['directories.data']['processed']}/model_input.csv",
+        usecols=['iso3_orig', 'iso3_dest', 'query_date', 'flow'])
+    ).pipe(save_output, 'network_metrics')
@@ -0,0 +1,239 @@
+"""Local HTTP/JSON service for looking up processed flows.
+
+Loads model_input, variance, variance_recip_pairs and the best model's
+output once, with a hash index (value -> row positions) on the id columns,
+and answers GET requests:
+
+    /tables                         table names, columns and row counts
+    /rows/<table>?<filters>         matching rows
+    /aggregate/<table>?by=..&value=..&agg=sum&<filters>
+    /pair_series?orig=deu&dest=fra  flow of one pair over time
+    /top_origins?dest=deu&k=10      largest origins for a destination
+    /regional_totals?level=region   flows summed to region pairs by date
+
+Filters are column=value (comma separated for several values) on indexed
+columns. Results are cached, and every endpoint pages its rows with
+limit and offset (default limit PAGE_SIZE). Start it with
+
+    python utils/query_api.py --port 8060
+
+and use utils.query_client.FlowClient to query it.
+"""
+import argparse
+import json
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from urllib.parse import parse_qsl, urlparse
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from model.registry import ModelRegistry
+from utils.database import INDEX_COLUMNS
+
+CONFIG = Config()
+
+TABLES = ['model_input', 'variance', 'variance_recip_pairs']
+AGGS = ['sum', 'mean', 'median', 'min', 'max', 'count']
+PAGE_SIZE = 1000
+CACHE_SIZE = 256
+
+
+class QueryError(Exception):
+    pass
+
+
+class NotFound(QueryError):
+    pass
+
+
+def _key(x):
+    """Index key of a value, the same for 1, 1.0, '1' and '1.0' since e.g.
+    recip comes back from csv as a float but arrives in queries as '1'."""
+    try:
+        number = float(x)
+    except (TypeError, ValueError):
+        return str(x)
+    return str(int(number)) if number.is_integer() else str(number)
+
+
+class FlowStore:
+    """Processed tables held in memory with hash indexes on id columns."""
+
+    def __init__(self, tables=None):
+        self.tables = load_tables() if tables is None else tables
+        self.indexes = {
+            name: {col: {_key(k): v for k, v in
+                         df.groupby(col, sort=False).indices.items()}
+                   for col in INDEX_COLUMNS if col in df.columns}
+            for name, df in self.tables.items()}
+
+    def _table(self, table):
+        if table not in self.tables:
+            raise NotFound(f"Unknown table {table}")
+        return self.tables[table]
+
+    def select(self, table, filters):
+        """Rows of table matching all filters, {column: [values]}."""
+        df = self._table(table)
+        rows = None
+        for col, values in filters.items():
+            if col not in self.indexes[table]:
+                raise QueryError(f"Can't filter {table} on {col}, indexed "
+                                 f"columns are {list(self.indexes[table])}")
+            index = self.indexes[table][col]
+            # positions from groupby().indices are sorted
+            match = np.unique(np.concatenate(
+                [index.get(_key(x), np.array([], dtype=int))
+                 for x in values]))
+            rows = match if rows is None else np.intersect1d(
+                rows, match, assume_unique=True)
+        return df if rows is None else df.iloc[rows]
+
+    def aggregate(self, table, filters, by, value, agg='sum'):
+        if agg not in AGGS:
+            raise QueryError(f"agg must be one of {AGGS}")
+        df = self.select(table, filters)
+        missing = set(by + [value]) - set(df.columns)
+        if missing:
+            raise QueryError(f"{table} has no columns {sorted(missing)}")
+        return df.groupby(by, as_index=False)[value].agg(agg)
+
+    def pair_series(self, orig, dest, value='flow'):
+        return self.select(
+            'model_input', {'iso3_orig': [orig], 'iso3_dest': [dest]}
+        )[['query_date', value]].sort_values('query_date')
+
+    def top_origins(self, dest, k=10, value='flow', query_date=None):
+        """Largest origins for dest, median over dates unless one is given."""
+        filters = {'iso3_dest': [dest]}
+        if query_date is not None:
+            filters['query_date'] = [query_date]
+        return self.aggregate(
+            'model_input', filters, ['iso3_orig'], value, 'median'
+        ).nlargest(k, value)
+
+    def regional_totals(self, level='region', value='flow', filters=None):
+        return self.aggregate(
+            'model_input', filters or {},
+            [f'{level}_orig', f'{level}_dest', 'query_date'], value, 'sum')
+
+
+def test_numeric_filters():
+    store = FlowStore({'t': pd.DataFrame(
+        {'recip': [1.0, 0.0, 1.0], 'query_date': ['2021-03-01'] * 3})})
+    # this should match the two recip == 1.0 rows
+    assert len(store.select('t', {'recip': ['1']})) == 2
+    assert len(store.select('t', {'recip': ['1.0']})) == 2
+    assert len(store.select('t', {'query_date': ['2021-03-01']})) == 3
+
+
+def load_tables():
+    processed = CONFIG['directories.data']['processed']
+    tables = {name: pd.read_csv(f"{processed}/{name}.csv")
+              for name in TABLES if path.exists(f"{processed}/{name}.csv")}
+    best = ModelRegistry().find(best=1)
+    if len(best) == 1:
+        best = best.iloc[0]
+        tables['model'] = pd.read_csv(
+            f"{CONFIG['directories.data']['model']}/"
+            f"{best['description']}-{best['version_id']}.csv")
+    return tables
+
+
+def _split(params, key, default=None):
+    return params.pop(key).split(',') if key in params else default
+
+
+def _filters(params):
+    return {k: v.split(',') for k, v in params.items()}
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _run(store, route, query):
+    """DataFrame answering one request, cached on the request minus paging."""
+    params = dict(query)
+    if not route:
+        raise NotFound("Unknown endpoint /")
+    if route[0] in ['rows', 'aggregate'] and len(route) != 2:
+        raise NotFound(f"Use /{route[0]}/<table>")
+    if route[0] == 'rows':
+        columns = _split(params, 'columns')
+        df = store.select(route[1], _filters(params))
+        return df if columns is None else df[columns]
+    if route[0] == 'aggregate':
+        by, value = _split(params, 'by', []), params.pop('value', 'flow')
+        agg = params.pop('agg', 'sum')
+        return store.aggregate(route[1], _filters(params), by, value, agg)
+    if route[0] == 'pair_series':
+        return store.pair_series(
+            params['orig'], params['dest'], params.get('value', 'flow'))
+    if route[0] == 'top_origins':
+        return store.top_origins(
+            params['dest'], int(params.get('k', 10)),
+            params.get('value', 'flow'), params.get('query_date'))
+    if route[0] == 'regional_totals':
+        level = params.pop('level', 'region')
+        value = params.pop('value', 'flow')
+        return store.regional_totals(level, value, _filters(params))
+    raise NotFound(f"Unknown endpoint /{'/'.join(route)}")
+
+
+def make_handler(store):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            body = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            route = tuple(x for x in url.path.split('/') if x)
+            params = dict(parse_qsl(url.query))
+            if route == ('tables',):
+                return self._send(200, json.dumps({
+                    name: {'columns': list(df.columns), 'rows': len(df),
+                           'indexed': list(store.indexes[name])}
+                    for name, df in store.tables.items()}))
+            try:
+                limit = int(params.pop('limit', PAGE_SIZE))
+                offset = int(params.pop('offset', 0))
+                df = _run(store, route, tuple(sorted(params.items())))
+            except NotFound as e:
+                return self._send(404, json.dumps({'error': str(e)}))
+            except KeyError as e:
+                return self._send(400, json.dumps(
+                    {'error': f"Missing parameter or column {e}"}))
+            except (QueryError, ValueError) as e:
+                return self._send(400, json.dumps({'error': str(e)}))
+            page = df.iloc[offset:offset + limit]
+            next_offset = offset + limit if offset + limit < len(df) else None
+            self._send(200, (
+                f'{{"total": {len(df)}, "offset": {offset}, '
+                f'"next_offset": {json.dumps(next_offset)}, '
+                f'"rows": {page.to_json(orient="records")}}}'))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(host='127.0.0.1', port=8060, store=None):
+    store = FlowStore() if store is None else store
+    server = ThreadingHTTPServer((host, port), make_handler(store))
+    print(f"Serving {list(store.tables)} on http://{host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8060)
+    args = parser.parse_args()
+    serve(args.host, args.port)
@@ -0,0 +1,66 @@
+"""Client for the local flow query service (utils/query_api.py).
+
+In a notebook, instead of reading a whole csv to look up a few pairs:
+
+    from utils.query_client import FlowClient
+    client = FlowClient()
+    df = client.read_table('model_input', iso3_dest='deu', query_date=...)
+    client.pair_series('deu', 'fra')
+    client.top_origins('deu', k=10)
+
+Every method returns a DataFrame, fetching all pages of the result.
+"""
+import json
+from urllib.error import HTTPError
+from urllib.parse import quote, urlencode
+from urllib.request import urlopen
+
+import pandas as pd
+
+
+class FlowClient:
+    def __init__(self, url='http://127.0.0.1:8060', page_size=10000):
+        self.url = url.rstrip('/')
+        self.page_size = page_size
+
+    def _get_json(self, endpoint, params):
+        url = f"{self.url}/{quote(endpoint)}?{urlencode(params)}"
+        try:
+            with urlopen(url) as response:
+                return json.load(response)
+        except HTTPError as e:
+            raise ValueError(json.load(e)['error']) from None
+
+    def _get(self, endpoint, **params):
+        # lists become comma separated values, None means no filter
+        params = {k: ','.join(map(str, v)) if isinstance(v, (list, tuple))
+                  else v for k, v in params.items() if v is not None}
+        params['limit'] = self.page_size
+        rows, offset = [], 0
+        while offset is not None:
+            page = self._get_json(endpoint, {**params, 'offset': offset})
+            rows += page['rows']
+            offset = page['next_offset']
+        return pd.DataFrame(rows)
+
+    def tables(self):
+        return self._get_json('tables', {})
+
+    def read_table(self, table, columns=None, **filters):
+        """Rows of table, filtered on indexed columns, like pd.read_csv."""
+        return self._get(f'rows/{table}', columns=columns, **filters)
+
+    def aggregate(self, table, by, value='flow', agg='sum', **filters):
+        return self._get(f'aggregate/{table}', by=by, value=value, agg=agg,
+                         **filters)
+
+    def pair_series(self, orig, dest, value='flow'):
+        return self._get('pair_series', orig=orig, dest=dest, value=value)
+
+    def top_origins(self, dest, k=10, value='flow', query_date=None):
+        return self._get('top_origins', dest=dest, k=k, value=value,
+                         query_date=query_date)
+
+    def regional_totals(self, level='region', value='flow', **filters):
+        return self._get('regional_totals', level=level, value=value,
+                         **filters)
@@ -0,0 +1,325 @@
+"""Interactive dashboard of flows and gravity model residuals.
+
+Aggregates are precomputed by build_aggregates (run with --build, or
+automatically the first time) into two tables in the processed data
+directory: flows by origin, destination and date, and observed vs fitted
+flows from the best model, both at every location level. The app only
+filters those tables. Figures are memoized per selection with an LRU
+cache, and each view caps how much it sends to the browser (top partners,
+top locations, top links, a sample of points).
+
+Everything, plotly.js included, is served by the app itself, so it runs on
+a cluster node without internet access, e.g.
+
+    python viz/dashboard.py --host 0.0.0.0 --port 8050
+
+For many users, run create_server under a multi-worker WSGI server, e.g.
+gunicorn -w 4 'viz.dashboard:create_server()', each worker has its own
+cache.
+"""
+import argparse
+import warnings
+from functools import lru_cache
+from os import path
+
+import dash
+import dash_core_components as dcc
+import dash_html_components as html
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from dash.dependencies import Input, Output, State
+
+from configurator import Config
+from model.registry import ModelRegistry
+from utils.hierarchy import LEVELS, LocationHierarchy
+from utils.io import save_output
+from viz.heatmap_gravity_model import (
+    aggregate_locations, fitted_flows, get_best_model)
+
+CONFIG = Config()
+
+# caps on what one figure sends to the browser
+MAX_PARTNERS = 10
+MAX_HEATMAP = 50
+MAX_LINKS = 40
+MAX_POINTS = 2000
+CACHE_SIZE = 512
+
+VIEWS = {
+    'time_series': 'Time series', 'heatmap': 'Heatmap',
+    'chord': 'Chord (top links)', 'resid_scatter': 'Observed vs fitted',
+    'resid_heatmap': 'Residual quintiles'}
+
+
+def _aggregate_file(name):
+    return f"{CONFIG['directories.data']['processed']}/dashboard_{name}.csv"
+
+
+def build_aggregates():
+    """Save flows and model residuals summed to every location level."""
+    hierarchy = LocationHierarchy()
+    df = pd.read_csv(
+        f"{CONFIG['directories.data']['processed']}/model_input.csv",
+        usecols=['iso3_orig', 'iso3_dest', 'query_date', 'flow'])
+    flows = []
+    for level in LEVELS:
+        for date, date_df in df.groupby('query_date'):
+            flows.append(hierarchy.rollup(date_df, ['flow'], level).set_axis(
+                ['orig', 'dest', 'flow'], axis=1).assign(
+                    level=level, query_date=date))
+    save_output(pd.concat(flows, ignore_index=True), 'dashboard_flows',
+                archive=False)
+    model_df, version = get_best_model(), ModelRegistry().best()
+    resids = [model_df.assign(
+        orig=model_df['iso3_orig'], dest=model_df['iso3_dest'],
+        observed=model_df['flow_median'],
+        fitted=fitted_flows(model_df, version), level='country')]
+    for level in LEVELS[1:]:
+        level_df = aggregate_locations(model_df, level, hierarchy, version)
+        resids.append(level_df.assign(
+            orig=level_df['region_orig'], dest=level_df['region_dest'],
+            observed=level_df['flow_median'], fitted=level_df['.fitted'],
+            level=level))
+    resids = pd.concat(resids, ignore_index=True)[
+        ['level', 'orig', 'dest', 'observed', 'fitted']]
+    resids['pct_error'] = (resids['observed'] / resids['fitted'] - 1) * 100
+    resids['quintile'] = resids.groupby('level')['pct_error'].transform(
+        lambda x: pd.qcut(x, 5, labels=False) + 1)
+    save_output(resids, 'dashboard_resids', archive=False)
+
+
+def load_aggregates():
+    """Return flows (pairs x dates, one frame per level), residuals by level
+    and the collection dates."""
+    if not all(path.exists(_aggregate_file(x)) for x in ['flows', 'resids']):
+        build_aggregates()
+    flows = pd.read_csv(_aggregate_file('flows'))
+    resids = pd.read_csv(_aggregate_file('resids'))
+    dates = sorted(flows['query_date'].unique())
+    return ({level: df.pivot_table(
+                'flow', ['orig', 'dest'], 'query_date').reindex(
+                    columns=dates).sort_index()
+             for level, df in flows.groupby('level')},
+            {level: df.drop(columns='level')
+             for level, df in resids.groupby('level')},
+            dates)
+
+
+FLOWS, RESIDS, DATES = {}, {}, []
+
+
+def _sig(values, digits=4):
+    """Round to significant digits, keeps the json payloads small."""
+    return [float(f'{x:.{digits}g}') for x in np.asarray(values, dtype=float)]
+
+
+def _dates(date_range):
+    return slice(date_range[0], date_range[1] + 1)
+
+
+def _other(direction):
+    return 'dest' if direction == 'orig' else 'orig'
+
+
+def _median_flows(level, date_range):
+    wide = FLOWS[level].iloc[:, _dates(date_range)]
+    with warnings.catch_warnings():
+        # pairs missing on every selected date
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(wide.values, axis=1)
+    return wide.index.to_frame(index=False).assign(flow=median).dropna()
+
+
+def time_series(level, location, direction, date_range):
+    wide = FLOWS[level]
+    if location not in wide.index.get_level_values(direction):
+        return go.Figure()
+    wide = wide.xs(location, level=direction).iloc[:, _dates(date_range)]
+    top = wide.sum(axis=1).nlargest(MAX_PARTNERS).index
+    fig = go.Figure()
+    for name, flows in wide.loc[top].iterrows():
+        flows = flows.dropna()
+        fig.add_trace(go.Scatter(
+            x=flows.index.tolist(), y=_sig(flows), mode='lines+markers',
+            name=name))
+    verb = 'from' if direction == 'orig' else 'to'
+    fig.update_layout(
+        title=f'Top {len(top)} partners, users {verb} {location}',
+        xaxis_title='Date of Data Collection',
+        yaxis_title='Users open to relocating')
+    return fig
+
+
+def _matrix_heatmap(df, value, title, colorscale, zmid=None):
+    totals = df.groupby('dest')['observed' if value == 'quintile'
+                                else value].sum()
+    top = totals.nlargest(MAX_HEATMAP).index
+    matrix = df[df['orig'].isin(top) & df['dest'].isin(top)].pivot_table(
+        value, 'orig', 'dest').reindex(index=top, columns=top)
+    z = [[None if np.isnan(x) else x for x in _sig(row)]
+         for row in matrix.values]
+    fig = go.Figure(go.Heatmap(
+        z=z, x=list(top), y=list(top), colorscale=colorscale, zmid=zmid,
+        hoverongaps=False))
+    fig.update_layout(
+        title=title, xaxis_title='Destination', yaxis_title='Origin',
+        yaxis_autorange='reversed')
+    return fig
+
+
+def heatmap(level, date_range):
+    return _matrix_heatmap(
+        _median_flows(level, date_range), 'flow',
+        f'Median flow, top {MAX_HEATMAP} destinations', 'Viridis')
+
+
+def chord(level, location, direction, date_range):
+    df = _median_flows(level, date_range)
+    if level != 'country':
+        df = df[df['orig'] != df['dest']]
+    df = df.nlargest(MAX_LINKS, 'flow')
+    origs, dests = list(df['orig'].unique()), list(df['dest'].unique())
+    # origins on the left, destinations on the right
+    labels = origs + dests
+    colors = ['rgba(31,119,180,0.6)' if x == location else
+              'rgba(160,160,160,0.4)' for x in df[direction]]
+    fig = go.Figure(go.Sankey(
+        node={'label': labels, 'pad': 10},
+        link={'source': [origs.index(x) for x in df['orig']],
+              'target': [len(origs) + dests.index(x) for x in df['dest']],
+              'value': _sig(df['flow']), 'color': colors}))
+    fig.update_layout(title=f'Top {len(df)} links by median flow')
+    return fig
+
+
+def resid_scatter(level, location, direction):
+    df = RESIDS[level]
+    selected = df[direction] == location
+    # always keep the selected location, sample the rest
+    rest = df[~selected]
+    if len(rest) > MAX_POINTS:
+        rest = rest.sample(MAX_POINTS, random_state=0)
+    fig = go.Figure()
+    for name, part, color in [('other pairs', rest, 'lightgray'),
+                              (location, df[selected], 'crimson')]:
+        fig.add_trace(go.Scattergl(
+            x=_sig(part['fitted']), y=_sig(part['observed']), mode='markers',
+            name=name, marker={'color': color, 'size': 5},
+            text=(part['orig'] + ' → ' + part['dest']).tolist(),
+            hovertemplate='%{text}<br>fitted %{x}<br>observed %{y}'))
+    fig.update_layout(
+        title='Observed vs fitted flows, best model',
+        xaxis={'title': 'Fitted', 'type': 'log'},
+        yaxis={'title': 'Observed', 'type': 'log'})
+    return fig
+
+
+def resid_heatmap(level):
+    return _matrix_heatmap(
+        RESIDS[level], 'quintile', 'Quintiles of percentage error',
+        'RdBu_r', zmid=3)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def get_figure(view, level, location, direction, date_range):
+    """Figure (as a dict) for one selection, memoized."""
+    if view == 'time_series':
+        fig = time_series(level, location, direction, date_range)
+    elif view == 'heatmap':
+        fig = heatmap(level, date_range)
+    elif view == 'chord':
+        fig = chord(level, location, direction, date_range)
+    elif view == 'resid_scatter':
+        fig = resid_scatter(level, location, direction)
+    else:
+        fig = resid_heatmap(level)
+    fig.update_layout(template='plotly_white', height=700)
+    return fig.to_dict()
+
+
+@lru_cache(maxsize=None)
+def location_options(level):
+    index = FLOWS[level].index
+    locations = sorted(set(index.levels[0]) | set(index.levels[1]))
+    return [{'label': x, 'value': x} for x in locations]
+
+
+def _selector(label, component):
+    return html.Div([html.Label(label), component],
+                    style={'flex': 1, 'padding': '0 10px'})
+
+
+def make_app():
+    app = dash.Dash(__name__, serve_locally=True)
+    app.title = 'LinkedIn flows'
+    app.layout = html.Div([
+        html.H2('Users open to relocating'),
+        html.Div([
+            _selector('View', dcc.Dropdown(
+                id='view', value='time_series', clearable=False,
+                options=[{'label': v, 'value': k} for k, v in VIEWS.items()])),
+            _selector('Location level', dcc.Dropdown(
+                id='level', value='country', clearable=False,
+                options=[{'label': x, 'value': x} for x in LEVELS])),
+            _selector('Location', dcc.Dropdown(
+                id='location', clearable=False)),
+            _selector('Direction', dcc.RadioItems(
+                id='direction', value='orig',
+                options=[{'label': 'Origin', 'value': 'orig'},
+                         {'label': 'Destination', 'value': 'dest'}])),
+        ], style={'display': 'flex'}),
+        html.Div(dcc.RangeSlider(
+            id='dates', min=0, max=len(DATES) - 1,
+            value=[0, len(DATES) - 1],
+            marks={i: x for i, x in enumerate(DATES)}),
+            style={'padding': '20px 10px'}),
+        dcc.Loading(dcc.Graph(id='figure', config={'displaylogo': False})),
+    ], style={'fontFamily': 'sans-serif', 'margin': '0 20px'})
+
+    @app.callback(Output('location', 'options'), Output('location', 'value'),
+                  Input('level', 'value'), State('location', 'value'))
+    def update_locations(level, location):
+        options = location_options(level)
+        values = [x['value'] for x in options]
+        return options, location if location in values else values[0]
+
+    @app.callback(Output('figure', 'figure'),
+                  Input('view', 'value'), Input('level', 'value'),
+                  Input('location', 'value'), Input('direction', 'value'),
+                  Input('dates', 'value'))
+    def update_figure(view, level, location, direction, dates):
+        if location is None:
+            return dash.no_update
+        return get_figure(view, level, location, direction, tuple(dates))
+
+    return app
+
+
+def create_server():
+    """Load the aggregates and return the flask server of the app."""
+    flows, resids, dates = load_aggregates()
+    FLOWS.update(flows)
+    RESIDS.update(resids)
+    DATES[:] = dates
+    return make_app().server
+
+
+def main(host, port, debug, build):
+    if build:
+        build_aggregates()
+    create_server().run(host=host, port=port, debug=debug, threaded=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help="use 0.0.0.0 to serve to the local network, e.g. from a node "
+             "of the gwdg cluster")
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument(
+        '--build', action='store_true', help='recompute the aggregates first')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -1,15 +1,15 @@
 import argparse
-from collections import defaultdict
-from os import mkdir, path
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+from os import makedirs, path
 import pandas as pd
-from datetime import datetime
-import seaborn as sns
 from configurator import Config
+from utils.lazy import lazy_import
 from utils.misc import custom_round
+from viz.render import FigureJob, render
 
 CONFIG = Config()
+plt = lazy_import('matplotlib.pyplot')
+mdates = lazy_import('matplotlib.dates')
+sns = lazy_import('seaborn')
 
 
 def line_plt(df, iso, avg_prop, avg_n, x, y,
@@ -77,90 +77,109 @@ def line_plt(df, iso, avg_prop, avg_n, x, y,
         transform=ax.transAxes
     )
     fig.tight_layout()
-    outdir = f"{CONFIG['directories.data']['viz']}/{iso}"
-    if not path.exists(outdir):
-        mkdir(outdir)
-    plt.savefig(
-        f"{outdir}/{iso}_{x}_time_series_{suffix}.png", dpi=300, bbox_inches="tight")
-    plt.close()
+    outfile = get_outfile(iso, x, suffix)
+    makedirs(path.dirname(outfile), exist_ok=True)
+    fig.savefig(outfile, dpi=300, bbox_inches="tight")
+    plt.close(fig)
 
 
-def prep_data(iso, x, y):
+def get_outfile(iso, x, suffix):
+    return f"{CONFIG['directories.data']['viz']}/{iso}/" \
+        f"{iso}_{x}_time_series_{suffix}.png"
+
+
+def load_data():
+    """Read model_input and variance once, with dates already converted."""
     # drop july 2020 so time points shown are evenly spaced
     df = pd.read_csv(
         f"{CONFIG['directories.data']['processed']}/model_input.csv").query(
             "query_date != '2020-07-25'"
         )
+    df['query_datetime'] = pd.to_datetime(df['query_date'], format='%Y-%m-%d')
+    variance_df = pd.read_csv(
+        f"{CONFIG['directories.data']['processed']}/variance.csv")
+    return df, variance_df
+
+
+def country_slices(df, variance_df, x, y, isos=None, k=5):
+    """Yield (iso, df, prop, n) for each country on the x side.
+
+    df is restricted to the k partners with the largest mean flow, out of
+    the partners that show up more than 5 times. prop and n are the share of
+    the population using LinkedIn and the number of users, averaged over
+    time.
+    """
+    if isos is not None:
+        df = df[df[f'iso3_{x}'].isin(isos)]
+        variance_df = variance_df[variance_df[f'iso3_{x}'].isin(isos)]
+    pair_cols = [f'iso3_{x}', f'iso3_{y}']
     # restrict to countries that show up at least a few times
-    keep_isos = list(
-        df.query(f"iso3_{x} == '{iso}'").groupby(
-            f'iso3_{y}'
-        )['flow'].count().iloc[lambda x: x.values > 5].index)
-    bins_dict = defaultdict(lambda: 5)
-    return df.query(f"iso3_{x} == '{iso}' & iso3_{y} in {keep_isos}").assign(
+    counts = df.groupby(pair_cols)['flow'].count()
+    keep = pd.MultiIndex.from_frame(variance_df[pair_cols]).isin(
+        counts.index[counts.values > 5])
+    top_idx = variance_df[keep].groupby(f'iso3_{x}')['flow_mean'].nlargest(
+        k).index.get_level_values(-1)
+    df = df.merge(variance_df.loc[top_idx, pair_cols], on=pair_cols).assign(
         # proportion of relocaters out of all users
-        prop=df['flow'] / df[f'users_{x}'],
-        cutoff=lambda x: pd.qcut(
-            x['prop'], bins_dict[iso], labels=False
-        ),
-        query_datetime=df['query_date'].apply(
-            lambda x: datetime.strptime(x, '%Y-%m-%d'))
+        prop=lambda d: d['flow'] / d[f'users_{x}']
     ).sort_values(by=['query_datetime', 'prop'], ascending=[True, False])
+    # safe to take the first value b/c we only care about country_x
+    country_stats = variance_df.groupby(f'iso3_{x}')[
+        [f'prop_{x}_mean', f'users_{x}_mean']].first()
+    plot_cols = ['query_datetime', 'prop', f'country_{x}', f'country_{y}']
+    for iso, iso_df in df.groupby(f'iso3_{x}', sort=False):
+        prop, n = country_stats.loc[iso]
+        yield iso, iso_df[plot_cols], prop, custom_round(n)
 
 
-def get_top_countries(x, iso3_y, df, variance_df):
-    top = variance_df.sort_values(
-        by='flow_mean', ascending=False).iloc[:x][f'iso3_{iso3_y}'].values
-    top_df = df[df[f'iso3_{iso3_y}'].isin(top)]
-    # bit of a hack
-    # because of an earlier restriction (that we like) sometimes < 10
-    num_isos = x
-    while len(top_df[f'iso3_{iso3_y}'].unique()) < x:
-        num_isos += 1
-        top = variance_df.sort_values(
-            by='flow_mean', ascending=False
-        ).iloc[:num_isos][f'iso3_{iso3_y}'].values
-        top_df = df[df[f'iso3_{iso3_y}'].isin(top)]
-    return top_df
-
-
-def main(iso, dest):
+def time_series_jobs(df, variance_df, dest, isos=None):
     if not dest:
         iso3_x = 'orig'
         iso3_y = 'dest'
     else:
         iso3_x = 'dest'
         iso3_y = 'orig'
-    # data that will be plotted
-    df = prep_data(iso, iso3_x, iso3_y)
-    # now pull in some other metrics
-    variance_df = pd.read_csv(
-        f"{CONFIG['directories.data']['processed']}/variance.csv"
-    ).query(f"iso3_{iso3_x} == '{iso}'")
-    # safe to take the first value b/c we only care about country_x
-    # proportion of population using LinkedIn (averaged over time)
-    prop = variance_df[f'prop_{iso3_x}_mean'].iloc[0]
-    # number of LinkedIn users per country (averaged over time)
-    n = custom_round(variance_df[f'users_{iso3_x}_mean'].iloc[0])
     # plot top countries
-    # line_plt(
-    #     get_top_countries(10, iso3_y, df, variance_df),
-    #     iso, prop, n, iso3_x, iso3_y, suffix='top10')
-    line_plt(
-        get_top_countries(5, iso3_y, df, variance_df),
-        iso, prop, n, iso3_x, iso3_y, y_lim=(0, .0025), suffix='top5')
+    for iso, top_df, prop, n in country_slices(
+            df, variance_df, iso3_x, iso3_y, isos):
+        yield FigureJob(
+            line_plt, (top_df, iso, prop, n, iso3_x, iso3_y),
+            {'y_lim': (0, .0025), 'suffix': 'top5'},
+            [get_outfile(iso, iso3_x, 'top5')])
+
+
+def main(isos, dest, n_jobs=None, force=False):
+    """Plot time series for isos (all countries if None).
+
+    dest=None plots both directions.
+    """
+    df, variance_df = load_data()
+    directions = [False, True] if dest is None else [dest]
+    render((job for d in directions
+            for job in time_series_jobs(df, variance_df, d, isos)),
+           n_jobs, force)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('iso3', help='country code', type=str.lower)
+    parser.add_argument(
+        'iso3', help='country code', type=str.lower, nargs='?')
     parser.add_argument(
         '-dest', '--destination', help='iso3 will be destination instead',
         action='store_true'
     )
+    parser.add_argument(
+        '--all', action='store_true',
+        help='every country, as both origin and destination')
+    parser.add_argument('--n_jobs', type=int, help='number of processes')
+    parser.add_argument(
+        '--force', action='store_true', help='redraw unchanged figures too')
     args = parser.parse_args()
-    if args.iso3 == 'paa2022':
-        for iso3 in ['deu', 'esp', 'fra', 'nld', 'ita', 'gbr']:
-            main(iso3, False)
+    if args.all:
+        main(None, None, args.n_jobs, args.force)
+    elif args.iso3 == 'paa2022':
+        main(['deu', 'esp', 'fra', 'nld', 'ita', 'gbr'], False,
+             args.n_jobs, args.force)
     else:
-        main(args.iso3, args.destination)
+        assert args.iso3 is not None, "Pass a country code or --all"
+        main([args.iso3], args.destination, args.n_jobs, args.force)
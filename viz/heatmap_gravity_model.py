@@ -1,16 +1,23 @@
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
-from itertools import permutations
 from configurator import Config
 from datetime import datetime
 import argparse
-from pycountry import countries
-from utils.misc import get_location_hierarchy
-from etl.prep_bilateral_flows import cyp_hack
+from os import makedirs, path
+from shutil import copyfile
+from utils.hierarchy import EU_OVERRIDES, LocationHierarchy
+from viz.matrix_builder import add_country_names, build_matrices
+from viz.raster_heatmap import raster_heatmap
+from viz.render import FigureJob, render
+from model.design_matrix import parse_formula
+from model.registry import ModelRegistry
+from utils.lazy import lazy_import
 
 CONFIG = Config()
+INVERSE_TFORMS = {'log10': lambda x: np.power(10, x), 'log': np.exp,
+                  None: lambda x: x}
+sns = lazy_import('seaborn')
+plt = lazy_import('matplotlib.pyplot')
 
 
 def percent_error(resid, fitted):
@@ -19,86 +26,70 @@ def percent_error(resid, fitted):
 
 def get_best_model():
     model_dir = f"{CONFIG['directories.data']['model']}"
-    best = pd.read_csv(f"{model_dir}/model_versions.csv").query("best == 1")
-    assert len(best) == 1
-    best_row = best.iloc[0]
+    best_row = ModelRegistry().best()
     return pd.read_csv(
         f"{model_dir}/{best_row['description']}-{best_row['version_id']}.csv")
 
 
-def aggregate_locations(df, loc_level='subregion'):
+def fitted_flows(df, version):
+    """.fitted of a model version back on the flow scale: the dependent
+    variable's transform in the formula is inverted, and for the GLMs the
+    log link (.fitted is the linear predictor, like broom::augment)."""
+    dep_func = parse_formula(version['formula'])[0][0]
+    fitted = df['.fitted'] if version['type'] == 'cohen' \
+        else np.exp(df['.fitted'])
+    return INVERSE_TFORMS[dep_func](fitted)
+
+
+def aggregate_locations(df, loc_level='subregion', hierarchy=None,
+                        version=None):
     """Aggregate model results to a given location level.
     
     The model is run in log space, so residuals should be
     calculated in log space, however, it doesn't make sense to sum log-
     transformed values. Therefore, sum to the region then
     log-transform and recalculate residuals.
+
+    Aggregated locations are labeled region_orig / region_dest whatever
+    the level, that's what the heatmap expects. Cyprus goes with Southern
+    Europe unless another hierarchy is given. version is the registry row
+    of the model, the best one by default.
     """
-    # read in mapping from iso3 to region, subregion, midregion
-    loc_df = get_location_hierarchy()[[loc_level]]
-    df = df.merge(
-        loc_df, how='left', left_on='iso3_orig', right_index=True
-    ).merge(
-        loc_df, how='left', left_on='iso3_dest', right_index=True,
-        suffixes=('_orig', '_dest')
-    ).pipe(cyp_hack).assign(
-        antilog_preds=np.power(10, df['.fitted'])
-    ).groupby(
-        [f'{loc_level}_orig', f'{loc_level}_dest'], as_index=False
-    )[['antilog_preds', 'flow_median', 'users_dest_median']].sum().rename(
-        columns={'antilog_preds': '.fitted',
-                 'subregion_orig': 'region_orig',
-                 'subregion_dest': 'region_dest'})
+    hierarchy = LocationHierarchy(EU_OVERRIDES) if hierarchy is None \
+        else hierarchy
+    version = ModelRegistry().best() if version is None else version
+    df = hierarchy.rollup(
+        df.assign(antilog_preds=fitted_flows(df, version)),
+        ['antilog_preds', 'flow_median', 'users_dest_median'], loc_level
+    ).rename(columns={'antilog_preds': '.fitted',
+                      f'{loc_level}_orig': 'region_orig',
+                      f'{loc_level}_dest': 'region_dest'})
     df['.resid'] = df['flow_median'] - df['.fitted']
     return df
 
 
 def prep_heatmap_data(df, value, loc_level='country'):
     if loc_level == 'country':
-        for x in ['orig', 'dest']:
-            df[f'{loc_level}_{x}'] = df[f'iso3_{x}'].apply(
-                lambda x: countries.get(alpha_3=x.upper()).name
-            )
-    col_label_dict = {
-        f'{loc_level}_orig': f'Current {loc_level.capitalize()}',
-        f'{loc_level}_dest': f'Prospective Destination {loc_level.capitalize()}'
-    }
-    id_cols = list(col_label_dict.keys())
-    labels = list(col_label_dict.values())
-    if loc_level == 'country':
-        pvt = pd.DataFrame(
-            permutations(df[f'{loc_level}_dest'].unique(), 2), columns=id_cols
-        ).merge(df[id_cols + [value]], how='left').fillna(0).rename(
-            columns=col_label_dict).pivot_table(
-                value, labels[0], labels[1]
-            )
-    else:
-        pvt = df[id_cols + [value]].rename(columns=col_label_dict).pivot_table(
-            value, labels[0], labels[1])
-    order = df.sort_values(by='users_dest_median', ascending=False)[
-        f'{loc_level}_dest'].drop_duplicates().values
-    return pvt.reindex(order, axis=0).reindex(order, axis=1)
+        df = add_country_names(df)
+    loc_str = loc_level.capitalize()
+    kwargs = {'fill': 0, 'self_pairs': False} if loc_level == 'country' \
+        else {}
+    return build_matrices(
+        df, [value], f'{loc_level}_orig', f'{loc_level}_dest',
+        axis_names=(f'Current {loc_str}',
+                    f'Prospective Destination {loc_str}'),
+        **kwargs)[value]
 
 
 def heatmap(df, value, aggregate):
     assert 'quant' in value, "This will only work for categorical plots"
-    ticks = list(set(df[value]))
-    heatmap_kws = {
-        'square': True, 'linewidths': .5, 'cbar_kws': {"shrink": .5},
-        'cmap': sns.color_palette("coolwarm", len(ticks)),
-    }
+    ticks = sorted(set(df[value]))
     if aggregate:
         pairs = prep_heatmap_data(df, value, loc_level='region')
         fig_size = (9, 6)
     else:
         pairs = prep_heatmap_data(df, value)
         fig_size = (12, 10)
-    # create figure
-    fig, ax = plt.subplots(figsize=fig_size)
-    ax = sns.heatmap(pairs, mask=(pairs == 0), **heatmap_kws)
-    # hack for making the colorbar show categories
-    colorbar = ax.collections[0].colorbar
-    colorbar.set_ticks(ticks)
     tick_labels = [
         'much lower than expected', 'lower than expected',
         'about as expected', 'higher than expected',
@@ -106,7 +97,12 @@ def heatmap(df, value, aggregate):
     ]
     assert len(tick_labels) == len(ticks), \
         "now you messed up, number of tick labels != number of ticks"
-    colorbar.set_ticklabels(tick_labels)
+    # create figure
+    fig, ax = plt.subplots(figsize=fig_size)
+    raster_heatmap(
+        pairs, ax, sns.color_palette("coolwarm", len(ticks)),
+        mask=(pairs == 0), linewidth=.5,
+        categories=dict(zip(ticks, tick_labels)), cbar_kws={"shrink": .5})
     # Let the horizontal axis labeling appear on top
     ax.xaxis.set_label_position('top')
     ax.tick_params(top=True, bottom=False, labeltop=True, labelbottom=False)
@@ -116,25 +112,36 @@ def heatmap(df, value, aggregate):
     plt.setp(ax.get_xticklabels(), rotation=-30, ha="right",
              rotation_mode="anchor")
     fig.tight_layout()
+    outfile, archive_file = get_outfiles(value, aggregate)
+    fig.savefig(outfile)
+    plt.close(fig)
+    # the archive copy is the same file, no need to draw it twice
+    makedirs(path.dirname(archive_file), exist_ok=True)
+    copyfile(outfile, archive_file)
+
+
+def get_outfiles(value, aggregate):
+    """Current version of the heatmap and a dated copy in _archive."""
     out_dir = CONFIG['directories.data']['viz']
     agg_str = '_aggregate' if aggregate else ''
-    plt.savefig(
-        f'{out_dir}/eu_heatmap_{value}{agg_str}.pdf')
-    plt.savefig(
-        f'{out_dir}/_archive/\
-        eu_heatmap_{value}{agg_str}_{datetime.now().date()}.pdf')
-    plt.close()
+    return [
+        f'{out_dir}/eu_heatmap_{value}{agg_str}.pdf',
+        f'{out_dir}/_archive/'
+        f'eu_heatmap_{value}{agg_str}_{datetime.now().date()}.pdf']
 
 
-def main(value, aggregate):
+def main(value, aggregate, loc_level='subregion', force=False):
     df = get_best_model()
     if aggregate:
-        df = aggregate_locations(df)
+        df = aggregate_locations(df, loc_level)
     df['pct_error'] = percent_error(df['.resid'], df['.fitted'])
     df[[f'{x}_quant' for x in ['resids', 'pct_error']]] = \
         df[['.resid', 'pct_error']].apply(
             lambda x: pd.qcut(x, 5, labels=list(range(1, 6))).astype(int))
-    heatmap(df, f'{value}_quant', aggregate)
+    value = f'{value}_quant'
+    # the dated archive copy is new every day, it isn't an output to check
+    render([FigureJob(heatmap, (df, value, aggregate), {},
+                      get_outfiles(value, aggregate)[:1])], 1, force)
 
 
 if __name__ == "__main__":
@@ -144,5 +151,10 @@ if __name__ == "__main__":
         '-aggregate', help='whether to aggregate to higher location level',
         action='store_true'
     )
+    parser.add_argument(
+        '--loc_level', help='location level to aggregate to',
+        choices=['region', 'subregion', 'midregion'], default='subregion')
+    parser.add_argument(
+        '--force', action='store_true', help='redraw even if unchanged')
     args = parser.parse_args()
-    main(args.value, args.aggregate)
+    main(args.value, args.aggregate, args.loc_level, args.force)
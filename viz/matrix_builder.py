@@ -0,0 +1,61 @@
+"""Build origin x destination matrices for heatmaps.
+
+Dyadic values are scattered straight into a preallocated array using
+integer codes for origin and destination, so every metric for a subset
+comes out of one pass instead of a merge + pivot_table + reindex per metric.
+"""
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from utils.lazy import lazy_import
+
+pycountry = lazy_import('pycountry')
+
+
+@lru_cache(maxsize=None)
+def country_name(iso3):
+    return pycountry.countries.get(alpha_3=iso3.upper()).name
+
+
+def add_country_names(df):
+    """Add country_orig, country_dest, looking up each iso3 only once."""
+    for x in ['orig', 'dest']:
+        df[f'country_{x}'] = df[f'iso3_{x}'].map(
+            {iso: country_name(iso) for iso in df[f'iso3_{x}'].unique()})
+    return df
+
+
+def build_matrices(df, values, orig_col, dest_col,
+                   order_col='users_dest_median', fill=np.nan,
+                   self_pairs=True, axis_names=(None, None)):
+    """Return {value: origin x destination dataframe} for each value.
+
+    Rows and columns are the destinations in df, ordered by order_col
+    (largest first); origins that never show up as a destination are left
+    out. Pairs missing from df get fill, and with self_pairs=False the
+    diagonal is always NaN. Duplicate pairs are averaged like pivot_table.
+    """
+    order = df.sort_values(by=order_col, ascending=False)[
+        dest_col].drop_duplicates().values
+    labels = pd.Index(order)
+    orig = labels.get_indexer(df[orig_col])
+    dest = labels.get_indexer(df[dest_col])
+    keep = orig >= 0
+    orig, dest = orig[keep], dest[keep]
+    n = len(labels)
+    data = df.loc[keep, values].values.astype(float).T
+    sums = np.zeros((len(values), n, n))
+    counts = np.zeros((n, n))
+    np.add.at(counts, (orig, dest), 1)
+    for i in range(len(values)):
+        np.add.at(sums[i], (orig, dest), data[i])
+    with np.errstate(invalid='ignore'):
+        matrices = np.where(counts > 0, sums / counts, fill)
+    if not self_pairs:
+        matrices[:, np.arange(n), np.arange(n)] = np.nan
+    index = pd.Index(labels, name=axis_names[0])
+    columns = pd.Index(labels, name=axis_names[1])
+    return {value: pd.DataFrame(matrix, index=index, columns=columns)
+            for value, matrix in zip(values, matrices)}
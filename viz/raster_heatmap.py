@@ -0,0 +1,121 @@
+"""Heatmaps of dense origin x destination matrices drawn as one image.
+
+sns.heatmap draws a mesh of cells plus one Text artist per annotation,
+which gets slow and makes huge PDFs for 190 x 190 matrices. Here the cells
+are a single imshow image, cell borders are two line collections, and
+annotations are glyph outlines merged into one path per text colour. The
+image and annotations are rasterized, so only the axes, labels and lines
+are vector in a PDF, whatever the size of the matrix.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from utils.lazy import lazy_import
+
+mcolors = lazy_import('matplotlib.colors')
+font_manager = lazy_import('matplotlib.font_manager')
+patches = lazy_import('matplotlib.patches')
+mpath = lazy_import('matplotlib.path')
+textpath = lazy_import('matplotlib.textpath')
+
+# text height as a share of the cell
+ANNOT_SIZE = 0.4
+
+
+@lru_cache(maxsize=None)
+def _glyphs(label):
+    """Outline of label, centered on 0 with unit font size, flipped for an
+    axis where y points down."""
+    path = textpath.TextPath(
+        (0, 0), label, size=1, prop=font_manager.FontProperties())
+    extents = path.get_extents()
+    vertices = path.vertices - [
+        (extents.x0 + extents.x1) / 2, (extents.y0 + extents.y1) / 2]
+    return vertices * [1, -1], path.codes
+
+
+def _text_path(labels, x, y, size):
+    """One compound path with every label drawn at its (x, y)."""
+    glyphs = [_glyphs(label) for label in labels]
+    n_vertices = np.array([len(v) for v, _ in glyphs])
+    vertices = np.concatenate([v for v, _ in glyphs]) * size + np.repeat(
+        np.column_stack([x, y]), n_vertices, axis=0)
+    codes = np.concatenate([c for _, c in glyphs])
+    return mpath.Path(vertices, codes)
+
+
+def _luminance(rgba):
+    rgb = rgba[..., :3]
+    rgb = np.where(rgb <= .03928, rgb / 12.92, ((rgb + .055) / 1.055) ** 2.4)
+    return rgb @ [.2126, .7152, .0722]
+
+
+def raster_heatmap(matrix_df, ax, cmap, vmin=None, vmax=None, mask=None,
+                   annot=False, fmt='.0f', linewidth=1, categories=None,
+                   cbar_kws=None):
+    """Draw matrix_df on ax, returns (image, colorbar).
+
+    cmap: a colormap, or a list of colors (one per category)
+    mask: boolean array, True cells are left blank like NaNs
+    categories: {value: label} for a categorical colorbar, values are
+        expected to be the integers in the matrix
+    """
+    values = matrix_df.values.astype(float)
+    blank = ~np.isfinite(values)
+    if mask is not None:
+        blank |= np.asarray(mask)
+    data = np.ma.masked_array(values, blank)
+    if categories is not None:
+        levels = sorted(categories)
+        cmap = mcolors.ListedColormap(cmap) if isinstance(cmap, list) else cmap
+        norm = mcolors.BoundaryNorm(
+            np.append(np.array(levels) - .5, levels[-1] + .5), cmap.N)
+    else:
+        cmap = mcolors.ListedColormap(cmap) if isinstance(cmap, list) else cmap
+        norm = mcolors.Normalize(
+            data.min() if vmin is None else vmin,
+            data.max() if vmax is None else vmax)
+    n_rows, n_cols = values.shape
+    image = ax.imshow(
+        data, cmap=cmap, norm=norm, interpolation='none', aspect='equal',
+        extent=(-.5, n_cols - .5, n_rows - .5, -.5))
+    if linewidth:
+        ax.hlines(np.arange(n_rows + 1) - .5, -.5, n_cols - .5,
+                  colors='white', linewidth=linewidth)
+        ax.vlines(np.arange(n_cols + 1) - .5, -.5, n_rows - .5,
+                  colors='white', linewidth=linewidth)
+    if annot:
+        rows, cols = np.nonzero(~blank)
+        colors = cmap(norm(values[rows, cols]))
+        dark_text = _luminance(colors) > .408
+        labels = np.array([format(x, fmt) for x in values[rows, cols]])
+        for use_dark, color in [(True, '.15'), (False, 'white')]:
+            keep = dark_text == use_dark
+            if keep.any():
+                patch = patches.PathPatch(
+                    _text_path(labels[keep], cols[keep], rows[keep],
+                               ANNOT_SIZE),
+                    facecolor=mcolors.to_rgb(color), edgecolor='none', lw=0)
+                patch.set_rasterized(True)
+                # the extents of a path this size take ages to compute, and
+                # it never goes outside the image anyway
+                patch.set_in_layout(False)
+                ax.add_artist(patch)
+    colorbar = ax.figure.colorbar(image, ax=ax, **(cbar_kws or {}))
+    colorbar.outline.set_visible(False)
+    colorbar.solids.set_rasterized(True)
+    if categories is not None:
+        colorbar.set_ticks(levels)
+        colorbar.set_ticklabels([categories[x] for x in levels])
+    # every country gets a label, shrinking the font for big matrices
+    fontsize = min(10, max(2, 500 / max(n_rows, n_cols)))
+    ax.set_xticks(np.arange(n_cols))
+    ax.set_xticklabels(matrix_df.columns, fontsize=fontsize)
+    ax.set_yticks(np.arange(n_rows))
+    ax.set_yticklabels(matrix_df.index, fontsize=fontsize)
+    ax.set_xlabel(matrix_df.columns.name or '')
+    ax.set_ylabel(matrix_df.index.name or '')
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    return image, colorbar
@@ -0,0 +1,158 @@
+"""Render batches of figures in parallel, skipping unchanged ones.
+
+A FigureJob is a plotting function, its arguments and the files it writes.
+Each job is keyed by a hash of its data (dataframes are hashed by content),
+its other arguments and the source of the plotting code: the file of the
+plotting function's module and of every module of this repo it reaches
+through its globals (e.g. viz/raster_heatmap.py), so editing a title or a
+helper redraws the figure. Keys are kept in a manifest in the plot
+directory, and a job whose key and output files haven't changed since the
+last run is skipped. The rest run in a process pool with the Agg backend.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import types
+from collections import namedtuple
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from configurator import Config
+from utils.lazy import lazy_import
+
+CONFIG = Config()
+# workers set the backend, the parent doesn't need matplotlib at all
+matplotlib = lazy_import('matplotlib')
+
+FigureJob = namedtuple('FigureJob', ['func', 'args', 'kwargs', 'outputs'])
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _update_hash(h, x):
+    if isinstance(x, (pd.DataFrame, pd.Series)):
+        names = x.columns if isinstance(x, pd.DataFrame) else [x.name]
+        h.update(repr(list(names)).encode())
+        h.update(pd.util.hash_pandas_object(x, index=True).values.tobytes())
+    elif isinstance(x, np.ndarray):
+        h.update(np.ascontiguousarray(x).tobytes())
+    elif isinstance(x, (list, tuple)):
+        for item in x:
+            _update_hash(h, item)
+    elif isinstance(x, dict):
+        for k in sorted(x):
+            h.update(str(k).encode())
+            _update_hash(h, x[k])
+    else:
+        h.update(repr(x).encode())
+
+
+def _repo_module(x):
+    """The module of this repo that x is or was defined in, if any."""
+    module = x if isinstance(x, types.ModuleType) else sys.modules.get(
+        getattr(type(x), '__module__', None) if not callable(x)
+        else getattr(x, '__module__', None))
+    filename = getattr(module, '__file__', None)
+    if filename and os.path.abspath(filename).startswith(ROOT + os.sep):
+        return module
+    return None
+
+
+@lru_cache(maxsize=None)
+def source_hash(module_name):
+    """Hash of the source of a module and the repo modules it uses."""
+    todo, seen = [sys.modules[module_name]], set()
+    while todo:
+        module = todo.pop()
+        if module.__name__ in seen:
+            continue
+        seen.add(module.__name__)
+        todo.extend(x for x in map(_repo_module, vars(module).values())
+                    if x is not None)
+    h = hashlib.sha256()
+    for name in sorted(seen):
+        with open(sys.modules[name].__file__, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def job_key(job):
+    h = hashlib.sha256()
+    h.update(f'{job.func.__module__}.{job.func.__qualname__}'.encode())
+    h.update(job.func.__code__.co_code)
+    if _repo_module(job.func) is not None:
+        h.update(source_hash(job.func.__module__).encode())
+    _update_hash(h, job.args)
+    _update_hash(h, job.kwargs)
+    return h.hexdigest()
+
+
+def _manifest_path():
+    return f"{CONFIG['directories.data']['viz']}/_render_manifest.json"
+
+
+def _read_manifest():
+    if os.path.exists(_manifest_path()):
+        with open(_manifest_path()) as f:
+            return json.load(f)
+    return {}
+
+
+def _update_manifest(keys):
+    """Add {output: key} to the manifest. Read and written again under a
+    lock, so concurrent renders don't lose each other's entries, and via a
+    temporary file, so a crash can't leave half a manifest."""
+    with open(f'{_manifest_path()}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = _read_manifest()
+        manifest.update(keys)
+        tmp = f'{_manifest_path()}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, _manifest_path())
+
+
+def _init_worker():
+    matplotlib.use('Agg')
+
+
+def _run(job):
+    job.func(*job.args, **job.kwargs)
+
+
+def render(jobs, n_jobs=None, force=False):
+    """Run figure jobs (any iterable) whose inputs changed.
+
+    Returns how many were drawn.
+    """
+    manifest = _read_manifest()
+    todo, drawn = [], {}
+    n_unchanged = 0
+    for job in jobs:
+        key = job_key(job)
+        unchanged = all(
+            manifest.get(x) == key and os.path.exists(x) for x in job.outputs)
+        if force or not unchanged:
+            todo.append((key, job))
+        else:
+            n_unchanged += 1
+    print(f'{n_unchanged} figures unchanged, drawing {len(todo)}')
+    if not todo:
+        return 0
+    try:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker) as pool:
+            futures = {pool.submit(_run, job): (key, job) for key, job in todo}
+            for future in as_completed(futures):
+                key, job = futures[future]
+                # re-raises errors from the worker
+                future.result()
+                drawn.update({x: key for x in job.outputs})
+    finally:
+        # keep track of whatever did get drawn, even if a job failed
+        if drawn:
+            _update_manifest(drawn)
+    return len(todo)
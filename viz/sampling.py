@@ -0,0 +1,88 @@
+"""Reproducible samples and precomputed histograms for exploratory plots.
+
+stratified_sample keeps every stratum (e.g. query_date x eu_plus) in a plot
+while capping the total number of rows and the rows per stratum, so scatter
+plots draw a bounded number of points at any data size. facet_histograms
+bins every facet and hue in one pass with np.bincount and gets the KDEs by
+smoothing a fine histogram with a Gaussian kernel (Scott's rule, like
+seaborn), so the plotting function only has to draw arrays.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# defaults for the row budget and the cap on rows per stratum
+MAX_ROWS = 20000
+MAX_PER_STRATUM = 2000
+
+HistFacets = namedtuple(
+    'HistFacets', ['facets', 'hues', 'edges', 'counts', 'grid', 'kde'])
+
+
+def stratified_sample(df, strata, max_rows=MAX_ROWS,
+                      max_per_stratum=MAX_PER_STRATUM, seed=0):
+    """Sample rows of df in proportion to the size of each stratum.
+
+    Every stratum keeps at least one row and at most max_per_stratum rows,
+    and the same seed always gives the same sample.
+    """
+    if len(df) <= max_rows and \
+            df.groupby(strata).size().max() <= max_per_stratum:
+        return df
+    codes = df.groupby(strata, sort=False).ngroup().values
+    sizes = np.bincount(codes)
+    quota = np.clip(np.floor(sizes * max_rows / len(df)), 1, max_per_stratum)
+    # shuffle, then keep the first quota rows of each stratum
+    order = np.random.default_rng(seed).permutation(len(df))
+    rank = pd.Series(codes[order]).groupby(codes[order]).cumcount().values
+    keep = np.sort(order[rank < quota[codes[order]]])
+    return df.iloc[keep]
+
+
+def _kde(fine_counts, centers, bandwidth):
+    """Gaussian KDE of binned data, one row per group, in count units."""
+    diff = (centers[:, None] - centers[None, :])[None] / \
+        bandwidth[:, None, None]
+    kernel = np.exp(-0.5 * diff ** 2) / np.sqrt(2 * np.pi)
+    return np.einsum('gb,gbc->gc', fine_counts, kernel) / bandwidth[:, None]
+
+
+def facet_histograms(df, value, facet, hue, bins=20, grid_size=200):
+    """Histogram and KDE of df[value] for every (facet, hue) combination.
+
+    All facets share the same bins. counts and kde have shape
+    (facets, hues, bins) and (facets, hues, grid_size), the KDE is scaled
+    to the histogram counts like seaborn's histplot(kde=True).
+    """
+    df = df[np.isfinite(df[value])]
+    x = df[value].values
+    facet_codes, facets = pd.factorize(df[facet], sort=True)
+    hue_codes, hues = pd.factorize(df[hue], sort=True)
+    n_groups = len(facets) * len(hues)
+    group = facet_codes * len(hues) + hue_codes
+    edges = np.histogram_bin_edges(x, bins)
+    bin_idx = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, bins - 1)
+    counts = np.bincount(
+        group * bins + bin_idx, minlength=n_groups * bins
+    ).reshape(len(facets), len(hues), bins)
+    grid = np.linspace(edges[0], edges[-1], grid_size)
+    step = grid[1] - grid[0] if grid_size > 1 else 1
+    grid_idx = np.clip(np.round((x - grid[0]) / step).astype(int),
+                       0, grid_size - 1)
+    fine_counts = np.bincount(
+        group * grid_size + grid_idx, minlength=n_groups * grid_size
+    ).reshape(n_groups, grid_size)
+    # Scott's rule per group, groups with < 2 points or no spread get no KDE
+    n = np.bincount(group, minlength=n_groups)
+    sums = np.bincount(group, x, minlength=n_groups)
+    sq_sums = np.bincount(group, x ** 2, minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (sq_sums - sums ** 2 / n) / (n - 1)
+        bandwidth = np.sqrt(var) * n ** (-1 / 5)
+    ok = np.isfinite(bandwidth) & (bandwidth > 0)
+    kde = np.full((n_groups, grid_size), np.nan)
+    kde[ok] = _kde(fine_counts[ok], grid, bandwidth[ok]) * np.diff(edges)[0]
+    return HistFacets(
+        np.asarray(facets), np.asarray(hues), edges, counts, grid,
+        kde.reshape(len(facets), len(hues), grid_size))
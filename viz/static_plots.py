@@ -1,17 +1,25 @@
+import argparse
 import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
 from os import path, mkdir
-from matplotlib.patches import Rectangle
-from scipy import stats
-import statsmodels.stats.api as sms
 from configurator import Config
+from utils.lazy import lazy_import
+from viz.matrix_builder import build_matrices
+from viz.raster_heatmap import raster_heatmap
+from viz.render import FigureJob, render
+from viz.sampling import (
+    MAX_PER_STRATUM, MAX_ROWS, facet_histograms, stratified_sample)
 
 """Exploratory plots that I made at the very beginning to look at
 distributions, associations, etc."""
 
 CONFIG = Config()
+# only loaded by the plots that use them, e.g. not for heatmaps only
+sns = lazy_import('seaborn')
+plt = lazy_import('matplotlib.pyplot')
+patches = lazy_import('matplotlib.patches')
+stats = lazy_import('scipy.stats')
+sms = lazy_import('statsmodels.stats.api')
 
 
 def log_tform(df, log_cols):
@@ -30,28 +38,52 @@ def ttest(df, grp_var):
 
 
 def facet_hist(df, plt_vars, output_dir):
+    """Figure jobs for histograms of each variable, faceted by date.
+
+    Bins and KDEs are computed here, so each job only draws arrays.
+    """
     df = df[plt_vars + ['query_date', 'eu_plus']].replace(
-        {-np.inf: np.nan, np.inf: np.nan}
-    ).sort_values(by='query_date')
-    for plt_var in plt_vars:
-        ax = sns.displot(
-            df, x=plt_var, col='query_date', hue='eu_plus', kde=True,
-            height=2, col_wrap=3, facet_kws={'dropna': True}
-        )
-        plt.savefig(f"{output_dir}/hist_{plt_var}.png", dpi=300)
-        plt.close()
+        {-np.inf: np.nan, np.inf: np.nan})
+    return [
+        FigureJob(plot_facet_hist,
+                  (facet_histograms(df, plt_var, 'query_date', 'eu_plus'),
+                   plt_var, f"{output_dir}/hist_{plt_var}.png"), {},
+                  [f"{output_dir}/hist_{plt_var}.png"])
+        for plt_var in plt_vars]
+
+
+def plot_facet_hist(hist, plt_var, outfile, height=2, col_wrap=3):
+    n_rows = int(np.ceil(len(hist.facets) / col_wrap))
+    fig, axes = plt.subplots(
+        n_rows, col_wrap, figsize=(height * col_wrap, height * n_rows),
+        sharex=True, sharey=True, squeeze=False)
+    colors = sns.color_palette(n_colors=len(hist.hues))
+    for ax, facet, counts, kde in zip(
+            axes.flat, hist.facets, hist.counts, hist.kde):
+        for hue, color, hue_counts, hue_kde in zip(
+                hist.hues, colors, counts, kde):
+            ax.hist(hist.edges[:-1], hist.edges, weights=hue_counts,
+                    color=color, alpha=0.5, label=hue)
+            ax.plot(hist.grid, hue_kde, color=color)
+        ax.set_title(f'query_date = {facet}', fontsize=8)
+        ax.set_xlabel(plt_var)
+    for ax in axes.flat[len(hist.facets):]:
+        ax.set_visible(False)
+    axes.flat[0].legend(title='eu_plus', frameon=False, fontsize=6)
+    fig.tight_layout()
+    fig.savefig(outfile, dpi=300)
+    plt.close(fig)
 
 
 def pairplot(df, plt_vars, plt_name, output_dir):
     # TODO part of this is getting cut off? and the legend looks funky
-    plt.figure(figsize=(10, 10))
     g = sns.pairplot(
         df.sort_values(by='query_date'), vars=plt_vars + ['flow'],
         hue='query_date', palette='crest', diag_kws=dict(fill=False),
         corner=True, dropna=True
     )
-    plt.savefig(f"{output_dir}/{plt_name}_scatter.png", dpi=300)
-    plt.close()
+    g.savefig(f"{output_dir}/{plt_name}_scatter.png", dpi=300)
+    plt.close(g.fig)
 
 
 def corr_matrix(df, loc_str, suffix, output_dir, type='pearson'):
@@ -78,7 +110,7 @@ def corr_matrix(df, loc_str, suffix, output_dir, type='pearson'):
     )
     ax.set_xticklabels(cols, rotation=45, horizontalalignment='right')
     ax.set_title(f"{loc_str} {title_str} coefficients")
-    ax.add_patch(Rectangle(
+    ax.add_patch(patches.Rectangle(
         (0, 1), 1, len(cols), fill=False, edgecolor='blue', lw=3)
     )
     plt.tight_layout()
@@ -114,58 +146,51 @@ def data_availability(outdir):
 
 
 def variation_heatmap(df, outdir):
+    """Figure jobs for heatmaps of flow variation across dates."""
     df = df.assign(
         flow_variation_pct=lambda x: x['flow_variation'] * 100,
         flow_pct=(df['flow_median'] / df['flow_median'].sum()) * 100
     )
-    # order rows/columns by number of LinkedIn users
-    order = df.sort_values(by='users_dest_median', ascending=False)[
-        'country_dest'].drop_duplicates().values
     num_dates = df['flow_count'].iloc[0]
-    heatmap_kws = {
-        'square': True,
-        'linewidths': 1,
-        'annot': True,
-        'fmt': '.0f', 'cbar_kws': {"shrink": .5},
-        'cmap': sns.color_palette("viridis", as_cmap=True)
-    }
-    for metric in ['flow_variation_pct', 'flow_median', 'flow_pct']:
-        # quick data prep
-        matrix_df = df[
-            ['country_orig', 'country_dest', metric]
-        ].rename(
-            columns={'country_orig': 'Origin Country',
-                     'country_dest': 'Destination Country'}
-        ).pivot_table(
-            metric, 'Origin Country', 'Destination Country'
-        ).reindex(order, axis=0).reindex(order, axis=1)
-        # create figure
-        plt.figure(figsize=(12, 12))
-        if metric == 'flow_variation_pct':
-            metric_str = 'Coefficient of Variation (%)'
-        if metric == 'flow_pct':
-            metric_str = 'Median %'
-        if metric == 'flow_median':
-            metric_str = 'Median number'
-            heatmap_kws.update({'annot': None})
-        # make plot
-        ax = sns.heatmap(matrix_df, **heatmap_kws)
-        # Let the horizontal axis labeling appear on top
-        ax.xaxis.set_label_position('top')
-        ax.tick_params(top=True, bottom=False, labeltop=True,
-                       labelbottom=False)
-        ax.set_title(
-            f'{metric_str} across {num_dates} collection dates', fontsize=15)
-        # add '%' to colorbar for CV %
-        if metric == 'flow_variation_pct':
-            cb = ax.collections[0].colorbar
-            cb.ax.set_yticklabels([f'{i}%' for i in cb.get_ticks()])
-        # Rotate the tick labels and set alignment
-        plt.setp(ax.get_xticklabels(), rotation=-30, ha="right",
-                 rotation_mode="anchor")
-        plt.tight_layout()
-        plt.savefig(f"{outdir}/heatmap_{metric}.png", dpi=300)
-        plt.close()
+    metrics = ['flow_variation_pct', 'flow_median', 'flow_pct']
+    matrices = build_matrices(
+        df, metrics, 'country_orig', 'country_dest',
+        axis_names=('Origin Country', 'Destination Country'))
+    return [
+        FigureJob(plot_variation_heatmap,
+                  (matrix_df, metric, num_dates,
+                   f"{outdir}/heatmap_{metric}.png"), {},
+                  [f"{outdir}/heatmap_{metric}.png"])
+        for metric, matrix_df in matrices.items()]
+
+
+def plot_variation_heatmap(matrix_df, metric, num_dates, outfile):
+    metric_str = {
+        'flow_variation_pct': 'Coefficient of Variation (%)',
+        'flow_pct': 'Median %', 'flow_median': 'Median number'}[metric]
+    # create figure
+    fig, ax = plt.subplots(figsize=(12, 12))
+    # make plot, too many digits to annotate the raw numbers
+    _, cb = raster_heatmap(
+        matrix_df, ax, sns.color_palette("viridis", as_cmap=True),
+        annot=metric != 'flow_median', fmt='.0f', linewidth=1,
+        cbar_kws={"shrink": .5})
+    # Let the horizontal axis labeling appear on top
+    ax.xaxis.set_label_position('top')
+    ax.tick_params(top=True, bottom=False, labeltop=True,
+                   labelbottom=False)
+    ax.set_title(
+        f'{metric_str} across {num_dates} collection dates', fontsize=15)
+    # add '%' to colorbar for CV %
+    if metric == 'flow_variation_pct':
+        cb.set_ticks(cb.get_ticks())
+        cb.set_ticklabels([f'{i:g}%' for i in cb.get_ticks()])
+    # Rotate the tick labels and set alignment
+    plt.setp(ax.get_xticklabels(), rotation=-30, ha="right",
+             rotation_mode="anchor")
+    fig.tight_layout()
+    fig.savefig(outfile, dpi=300)
+    plt.close(fig)
 
 
 def get_top_countries(df, value, country_col='country_dest', n=15):
@@ -219,7 +244,9 @@ def make_line_plt(data, value, title_str, suffix, outdir):
     plt.close()
 
 
-def main(save_hists=False, save_heatmaps=True, save_pairplots=False):
+def main(save_hists=False, save_heatmaps=True, save_pairplots=False,
+         n_jobs=None, force=False, max_rows=MAX_ROWS,
+         max_per_stratum=MAX_PER_STRATUM):
     # save this first, shows what data went into each plot
     # data_availability(get_plot_dir())
     # TODO feeling a plotting class kind of thing
@@ -237,6 +264,7 @@ def main(save_hists=False, save_heatmaps=True, save_pairplots=False):
             for x in ['users', 'pop', 'gdp', 'area']] \
         + ['flow', 'prox2', 'cnl', 'csl'] + \
         [x for x in cont_cols if 'dist' in x]
+    jobs = []
     if save_heatmaps:
         for recip in [True, False]:
             suffix = "_recip_pairs" * recip
@@ -253,35 +281,59 @@ def main(save_hists=False, save_heatmaps=True, save_pairplots=False):
                          (df['users_dest_median'] >= min_users))
                     ]
                     # only make these for subregions
-                    variation_heatmap(data, outdir)
+                    jobs += variation_heatmap(data, outdir)
                 else:
                     data = df.copy()
                 # corr_matrix(data, loc, loc.lower(), outdir)
                 # corr_matrix(data, loc, loc.lower(), outdir, type='spearman')
+    model_input = pd.read_csv(
+        f"{CONFIG['directories.data']['processed']}/model_input.csv")
     for col in [None, 'recip', 'by_date_recip']:
         outdir = f"{CONFIG['directories.data']['viz']}/{col}"
-        df = pd.read_csv(
-            f"{CONFIG['directories.data']['processed']}/model_input.csv")
+        df = model_input.copy()
         if col is not None:
             df = log_tform(df, log_cols + ['net_flow', 'net_rate_100'])
         else:
             df = log_tform(df, log_cols)
         eu = df[df['eu_plus'] == 1]
         if save_hists:
-            facet_hist(df, [x for x in df.columns if 'log' in x], outdir)
+            jobs += facet_hist(
+                df, [x for x in df.columns if 'log' in x], outdir)
         for string, data in {'EU+UK': eu, 'Global': df}.items():
             if save_pairplots:
                 # columns chosen manually by inspection of previous plots
                 cols = ['gdp_dest', 'hdi_dest',
                         'internet_dest', 'prox1', 'prox2']
-                pairplot(data, cols, string, outdir)
+                # every date keeps some points, but no more than the budget
+                sample = stratified_sample(
+                    data[cols + ['flow', 'query_date', 'eu_plus']],
+                    ['query_date', 'eu_plus'], max_rows, max_per_stratum)
+                jobs.append(FigureJob(
+                    pairplot, (sample, cols, string, outdir), {},
+                    [f"{outdir}/{string}_scatter.png"]))
         # if col == 'recip':
         #     for x in categorical_cols:
         #         print(f'Global dataset:\n{ttest(df, x)}')
         #         print(f'EU dataset:\n{ttest(eu, x)}')
     # # TODO this line plot is not quite right
     # # plt_over_time(get_plot_dir())
+    render(jobs, n_jobs, force)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save_hists', action='store_true')
+    parser.add_argument('--skip_heatmaps', action='store_true')
+    parser.add_argument('--save_pairplots', action='store_true')
+    parser.add_argument('--n_jobs', type=int, help='number of processes')
+    parser.add_argument(
+        '--force', action='store_true', help='redraw unchanged figures too')
+    parser.add_argument(
+        '--max_rows', type=int, default=MAX_ROWS,
+        help='rows sampled for scatter plots')
+    parser.add_argument(
+        '--max_per_stratum', type=int, default=MAX_PER_STRATUM,
+        help='rows sampled per date and eu_plus group for scatter plots')
+    args = parser.parse_args()
+    main(args.save_hists, not args.skip_heatmaps, args.save_pairplots,
+         args.n_jobs, args.force, args.max_rows, args.max_per_stratum)